@@ -0,0 +1,327 @@
+"""
+Time the read endpoints of the HTTP API against synthetic repositories
+of a configurable size, through a WSGI test client. Every endpoint is
+run in a process of its own so its peak memory can be reported.
+
+::
+
+    $ python benchmarks/bench_api.py --content-types 3 --objects 1000 \\
+        --commits 50 --requests 50 --json out.json
+    $ python benchmarks/bench_api.py --compare out.json ...
+
+Settings for the app, for example ``cache.pull_dir`` or
+``content_store.dir``, can be given with ``--setting key=value`` to
+compare configurations.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from collections import Counter, OrderedDict
+
+from git import Repo
+from webtest import TestApp
+
+from elasticgit.commands.avro import serialize
+from elasticgit.models import IntegerField, Model, TextField
+from elasticgit.storage import StorageManager
+
+from unicore.distribute.api import main as api_main
+from unicore.distribute.storage import store_changes
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AUTHOR = ('Benchmark', 'benchmark@example.org')
+NAMESPACE = 'benchmarks.synthetic'
+
+
+def mk_model_class(index):
+    return type('ContentType%s' % (index,), (Model,), {
+        '__module__': NAMESPACE,
+        'title': TextField('The title'),
+        'body': TextField('The body'),
+        'position': IntegerField('The position'),
+    })
+
+
+def mk_object(sm, model_class, rand, size, object_uuid=None):
+    model = model_class({
+        'uuid': object_uuid or uuid.UUID(int=rand.getrandbits(128)).hex,
+        'title': 'Title %s' % (rand.getrandbits(32),),
+        'body': 'Lorem ipsum dolor sit amet. ' * size,
+        'position': rand.randint(0, 1000),
+    })
+    return sm.git_name(model), sm.serializer.serialize(model)
+
+
+def generate_repository(path, content_types, objects, commits, body_size,
+                        bare=False, seed=0):
+    """
+    Generate a repository with ``objects`` objects for every content
+    type, added over ``commits`` commits. Every commit after the first
+    also updates and deletes some of the objects added before it, so
+    diffs have additions, modifications and deletions.
+
+    :returns: list of commit shas, oldest first
+    """
+    rand = random.Random(seed)
+    repo = Repo.init(path, bare=bare)
+    sm = StorageManager(repo)
+    model_classes = [mk_model_class(i) for i in range(content_types)]
+
+    shas = []
+    schemas = dict(
+        ('_schemas/%s.%s.avsc' % (NAMESPACE, model_class.__name__),
+         serialize(model_class))
+        for model_class in model_classes)
+    shas.append(store_changes(
+        repo, schemas, 'Writing the schemas.', author=AUTHOR).hexsha)
+
+    # path -> model class, for the objects currently in the repository
+    existing = {}
+    for i in range(commits):
+        changes = {}
+        churn = rand.sample(
+            sorted(existing),
+            min(len(existing), max(2, objects // commits // 10)))
+        for repo_path in churn[::2]:
+            object_uuid = os.path.splitext(os.path.basename(repo_path))[0]
+            changes[repo_path] = mk_object(
+                sm, existing[repo_path], rand, body_size, object_uuid)[1]
+        # NOTE: deleted objects are replaced so the counts add up
+        replaced = Counter()
+        for repo_path in churn[1::2]:
+            changes[repo_path] = None
+            replaced[existing.pop(repo_path)] += 1
+        for model_class in model_classes:
+            count = len(range(i, objects, commits)) + replaced[model_class]
+            for _ in range(count):
+                repo_path, data = mk_object(sm, model_class, rand, body_size)
+                changes[repo_path] = data
+                existing[repo_path] = model_class
+        shas.append(store_changes(
+            repo, changes, 'Commit %s.' % (i,), author=AUTHOR).hexsha)
+    return shas
+
+
+def endpoints(name, shas):
+    first, middle = shas[0], shas[len(shas) // 2]
+    content_type = '%s.ContentType0' % (NAMESPACE,)
+    yield 'repo', '/repos/%s.json' % (name,)
+    yield 'content_type', '/repos/%s/%s.json' % (name, content_type)
+    yield 'content_type_page', '/repos/%s/%s.json?limit=50' % (
+        name, content_type)
+    yield 'clone', '/repos/%s/clone.json' % (name,)
+    yield 'pull', '/repos/%s/pull/%s.json' % (name, first)
+    yield 'pull_recent', '/repos/%s/pull/%s.json' % (name, middle)
+    yield 'diff', '/repos/%s/diff/%s.json' % (name, first)
+    yield 'diff_recent', '/repos/%s/diff/%s.json' % (name, middle)
+
+
+def percentile(timings, percent):
+    timings = sorted(timings)
+    index = int(round(percent / 100.0 * (len(timings) - 1)))
+    return timings[index]
+
+
+def time_endpoint(settings, url, requests, warmup):
+    app = TestApp(api_main({}, **settings))
+    size = len(app.get(url).body)
+    for _ in range(warmup):
+        app.get(url)
+    timings = []
+    started = time.time()
+    for _ in range(requests):
+        start = time.time()
+        app.get(url)
+        timings.append(time.time() - start)
+    elapsed = time.time() - started
+    return {
+        'requests': requests,
+        'response_bytes': size,
+        'min_ms': min(timings) * 1000,
+        'mean_ms': sum(timings) / len(timings) * 1000,
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p90_ms': percentile(timings, 90) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+        'max_ms': max(timings) * 1000,
+        'requests_per_second': requests / elapsed,
+    }
+
+
+def run_forked(func, *args):
+    """
+    Call ``func`` in a child process and return its result together
+    with the child's peak resident memory in kilobytes.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        os.close(read_fd)
+        try:
+            result = {'result': func(*args)}
+        except Exception, e:
+            result = {'error': '%s: %s' % (e.__class__.__name__, e)}
+        with os.fdopen(write_fd, 'w') as fp:
+            json.dump(result, fp)
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as fp:
+        output = fp.read()
+    _, _, rusage = os.wait4(pid, 0)
+    result = json.loads(output)
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    result = result['result']
+    result['peak_rss_kb'] = rss_kb(rusage)
+    return result
+
+
+def rss_kb(rusage):
+    # NOTE: ru_maxrss is in kilobytes on Linux, bytes on OS X
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss // 1024
+    return rusage.ru_maxrss
+
+
+def source_version():
+    with open(os.path.join(HERE, '..', 'VERSION')) as fp:
+        version = fp.read().strip()
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return version
+    return '%s (%s)' % (version, commit)
+
+
+def parse_settings(pairs):
+    settings = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        settings[key] = value
+    return settings
+
+
+def print_results(results, previous=None):
+    print '%-18s %9s %9s %9s %9s %9s %10s' % (
+        'endpoint', 'p50 ms', 'p90 ms', 'p99 ms', 'req/s', 'peak MB',
+        'bytes')
+    for name, stats in results['endpoints'].items():
+        line = '%-18s %9.1f %9.1f %9.1f %9.1f %9.1f %10d' % (
+            name, stats['p50_ms'], stats['p90_ms'], stats['p99_ms'],
+            stats['requests_per_second'], stats['peak_rss_kb'] / 1024.0,
+            stats['response_bytes'])
+        old = (previous or {}).get('endpoints', {}).get(name)
+        if old:
+            line += '  p50 %.2fx, peak %.2fx of %s' % (
+                stats['p50_ms'] / old['p50_ms'],
+                float(stats['peak_rss_kb']) / old['peak_rss_kb'],
+                previous['version'])
+        print line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--content-types', type=int, default=3,
+        help='The number of content types in the repository.')
+    parser.add_argument(
+        '--objects', type=int, default=500,
+        help='The number of objects per content type.')
+    parser.add_argument(
+        '--commits', type=int, default=20,
+        help='The number of commits the objects are added over.')
+    parser.add_argument(
+        '--body-size', type=int, default=20,
+        help='The number of sentences in every object\'s body.')
+    parser.add_argument(
+        '--bare', action='store_true',
+        help='Generate a bare repository.')
+    parser.add_argument(
+        '--requests', type=int, default=20,
+        help='The number of timed requests per endpoint.')
+    parser.add_argument(
+        '--warmup', type=int, default=2,
+        help='The number of untimed requests per endpoint.')
+    parser.add_argument(
+        '--endpoint', action='append', dest='endpoints',
+        help='Only time this endpoint, can be given more than once.')
+    parser.add_argument(
+        '--setting', action='append', default=[],
+        help='An app setting as key=value, can be given more than once.')
+    parser.add_argument(
+        '--storage-path',
+        help='Generate the repository here and keep it, '
+             'defaults to a temporary directory.')
+    parser.add_argument(
+        '--json', dest='json_path',
+        help='Write the results to this file.')
+    parser.add_argument(
+        '--compare',
+        help='Compare with the results in this file.')
+    args = parser.parse_args(argv)
+
+    storage_path = args.storage_path or tempfile.mkdtemp()
+    name = 'synthetic-%s-%s-%s' % (
+        args.content_types, args.objects, args.commits)
+    repo_path = os.path.join(storage_path, name)
+    try:
+        if os.path.exists(repo_path):
+            shutil.rmtree(repo_path)
+        start = time.time()
+        shas = generate_repository(
+            repo_path, args.content_types, args.objects, args.commits,
+            args.body_size, bare=args.bare)
+        print 'Generated %s in %.1fs' % (repo_path, time.time() - start)
+
+        settings = {'repo.storage_path': storage_path}
+        settings.update(parse_settings(args.setting))
+        results = {
+            'version': source_version(),
+            'python': sys.version.split()[0],
+            'repository': {
+                'content_types': args.content_types,
+                'objects': args.objects,
+                'commits': len(shas),
+                'body_size': args.body_size,
+                'bare': args.bare,
+            },
+            'settings': settings,
+            # NOTE: what every endpoint's process starts out with
+            'baseline_rss_kb': rss_kb(
+                resource.getrusage(resource.RUSAGE_SELF)),
+            'endpoints': OrderedDict(),
+        }
+        for endpoint, url in endpoints(name, shas):
+            if args.endpoints and endpoint not in args.endpoints:
+                continue
+            results['endpoints'][endpoint] = run_forked(
+                time_endpoint, settings, url, args.requests, args.warmup)
+    finally:
+        if not args.storage_path:
+            shutil.rmtree(storage_path)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as fp:
+            previous = json.load(fp)
+    print_results(results, previous)
+
+    if args.json_path:
+        with open(args.json_path, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
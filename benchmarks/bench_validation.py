@@ -0,0 +1,133 @@
+"""
+Compare validating a PUT payload the way ``validate_schema`` used to,
+with :py:func:`avro.io.validate` and ``schema.to_json()``, with the
+compiled validators in :py:mod:`unicore.distribute.validation`. The
+speedups are relative to ``avro_validate``.
+
+::
+
+    $ python benchmarks/bench_validation.py --number 2000 --json out.json
+"""
+import argparse
+import json
+import sys
+import timeit
+
+import avro.schema
+from avro.io import validate
+
+from elasticgit.commands.avro import serialize
+from elasticgit.tests.base import TestPerson
+
+from unicore.distribute.validation import ValidatorCache
+
+
+ARTICLE_SCHEMA = {
+    'type': 'record',
+    'name': 'Article',
+    'namespace': 'benchmarks',
+    'fields': [
+        {'name': 'uuid', 'type': 'string'},
+        {'name': 'title', 'type': ['null', 'string']},
+        {'name': 'body', 'type': ['null', 'string']},
+        {'name': 'position', 'type': 'int'},
+        {'name': 'featured', 'type': 'boolean'},
+        {'name': 'status', 'type': {
+            'type': 'enum', 'name': 'Status',
+            'symbols': ['draft', 'published', 'archived']}},
+        {'name': 'tags', 'type': {'type': 'array', 'items': 'string'}},
+        {'name': 'meta', 'type': {'type': 'map', 'values': 'string'}},
+        {'name': 'authors', 'type': {'type': 'array', 'items': {
+            'type': 'record', 'name': 'Author',
+            'fields': [
+                {'name': 'name', 'type': 'string'},
+                {'name': 'email', 'type': ['null', 'string']},
+            ]}}},
+    ],
+}
+
+
+def article(size):
+    return {
+        'uuid': 'the-uuid',
+        'title': 'A title',
+        'body': 'A body ' * 100,
+        'position': 1,
+        'featured': True,
+        'status': 'published',
+        'tags': ['tag-%s' % (i,) for i in range(size)],
+        'meta': dict(('key-%s' % (i,), 'value') for i in range(size)),
+        'authors': [{'name': 'Author %s' % (i,), 'email': None}
+                    for i in range(size)],
+    }
+
+
+def cases():
+    person_source = serialize(TestPerson)
+    person = json.loads(json.dumps(dict(TestPerson({'name': 'Foo'}))))
+    yield 'person', person_source, person
+    article_source = json.dumps(ARTICLE_SCHEMA)
+    for size in (10, 100):
+        yield 'article-%s' % (size,), article_source, article(size)
+
+
+def run_case(source, datum, number):
+    cache = ValidatorCache()
+    parsed = avro.schema.parse(source)
+    compiled = cache.get(source)
+
+    def avro_parse_validate():
+        # NOTE: without the schema registry's cached parsed schemas
+        schema = avro.schema.parse(source)
+        validate(schema, datum)
+        schema.to_json()
+
+    def avro_validate():
+        # NOTE: what validate_schema did before compiled validators
+        validate(parsed, datum)
+        parsed.to_json()
+
+    def compiled_lookup():
+        # NOTE: the first request for a content type after HEAD moved
+        cache.get(source).errors(datum)
+
+    def compiled_errors():
+        # NOTE: later requests, the schema set holds on to the validator
+        compiled.errors(datum)
+
+    def compiled_is_valid():
+        compiled.is_valid(datum)
+
+    timings = {}
+    for func in (avro_parse_validate, avro_validate, compiled_lookup,
+                 compiled_errors, compiled_is_valid):
+        seconds = min(timeit.repeat(func, repeat=3, number=number))
+        timings[func.__name__] = seconds / number * 1e6
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--number', type=int, default=1000,
+        help='The number of validations to time per case.')
+    parser.add_argument(
+        '--json', dest='json_path',
+        help='Write the results, in microseconds per call, to this file.')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, source, datum in cases():
+        results[name] = timings = run_case(source, datum, args.number)
+        print '%s (microseconds per call)' % (name,)
+        for func_name, micros in sorted(timings.items()):
+            print '    %-20s %10.1f %6.1fx' % (
+                func_name, micros, timings['avro_validate'] / micros)
+
+    if args.json_path:
+        with open(args.json_path, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
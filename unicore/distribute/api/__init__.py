@@ -3,6 +3,9 @@ import os
 from pyramid.config import Configurator
 
 from unicore.distribute.api import proxy
+from unicore.distribute.pool import get_repository_pool
+from unicore.distribute.proxycache import get_proxy_cache
+from unicore.distribute.utils import is_indexing_enabled
 
 
 def main(global_config, **settings):
@@ -17,6 +20,8 @@ def includeme(config):
     config.scan('.repos')
 
     settings = config.registry.settings
+    get_repository_pool(config.registry)
+
     proxy_enabled = os.environ.get('PROXY_ENABLED') or settings.get(
         'proxy.enabled', 'false').lower()
     proxy_path = os.environ.get('PROXY_PATH') or settings.get(
@@ -26,11 +31,18 @@ def includeme(config):
 
     if proxy_enabled == 'true':  # pragma: no cover
         config.add_route('esapi', os.path.join('/', proxy_path, '{parts:.*}'))
-        config.add_view(proxy.Proxy(proxy_upstream), route_name='esapi')
+        config.add_view(proxy.Proxy(
+            proxy_upstream,
+            session=proxy.mk_session(
+                pool_size=int(settings.get('proxy.pool_size', 10)),
+                pool_block=settings.get(
+                    'proxy.pool_block', 'false').lower() == 'true'),
+            timeout=(float(settings.get('proxy.connect_timeout', 5)),
+                     float(settings.get('proxy.read_timeout', 30))),
+            cache=get_proxy_cache(settings)),
+            route_name='esapi')
 
-    indexing_enabled = os.environ.get('INDEXING_ENABLED') or settings.get(
-        'es.indexing_enabled', 'false').lower()
-    if indexing_enabled == 'true':
+    if is_indexing_enabled(settings):
         config.add_subscriber(
             'unicore.distribute.api.repos.initialize_repo_index',
             'unicore.distribute.events.RepositoryCloned')
@@ -40,3 +52,33 @@ def includeme(config):
         config.add_subscriber(
             'unicore.distribute.api.repos.index_content_type_object',
             'unicore.distribute.events.ContentTypeObjectUpdated')
+
+    for event_class in ('RepositoryCloned',
+                        'RepositoryUpdated',
+                        'ContentTypeObjectUpdated'):
+        config.add_subscriber(
+            'unicore.distribute.catalog.update_repository_catalog',
+            'unicore.distribute.events.%s' % (event_class,))
+
+    if get_proxy_cache(settings) is not None:
+        for event_class in ('RepositoryCloned',
+                            'RepositoryUpdated',
+                            'ContentTypeObjectUpdated'):
+            config.add_subscriber(
+                'unicore.distribute.proxycache.invalidate_proxy_cache',
+                'unicore.distribute.events.%s' % (event_class,))
+
+    if settings.get('cache.pull_dir'):
+        # NOTE: only for publishes and pulls, not for every write
+        for event_class in ('RepositoryCloned', 'RepositoryUpdated'):
+            config.add_subscriber(
+                'unicore.distribute.api.repo_status.prewarm_repo_pull_cache',
+                'unicore.distribute.events.%s' % (event_class,))
+
+    if settings.get('content_store.dir'):
+        for event_class in ('RepositoryCloned',
+                            'RepositoryUpdated',
+                            'ContentTypeObjectUpdated'):
+            config.add_subscriber(
+                'unicore.distribute.contentstore.sync_content_store',
+                'unicore.distribute.events.%s' % (event_class,))
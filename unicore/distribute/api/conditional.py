@@ -0,0 +1,101 @@
+import hashlib
+from datetime import datetime
+
+from pyramid.httpexceptions import HTTPNotModified
+
+from webob.datetime_utils import serialize_date, UTC
+from webob.etag import ETagMatcher
+
+from unicore.distribute.schemas import get_head_sha
+from unicore.distribute.utils import get_config
+
+
+def make_etag(sha, *parts):
+    """
+    Return a strong ETag for a response that is fully determined by the
+    commit ``sha`` and any other ``parts`` (content type, uuid, query
+    parameters, ...) that went into generating it.
+
+    :param str sha:
+        The commit's hexsha.
+    :param parts:
+        Anything else identifying the response.
+    :returns: str
+    """
+    if not parts:
+        return sha
+    return '%s-%s' % (
+        sha, hashlib.sha1(
+            u'\0'.join(map(unicode, parts)).encode('utf-8')).hexdigest())
+
+
+def etag_matches(request, etag):
+    """
+    Return ``True`` if the request's ``If-None-Match`` header matches
+    ``etag``. Weak ETags never match, ours are all strong.
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag in ETagMatcher.parse(if_none_match, strong=True)
+
+
+def conditional_headers(request, repo, *parts, **kwargs):
+    """
+    Return the caching headers for a response generated from the HEAD
+    commit of ``repo``.
+
+    If the client already has the current version of the response
+    according to ``If-None-Match`` then
+    :py:class:`pyramid.httpexceptions.HTTPNotModified` is raised. The
+    check only reads the repository's refs so a matching request costs
+    no git object or schema lookups.
+
+    ``Last-Modified`` is informational only. Commit dates have a one
+    second resolution and HEAD can move to an older commit, so
+    ``If-Modified-Since`` on its own never results in a 304.
+
+    :param Request request:
+        The HTTP request
+    :param Repo repo:
+        The git repository.
+    :param parts:
+        Anything besides the commit identifying the response.
+    :param str vary:
+        The ``Vary`` header, for responses that are negotiated. It is
+        sent with a 304 too so shared caches pick the right
+        representation.
+    :returns: dict
+    """
+    config = get_config(request)
+    max_age = int(config.get('http.cache_max_age', 0))
+    headers = {}
+    if kwargs.get('vary'):
+        headers['Vary'] = kwargs['vary']
+    sha = get_head_sha(repo)
+    if sha is None:
+        return headers
+
+    etag = make_etag(sha, *parts)
+    headers.update({
+        'ETag': '"%s"' % (etag,),
+        'Cache-Control': 'public, max-age=%d' % (max_age,),
+    })
+    if etag_matches(request, etag):
+        raise HTTPNotModified(headers=headers)
+
+    last_modified = datetime.fromtimestamp(
+        repo.commit(sha).committed_date, UTC)
+    headers['Last-Modified'] = serialize_date(last_modified)
+    return headers
+
+
+def set_conditional_headers(request, repo, *parts, **kwargs):
+    """
+    Like :py:func:`conditional_headers` but sets the headers on
+    ``request.response``.
+    """
+    request.response.headers.update(
+        conditional_headers(request, repo, *parts, **kwargs))
@@ -1,44 +1,207 @@
+import itertools
+
 from urlparse import urljoin
 
 from pyramid.response import Response
-from pyramid.httpexceptions import HTTPNotFound
+from pyramid.httpexceptions import (
+    HTTPNotFound, HTTPBadGateway, HTTPGatewayTimeout)
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from unicore.distribute.proxycache import (
+    cache_key, is_cacheable, request_indexes)
+
+
+# https://tools.ietf.org/html/rfc2616#section-13.5.1
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'te',
+    'trailers',
+    'transfer-encoding',
+    'upgrade',
+])
+
+# NOTE: requests computes these itself for the upstream request
+REQUEST_EXCLUDED_HEADERS = HOP_BY_HOP_HEADERS | frozenset([
+    'host',
+    'content-length',
+])
+
+CHUNK_SIZE = 16 * 1024
+
+
+def mk_session(pool_size=10, pool_block=False):
+    """
+    Return a :py:class:`requests.Session` that keeps up to
+    ``pool_size`` connections per upstream host alive between
+    requests.
+
+    :param int pool_size:
+        The maximum number of connections to keep open per host.
+    :param bool pool_block:
+        Whether to wait for a free connection rather than opening an
+        extra one, that is then thrown away, when the pool is in use.
+    :returns: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_size, pool_block=pool_block)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 class Proxy(object):
-
-    def __init__(self, upstream_url):
+    """
+    A view that proxies requests to Elasticsearch. All requests share
+    one connection pool.
+
+    :param str upstream_url:
+        The URL to proxy to.
+    :param requests.Session session:
+        The session to send requests with, one is created with
+        :py:func:`mk_session` if not given.
+    :param tuple timeout:
+        The connect and read timeouts in seconds.
+    :param unicore.distribute.proxycache.ProxyCache cache:
+        The cache for responses to searches, if any.
+    """
+
+    def __init__(self, upstream_url, session=None, timeout=(5, 30),
+                 cache=None):
         self.upstream_url = upstream_url
+        self.session = session if session is not None else mk_session()
+        self.timeout = timeout
+        self.cache = cache
 
     def __call__(self, request):
-        view = ProxyView(request, self.upstream_url)
+        view = ProxyView(
+            request, self.upstream_url, session=self.session,
+            timeout=self.timeout, cache=self.cache)
         handler = getattr(view, 'do_%s' % (request.method,), HTTPNotFound)
         return handler()
 
 
 class ProxyView(object):
 
-    def __init__(self, request, upstream_url):
+    def __init__(self, request, upstream_url, session=None, timeout=None,
+                 cache=None):
         self.request = request
         self.upstream_url = upstream_url
+        self.session = session
+        self.timeout = timeout
+        self.cache = cache
 
     def url(self):
-        return urljoin(self.upstream_url, self.request.matchdict['parts'])
+        url = urljoin(self.upstream_url, self.request.matchdict['parts'])
+        query_string = self.request.query_string
+        if query_string:
+            return '%s?%s' % (url, query_string)
+        return url
+
+    def request_headers(self):
+        headers = dict(
+            (name, value) for name, value in self.request.headers.items()
+            if name.lower() not in REQUEST_EXCLUDED_HEADERS)
+        # NOTE: the body is passed through as is, so only ask for a
+        #       compressed one if the client did.
+        if 'accept-encoding' not in (name.lower() for name in headers):
+            headers['Accept-Encoding'] = 'identity'
+        return headers
 
     def mk_request(self, *args, **kwargs):  # for mocking
-        return requests.request(*args, **kwargs)
+        kwargs.setdefault('headers', self.request_headers())
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('stream', True)
+        return (self.session or requests).request(*args, **kwargs)
+
+    def iter_body(self, response):
+        try:
+            if response.raw is None:
+                # NOTE: the body has already been read
+                yield response.content
+                return
+            for chunk in response.raw.stream(
+                    CHUNK_SIZE, decode_content=False):
+                yield chunk
+        finally:
+            # NOTE: returns the connection to the pool
+            response.close()
+
+    def response_headers(self, response):
+        return [(name, value) for name, value in response.headers.items()
+                if name.lower() not in HOP_BY_HOP_HEADERS]
 
     def mk_response(self, response):
-        return Response(body=response.text, status=response.status_code,
-                        headerlist=response.headers.items(),
-                        content_type=response.headers['Content-Type'],
-                        charset=response.encoding)
+        return Response(status=response.status_code,
+                        headerlist=self.response_headers(response),
+                        app_iter=self.iter_body(response))
+
+    def mk_cached_response(self, cached):
+        headerlist = cached.headerlist + [('X-Cache', 'HIT')]
+        return Response(status=cached.status, headerlist=headerlist,
+                        body=cached.body)
+
+    def mk_caching_response(self, response, key, indexes, started_at):
+        headerlist = self.response_headers(response)
+        body = self.iter_body(response)
+        chunks = []
+        size = 0
+        for chunk in body:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > self.cache.max_entry_size:
+                # NOTE: too big to cache, stream the rest through
+                return Response(status=response.status_code,
+                                headerlist=headerlist + [('X-Cache', 'MISS')],
+                                app_iter=itertools.chain(chunks, body))
+        self.cache.put(key, indexes, started_at, response.status_code,
+                       headerlist, ''.join(chunks))
+        return Response(status=response.status_code,
+                        headerlist=headerlist + [('X-Cache', 'MISS')],
+                        body=''.join(chunks))
+
+    def cache_lookup(self):
+        """
+        Return the cache key and indexes of a cacheable request and the
+        cached response if there is one.
+
+        :returns: tuple
+        """
+        parts = self.request.matchdict['parts']
+        if self.cache is None or not is_cacheable(
+                self.request.method, parts, self.request.query_string):
+            return None, None, None
+        key = cache_key(
+            parts, self.request.query_string, self.request.body,
+            self.request.headers.get('Accept-Encoding'))
+        indexes = request_indexes(parts)
+        if 'no-cache' in self.request.headers.get('Cache-Control', ''):
+            return key, indexes, None
+        return key, indexes, self.cache.get(key)
 
     def do_request(self):
-        return self.mk_response(
-            self.mk_request(
-                self.request.method, self.url(), data=self.request.body))
+        key, indexes, cached = self.cache_lookup()
+        if cached is not None:
+            return self.mk_cached_response(cached)
+        started_at = self.cache.clock() if key is not None else None
+
+        try:
+            response = self.mk_request(
+                self.request.method, self.url(), data=self.request.body)
+        except requests.exceptions.Timeout:
+            return HTTPGatewayTimeout()
+        except requests.exceptions.ConnectionError:
+            return HTTPBadGateway()
+
+        if key is not None and response.status_code == 200:
+            return self.mk_caching_response(
+                response, key, indexes, started_at)
+        return self.mk_response(response)
 
     def do_POST(self):
         return self.do_request()
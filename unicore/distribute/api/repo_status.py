@@ -1,8 +1,80 @@
 import os
+
 from cornice.resource import resource, view
+
+from pyramid.exceptions import NotFound
+from pyramid.response import Response
+
+from unicore.distribute.api.conditional import (
+    conditional_headers, set_conditional_headers)
+from unicore.distribute.catalog import get_repository_catalog
+from unicore.distribute.indexing import readiness_stats
+from unicore.distribute.events import ContentTypeObjectsUpdated
+from unicore.distribute.jobs import JobManager, get_job_manager
+from unicore.distribute.pool import get_repository_pool
+from unicore.distribute.proxycache import get_proxy_cache
+from unicore.distribute.pullcache import (
+    get_pull_cache, cached_repository_diff, cached_pull_repository_files,
+    prewarm_pull_cache)
+from unicore.distribute.schemas import get_head_sha, schema_registry
+from unicore.distribute.singleflight import request_coalescer
 from unicore.distribute.utils import (
-    get_config, format_repo_status, get_repository, get_repository_diff,
-    pull_repository_files, clone_repository)
+    get_commit, get_config, format_repo_status,
+    get_repository_diff, pull_repository_files, clone_repository,
+    iterate_repository_objects, stream_ndjson, stream_gzip)
+from unicore.distribute.validation import validator_cache
+from unicore.distribute.writes import get_write_queues
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+@resource(path='/status.json')
+class ServiceStatusResource(object):
+    def __init__(self, request):
+        self.request = request
+        self.config = get_config(request)
+
+    @view(renderer='json')
+    def get(self):
+        status = {
+            'repository_pool': get_repository_pool(
+                self.request.registry).stats(),
+            'schema_registry': schema_registry.stats(),
+            'schema_validators': validator_cache.stats(),
+            'jobs': get_job_manager(self.request.registry).stats(),
+            'index_readiness': readiness_stats.stats(),
+            'request_coalescing': request_coalescer.stats(),
+            'repository_catalog': get_repository_catalog(
+                self.request.registry).stats(),
+            'write_queue': get_write_queues(self.request.registry).stats(),
+        }
+        pull_cache = get_pull_cache(self.config)
+        if pull_cache is not None:
+            status['pull_cache'] = pull_cache.stats()
+            status['pull_cache_prewarm'] = prewarm_jobs.stats()
+        proxy_cache = get_proxy_cache(self.config)
+        if proxy_cache is not None:
+            status['proxy_cache'] = proxy_cache.stats()
+        return status
+
+
+@resource(path='/jobs/{id}.json')
+class JobResource(object):
+    def __init__(self, request):
+        self.request = request
+        self.config = get_config(request)
+
+    @view(renderer='json')
+    def get(self):
+        job = get_job_manager(self.request.registry).get(
+            self.request.matchdict['id'])
+        if job is None:
+            raise NotFound('Job not found.')
+        job_json = job.to_dict()
+        if 'name' in job_json['result']:
+            job_json['result']['url'] = self.request.route_url(
+                'repositoryresource', name=job_json['result']['name'])
+        return job_json
 
 
 @resource(path='/repos/{name}/status.json')
@@ -10,13 +82,14 @@ class RepositoryStatusResource(object):
     def __init__(self, request):
         self.request = request
         self.config = get_config(request)
+        self.pool = get_repository_pool(request.registry)
 
     @view(renderer='json')
     def get(self):
         name = self.request.matchdict['name']
-        storage_path = self.config.get('repo.storage_path')
-        return format_repo_status(get_repository(
-            os.path.join(storage_path, name)))
+        with self.pool.repository(name) as repo:
+            set_conditional_headers(self.request, repo, 'status')
+            return format_repo_status(repo)
 
 
 @resource(path='/repos/{name}/diff/{commit_id}.json')
@@ -24,14 +97,22 @@ class RepositoryDiffResource(object):
     def __init__(self, request):
         self.request = request
         self.config = get_config(request)
+        self.pool = get_repository_pool(request.registry)
 
     @view(renderer='json')
     def get(self):
         name = self.request.matchdict['name']
         commit_id = self.request.matchdict['commit_id']
-        storage_path = self.config.get('repo.storage_path')
-        return get_repository_diff(get_repository(
-            os.path.join(storage_path, name)), commit_id)
+        cache = get_pull_cache(self.config)
+        with self.pool.repository(name) as repo:
+            set_conditional_headers(self.request, repo, 'diff', commit_id)
+            key = (name, get_head_sha(repo), commit_id)
+            if cache is None:
+                return request_coalescer.do(
+                    'diff', key, get_repository_diff, repo, commit_id)
+            return request_coalescer.do(
+                'diff', key, cached_repository_diff, cache, name, repo,
+                commit_id)
 
 
 @resource(path='/repos/{name}/pull/{commit_id}.json')
@@ -39,14 +120,24 @@ class RepositoryPullResource(object):
     def __init__(self, request):
         self.request = request
         self.config = get_config(request)
+        self.pool = get_repository_pool(request.registry)
 
     @view(renderer='json')
     def get(self):
         name = self.request.matchdict['name']
         commit_id = self.request.matchdict['commit_id']
-        storage_path = self.config.get('repo.storage_path')
-        return pull_repository_files(get_repository(
-            os.path.join(storage_path, name)), commit_id)
+        cache = get_pull_cache(self.config)
+        with self.pool.repository(name) as repo:
+            set_conditional_headers(self.request, repo, 'pull', commit_id)
+            # NOTE: concurrent requests for the same commits share one
+            #       computation, see request_coalescing in /status.json
+            key = (name, get_head_sha(repo), commit_id)
+            if cache is None:
+                return request_coalescer.do(
+                    'pull', key, pull_repository_files, repo, commit_id)
+            return request_coalescer.do(
+                'pull', key, cached_pull_repository_files, cache, name,
+                repo, commit_id)
 
 
 @resource(path='/repos/{name}/clone.json')
@@ -54,10 +145,86 @@ class RepositoryCloneResource(object):
     def __init__(self, request):
         self.request = request
         self.config = get_config(request)
+        self.pool = get_repository_pool(request.registry)
 
     @view(renderer='json')
     def get(self):
         name = self.request.matchdict['name']
-        storage_path = self.config.get('repo.storage_path')
-        return clone_repository(
-            get_repository(os.path.join(storage_path, name)))
+        if (self.request.GET.get('format') == 'ndjson' or
+                NDJSON_CONTENT_TYPE in self.request.headers.get('Accept', '')):
+            return self.get_ndjson(name)
+
+        commit_id = self.request.GET.get('commit')
+        with self.pool.repository(name) as repo:
+            # NOTE: like diffs and pulls the ETag is made from HEAD and
+            #       the requested commit as given, the commit is only
+            #       looked up if the client does not have the response.
+            set_conditional_headers(
+                self.request, repo, 'clone', commit_id or 'HEAD',
+                vary='Accept')
+            commit_id = get_commit(repo, commit_id).hexsha
+            return request_coalescer.do(
+                'clone', (name, commit_id), clone_repository, repo,
+                commit_id)
+
+    def get_ndjson(self, name):
+        # NOTE: without an Accept-Encoding header webob considers any
+        #       encoding acceptable, only gzip when asked for.
+        gzipped = (
+            'Accept-Encoding' in self.request.headers and
+            self.request.accept_encoding.best_match(
+                ['gzip', 'identity']) == 'gzip')
+        commit = self.request.GET.get('commit')
+        with self.pool.repository(name) as repo:
+            cache_headers = conditional_headers(
+                self.request, repo, 'clone', 'ndjson',
+                'gzip' if gzipped else 'identity', commit or 'HEAD',
+                vary='Accept, Accept-Encoding')
+            commit = str(get_commit(repo, commit).hexsha)
+
+        def app_iter():
+            # NOTE: the repository is checked out again for as long as
+            #       the WSGI server is consuming the response.
+            with self.pool.repository(name) as repo:
+                for chunk in stream_ndjson(
+                        iterate_repository_objects(repo, commit)):
+                    yield chunk
+
+        response = Response(
+            content_type=NDJSON_CONTENT_TYPE, charset='utf-8')
+        response.headers.update(cache_headers)
+        response.headers['X-Commit'] = commit
+        if gzipped:
+            response.content_encoding = 'gzip'
+            response.app_iter = stream_gzip(app_iter())
+        else:
+            response.app_iter = app_iter()
+        return response
+
+
+# NOTE: prewarming runs on a worker of its own so that it neither holds
+#       up the request that published or pulled the changes nor competes
+#       with clone jobs.
+prewarm_jobs = JobManager(workers=1)
+
+
+def prewarm_repo_pull_cache(event):
+    cache = get_pull_cache(event.config)
+    if cache is None:
+        return
+    if isinstance(event, ContentTypeObjectsUpdated):
+        # NOTE: every write moves HEAD, payloads computed for it would be
+        #       replaced by the next write before anyone asks for them.
+        return
+    prewarm_jobs.submit(
+        'prewarm', prewarm_repo_pull_cache_job, cache,
+        get_repository_pool(event.registry),
+        os.path.basename(event.repo.working_dir),
+        int(event.config.get('cache.pull_prewarm', 10)))
+
+
+def prewarm_repo_pull_cache_job(job, cache, pool, name, count):
+    # NOTE: the event's repository may be back in the pool and in use by
+    #       another request by now, check out a handle of our own.
+    with pool.repository(name) as repo:
+        prewarm_pull_cache(cache, name, repo, count)
@@ -1,27 +1,47 @@
 import os
+from urllib import urlencode
 from urlparse import urlparse
 
 from cornice.resource import resource, view
 
+from pyramid.response import Response
+
 from git.exc import GitCommandError
 
-from elasticsearch import ElasticsearchException
-from elasticgit import EG
 from elasticgit.workspace import Workspace
 from elasticgit.storage import StorageManager
 from elasticgit.search import ESManager
 
+from unicore.distribute.api.conditional import (
+    conditional_headers, set_conditional_headers)
 from unicore.distribute.api.validators import (
-    validate_schema, CreateRepoColanderSchema)
+    validate_schema, validate_pagination, validate_batch,
+    CreateRepoColanderSchema,
+    DEFAULT_PAGINATION)
+from unicore.distribute.catalog import get_repository_catalog
+from unicore.distribute.contentstore import (
+    get_content_store, refresh_content_store)
 from unicore.distribute.events import (
-    RepositoryCloned, RepositoryUpdated, ContentTypeObjectUpdated)
+    RepositoryCloned, RepositoryUpdated, ContentTypeObjectUpdated,
+    ContentTypeObjectsUpdated)
+from unicore.distribute.indexing import (
+    advance_indexed_sha_for_paths, build_index, load_model_mappings,
+    reindex_repository, update_index)
+from unicore.distribute.jobs import get_job_manager
+from unicore.distribute.pool import get_repository_pool
+from unicore.distribute.storage import (
+    clone_repo, commit_diff, get_storage_manager)
+from unicore.distribute.writes import get_write_queues
 from unicore.webhooks.events import WebhookEvent
 from unicore.distribute.utils import (
-    get_config, get_repositories, get_repository, format_repo,
-    format_content_type, format_content_type_object,
+    get_config, format_repo,
+    format_content_type_object, get_commit, list_content_type_uuids,
+    paginate_uuids,
+    iterate_content_type, stream_json_list, stream_encoded_json_list,
     save_content_type_object, delete_content_type_object,
-    format_diffindex, get_index_prefix, load_model_class,
-    get_es, get_es_settings, get_mapping, list_content_types,
+    apply_content_type_operations,
+    format_diffindex, get_index_prefix,
+    get_es, get_es_settings, is_indexing_enabled,
     get_repository_names)
 
 
@@ -31,14 +51,45 @@ class RepositoryResource(object):
     def __init__(self, request):
         self.request = request
         self.config = get_config(request)
+        self.pool = get_repository_pool(request.registry)
 
+    @view(validators=validate_pagination)
     def collection_get(self):
         storage_path = self.config.get('repo.storage_path')
-        if self.request.GET.get('name_only'):
-            return [
-                {'name': repo_path}
-                for repo_path in get_repository_names(storage_path)]
-        return [format_repo(repo) for repo in get_repositories(storage_path)]
+        pagination = getattr(
+            self.request, 'pagination', DEFAULT_PAGINATION)
+        prefix = self.request.GET.get('prefix')
+        content_type = self.request.GET.get('schema')
+        name_only = self.request.GET.get('name_only')
+        if name_only and not content_type:
+            # NOTE: names only need a directory listing, this also lists
+            #       repositories without commits.
+            repos = [
+                {'name': repo_name}
+                for repo_name in sorted(get_repository_names(storage_path))
+                if not prefix or repo_name.startswith(prefix)]
+        else:
+            repos = get_repository_catalog(self.request.registry).list(
+                prefix=prefix, content_type=content_type)
+            if name_only:
+                repos = [{'name': repo['name']} for repo in repos]
+
+        all_names = [repo['name'] for repo in repos]
+        names = paginate_uuids(
+            all_names, offset=pagination['offset'],
+            after=pagination['after'], limit=pagination['limit'])
+        self.request.response.headers['X-Total-Count'] = str(len(all_names))
+        if (pagination['limit'] is not None and names and
+                names[-1] != all_names[-1]):
+            query = [('after', names[-1]), ('limit', pagination['limit'])]
+            query.extend(
+                (key, self.request.GET[key])
+                for key in ('prefix', 'schema', 'name_only')
+                if key in self.request.GET)
+            self.request.response.headers['Link'] = '<%s?%s>; rel="next"' % (
+                self.request.path_url, urlencode(query))
+        page = set(names)
+        return [repo for repo in repos if repo['name'] in page]
 
     @view(schema=CreateRepoColanderSchema)
     def collection_post(self):
@@ -50,9 +101,20 @@ class RepositoryResource(object):
             repo_name_dot_git = os.path.basename(repo_url_info.path)
             repo_name = repo_name_dot_git.partition('.git')[0]
 
+        if self.config.get('repo.async_clone', 'false').lower() == 'true':
+            job = get_job_manager(self.request.registry).submit(
+                'clone', clone_repository_job, self.request.registry,
+                self.config, repo_url, storage_path, repo_name)
+            self.request.response.headers['Location'] = self.request.route_url(
+                'jobresource', id=job.id)
+            self.request.response.status = 202
+            return job.to_dict()
+
         try:
-            repo = EG.clone_repo(
-                repo_url, os.path.join(storage_path, repo_name))
+            repo = clone_repo(
+                repo_url, os.path.join(storage_path, repo_name),
+                bare=self.config.get('repo.bare', 'false').lower() == 'true')
+            self.pool.invalidate(repo_name)
             self.request.registry.notify(
                 RepositoryCloned(
                     config=self.config,
@@ -69,26 +131,29 @@ class RepositoryResource(object):
     @view(renderer='json')
     def get(self):
         name = self.request.matchdict['name']
-        storage_path = self.config.get('repo.storage_path')
-        return format_repo(get_repository(os.path.join(storage_path, name)))
+        with self.pool.repository(name) as repo:
+            set_conditional_headers(self.request, repo)
+            return format_repo(repo)
 
     @view(renderer='json')
     def post(self):
         name = self.request.matchdict['name']
         branch_name = self.request.params.get('branch', 'master')
         remote_name = self.request.params.get('remote')
-        storage_path = self.config.get('repo.storage_path')
-        repo = get_repository(os.path.join(storage_path, name))
-        storage_manager = StorageManager(repo)
-        changes = storage_manager.pull(branch_name=branch_name,
-                                       remote_name=remote_name)
-        # Fire events
-        self.request.registry.notify(
-            RepositoryUpdated(
-                config=self.config,
-                repo=repo,
-                changes=changes,
-                branch=branch_name))
+        write_queue = get_write_queues(self.request.registry).get(name)
+        with self.pool.repository(name) as repo:
+            storage_manager = get_storage_manager(repo)
+            with write_queue.exclusive():
+                changes = storage_manager.pull(branch_name=branch_name,
+                                               remote_name=remote_name)
+            self.pool.invalidate(name)
+            # Fire events
+            self.request.registry.notify(
+                RepositoryUpdated(
+                    config=self.config,
+                    repo=repo,
+                    changes=changes,
+                    branch=branch_name))
         self.request.registry.notify(
             WebhookEvent(
                 owner=self.request.authenticated_userid,
@@ -102,24 +167,73 @@ class RepositoryResource(object):
 
     def delete(self):
         name = self.request.matchdict['name']
-        storage_path = self.config.get('repo.storage_path')
-        repo = get_repository(os.path.join(storage_path, name))
-        workspace = Workspace(
-            repo=repo,
-            es=get_es_settings(self.config),
-            index_prefix=get_index_prefix(repo.working_dir))
-        # NOTE: destroys both the repo and index, if it exists,
-        # irrespective of es.indexing_enabled value.
-        workspace.destroy()
+        with self.pool.repository(name) as repo:
+            self.pool.invalidate(name)
+            workspace = Workspace(
+                repo=repo,
+                es=get_es_settings(self.config),
+                index_prefix=get_index_prefix(repo.working_dir))
+            # NOTE: destroys both the repo and index, if it exists,
+            # irrespective of es.indexing_enabled value.
+            workspace.destroy()
+        store = get_content_store(self.config, name)
+        if store is not None:
+            store.destroy()
+        get_repository_catalog(self.request.registry).remove(name)
         self.request.response.status = 204
 
 
+def clone_repository_job(job, registry, config, repo_url, storage_path,
+                         repo_name):
+    """
+    Clone a repository and fire :py:class:`RepositoryCloned` for it,
+    run in the background by :py:class:`unicore.distribute.jobs.JobManager`.
+
+    :param Job job:
+        The job to report progress to.
+    :param pyramid.registry.Registry registry:
+        The application registry.
+    :param dict config:
+        The app configuration.
+    :param str repo_url:
+        The URL of the repository to clone.
+    :param str storage_path:
+        The directory the repositories live in.
+    :param str repo_name:
+        The name to clone the repository as.
+    :returns: dict
+    """
+    job.set_phase('cloning')
+    repo = clone_repo(
+        repo_url, os.path.join(storage_path, repo_name),
+        bare=config.get('repo.bare', 'false').lower() == 'true')
+    get_repository_pool(registry).invalidate(repo_name)
+    if is_indexing_enabled(config):
+        job.set_phase('indexing')
+    event = RepositoryCloned(
+        config=config,
+        repo=repo,
+        registry=registry,
+        progress=job.progress)
+    registry.notify(event)
+    result = {'name': repo_name}
+    # NOTE: set by initialize_repo_index when indexing is enabled
+    if getattr(event, 'index_stats', None) is not None:
+        result['index'] = event.index_stats
+    return result
+
+
 def initialize_repo_index(event):
     repo = event.repo
+    progress = getattr(event, 'progress', None)
+    mode = event.config.get('es.reindex_mode', 'replace').lower()
+    if mode == 'alias':
+        event.index_stats = reindex_repository(
+            repo, event.config, progress=progress)
+        return
+
     # load models and mappings before creating index in case of errors
-    model_mappings = [(load_model_class(repo, content_type),
-                       get_mapping(repo, content_type))
-                      for content_type in list_content_types(repo)]
+    model_mappings, total = load_model_mappings(repo)
     sm = StorageManager(repo)
     im = ESManager(
         storage_manager=sm,
@@ -128,34 +242,52 @@ def initialize_repo_index(event):
 
     if im.index_exists(sm.active_branch()):
         im.destroy_index(sm.active_branch())
-    im.create_index(sm.active_branch())
-    while not im.index_ready(sm.active_branch()):
-        pass
-
-    try:
-        for model_class, mapping in model_mappings:
-            im.setup_custom_mapping(
-                sm.active_branch(), model_class, mapping)
-
-        for model_class, _ in model_mappings:
-            for model in sm.iterate(model_class):
-                im.index(model)
-    except ElasticsearchException:
-        im.destroy_index(sm.active_branch())
-        raise
+    event.index_stats = build_index(
+        im, sm.active_branch(), model_mappings, total, event.config,
+        progress=progress)
 
 
 def update_repo_index(event):
-    repo = event.repo
-    workspace = Workspace(
-        repo=repo,
-        es=get_es_settings(event.config),
-        index_prefix=get_index_prefix(repo.working_dir))
+    update_index(
+        event.repo, event.config, event.branch, changes=event.changes)
 
-    old_branch = repo.head.ref
-    repo.heads[event.branch].checkout()
-    workspace.index_diff(event.changes)
-    old_branch.checkout()
+
+# NOTE: venusian registers the resources of a module in alphabetical
+#       order, this route has to be added before ContentTypeResource's
+#       collection route, which would otherwise match it.
+@resource(path='/repos/{name}/batch.json')
+class BatchResource(object):
+
+    def __init__(self, request):
+        self.request = request
+        self.config = get_config(request)
+        self.pool = get_repository_pool(request.registry)
+
+    @view(renderer='json', validators=validate_batch)
+    def post(self):
+        name = self.request.matchdict['name']
+        write_queue = get_write_queues(self.request.registry).get(name)
+        with self.pool.repository(name) as repo:
+            commit, models = apply_content_type_operations(
+                repo, self.request.batch['operations'],
+                self.request.batch['message'], write_queue=write_queue)
+            # Fire a single event for the whole batch
+            self.request.registry.notify(ContentTypeObjectsUpdated(
+                config=self.config,
+                repo=repo,
+                models=models,
+                changes=commit_diff(commit),
+                branch=repo.active_branch.name))
+        return {
+            'commit': commit.hexsha,
+            'objects': [{
+                'action': action,
+                'content_type': '%s.%s' % (
+                    model.__module__, model.__class__.__name__),
+                'uuid': model.uuid,
+                'data': dict(model),
+            } for action, model in models],
+        }
 
 
 @resource(collection_path='/repos/{name}/{content_type}.json',
@@ -165,29 +297,94 @@ class ContentTypeResource(object):
     def __init__(self, request):
         self.request = request
         self.config = get_config(request)
+        self.pool = get_repository_pool(request.registry)
 
+    @view(validators=validate_pagination)
     def collection_get(self):
         name = self.request.matchdict['name']
         content_type = self.request.matchdict['content_type']
-        storage_path = self.config.get('repo.storage_path')
-        return format_content_type(
-            get_repository(os.path.join(storage_path, name)),
-            content_type)
+        pagination = getattr(
+            self.request, 'pagination', DEFAULT_PAGINATION)
+        store = get_content_store(self.config, name)
+        with self.pool.repository(name) as repo:
+            cache_headers = conditional_headers(
+                self.request, repo, content_type,
+                urlencode(sorted(self.request.GET.items())))
+            # NOTE: read everything, including a streamed response, from
+            #       the same commit.
+            commit_id = get_commit(
+                repo, self.request.GET.get('commit')).hexsha
+            all_uuids = None
+            if store is not None:
+                refresh_content_store(store, repo, commit_id)
+                all_uuids = store.uuids(commit_id, content_type)
+            if all_uuids is None:
+                all_uuids = list_content_type_uuids(
+                    repo, content_type, commit_id)
+            uuids = paginate_uuids(
+                all_uuids, offset=pagination['offset'],
+                after=pagination['after'], limit=pagination['limit'])
+            if not pagination['stream']:
+                objects = None
+                if store is not None:
+                    objects = store.objects(commit_id, content_type, uuids)
+                if objects is None:
+                    objects = list(iterate_content_type(
+                        repo, content_type, uuids, commit_id=commit_id))
+
+        headers = dict(cache_headers)
+        headers['X-Total-Count'] = str(len(all_uuids))
+        headers['X-Commit'] = str(commit_id)
+        if (pagination['limit'] is not None and uuids and
+                uuids[-1] != all_uuids[-1]):
+            query = [('after', uuids[-1]), ('limit', pagination['limit'])]
+            if 'commit' in self.request.GET:
+                query.append(('commit', self.request.GET['commit']))
+            headers['Link'] = '<%s?%s>; rel="next"' % (
+                self.request.path_url, urlencode(query))
+
+        if not pagination['stream']:
+            self.request.response.headers.update(headers)
+            return objects
+
+        def app_iter():
+            if store is not None:
+                encoded = store.iterate_json(commit_id, content_type, uuids)
+                if encoded is not None:
+                    for chunk in stream_encoded_json_list(encoded):
+                        yield chunk
+                    return
+            # NOTE: the repository is checked out again for as long as
+            #       the WSGI server is consuming the response.
+            with self.pool.repository(name) as repo:
+                for chunk in stream_json_list(iterate_content_type(
+                        repo, content_type, uuids, commit_id=commit_id)):
+                    yield chunk
+
+        response = Response(
+            app_iter=app_iter(), content_type='application/json',
+            charset='utf-8')
+        response.headers.update(headers)
+        return response
 
     @view(renderer='json', validators=validate_schema)
     def put(self):
         name = self.request.matchdict['name']
         uuid = self.request.matchdict['uuid']
-        storage_path = self.config.get('repo.storage_path')
-        repo = get_repository(os.path.join(storage_path, name))
-        commit, model = save_content_type_object(
-            repo, self.request.schema, uuid, self.request.schema_data)
-        # Fire event
-        self.request.registry.notify(ContentTypeObjectUpdated(
-            config=self.config,
-            repo=repo,
-            model=model,
-            change_type='update'))
+        write_queue = get_write_queues(self.request.registry).get(name)
+        with self.pool.repository(name) as repo:
+            commit, model = save_content_type_object(
+                repo, self.request.schema, uuid, self.request.schema_data,
+                write_queue=write_queue)
+            # Fire event
+            self.request.registry.notify(ContentTypeObjectUpdated(
+                config=self.config,
+                repo=repo,
+                model=model,
+                commit=commit,
+                change_type='update'))
+        # NOTE: with group commits other writes may share this commit
+        self.request.response.headers['X-Commit'] = str(commit.hexsha)
         return dict(model)
 
     @view(renderer='json')
@@ -195,26 +392,38 @@ class ContentTypeResource(object):
         name = self.request.matchdict['name']
         content_type = self.request.matchdict['content_type']
         uuid = self.request.matchdict['uuid']
-        storage_path = self.config.get('repo.storage_path')
-        return format_content_type_object(
-            get_repository(os.path.join(storage_path, name)),
-            content_type, uuid)
+        commit_id = self.request.GET.get('commit')
+        store = get_content_store(self.config, name)
+        with self.pool.repository(name) as repo:
+            set_conditional_headers(
+                self.request, repo, content_type, uuid, commit_id or '')
+            if store is not None:
+                sha = get_commit(repo, commit_id).hexsha
+                refresh_content_store(store, repo, sha)
+                data = store.get(sha, content_type, uuid)
+                if data is not None:
+                    return data
+            return format_content_type_object(
+                repo, content_type, uuid, commit_id)
 
     @view(renderer='json')
     def delete(self):
         name = self.request.matchdict['name']
         content_type = self.request.matchdict['content_type']
         uuid = self.request.matchdict['uuid']
-        storage_path = self.config.get('repo.storage_path')
-        repo = get_repository(os.path.join(storage_path, name))
-        commit, model = delete_content_type_object(
-            repo, content_type, uuid)
-        # Fire event
-        self.request.registry.notify(ContentTypeObjectUpdated(
-            config=self.config,
-            repo=repo,
-            model=model,
-            change_type='delete'))
+        write_queue = get_write_queues(self.request.registry).get(name)
+        with self.pool.repository(name) as repo:
+            commit, model = delete_content_type_object(
+                repo, content_type, uuid, write_queue=write_queue)
+            # Fire event
+            self.request.registry.notify(ContentTypeObjectUpdated(
+                config=self.config,
+                repo=repo,
+                model=model,
+                commit=commit,
+                change_type='delete'))
+        # NOTE: with group commits other writes may share this commit
+        self.request.response.headers['X-Commit'] = str(commit.hexsha)
         return dict(model)
 
 
@@ -229,3 +438,8 @@ def index_content_type_object(event):
         im.unindex(model)
     else:
         im.index(model)
+    if event.commit is not None:
+        # NOTE: so the next update of the index doesn't index it again
+        advance_indexed_sha_for_paths(
+            repo, im.sm.active_branch(), event.commit,
+            [im.sm.git_name(model)])
@@ -0,0 +1,168 @@
+import json
+import os
+
+from elasticgit.commands.avro import serialize
+from elasticgit.tests.base import ModelBaseTest, TestPerson
+from elasticgit.utils import fqcn
+
+from mock import patch
+
+from pyramid import testing
+from pyramid.httpexceptions import HTTPNotModified
+
+from webtest import TestApp
+
+from unicore.distribute.api import main
+from unicore.distribute.api.conditional import (
+    make_etag, conditional_headers)
+
+
+class TestConditionalHeaders(ModelBaseTest):
+
+    def setUp(self):
+        self.workspace = self.mk_workspace()
+        schema_string = serialize(TestPerson)
+        schema = json.loads(schema_string)
+        self.workspace.sm.store_data(
+            os.path.join('_schemas', '%(namespace)s.%(name)s.avsc' % schema),
+            schema_string, 'Writing the schema.')
+        self.workspace.save(
+            TestPerson({'name': 'Foo', 'age': 1}), 'Saving a person.')
+        self.config = testing.setUp(settings={
+            'repo.storage_path': self.WORKING_DIR,
+            'http.cache_max_age': '60',
+        })
+        self.sha = self.workspace.repo.head.commit.hexsha
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_make_etag(self):
+        self.assertEqual(make_etag(self.sha), self.sha)
+        self.assertNotEqual(make_etag(self.sha, 'a'), make_etag(self.sha))
+        self.assertNotEqual(
+            make_etag(self.sha, 'a'), make_etag(self.sha, 'b'))
+        self.assertTrue(make_etag(self.sha, 'a').startswith(self.sha))
+
+    def test_conditional_headers(self):
+        request = testing.DummyRequest({})
+        headers = conditional_headers(request, self.workspace.repo, 'foo')
+        self.assertEqual(
+            headers['ETag'], '"%s"' % (make_etag(self.sha, 'foo'),))
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=60')
+        self.assertIn('GMT', headers['Last-Modified'])
+
+    def test_if_none_match(self):
+        request = testing.DummyRequest({}, headers={
+            'If-None-Match': '"%s"' % (make_etag(self.sha, 'foo'),),
+        })
+        self.assertRaises(
+            HTTPNotModified, conditional_headers,
+            request, self.workspace.repo, 'foo')
+        # NOTE: a different response for the same commit
+        conditional_headers(request, self.workspace.repo, 'bar')
+
+    def test_vary(self):
+        request = testing.DummyRequest({})
+        headers = conditional_headers(
+            request, self.workspace.repo, 'foo', vary='Accept')
+        self.assertEqual(headers['Vary'], 'Accept')
+        request = testing.DummyRequest({}, headers={
+            'If-None-Match': headers['ETag'],
+        })
+        try:
+            conditional_headers(
+                request, self.workspace.repo, 'foo', vary='Accept')
+        except HTTPNotModified, e:
+            self.assertEqual(e.headers['Vary'], 'Accept')
+        else:
+            self.fail('HTTPNotModified not raised.')
+
+    def test_if_none_match_star(self):
+        request = testing.DummyRequest({}, headers={'If-None-Match': '*'})
+        self.assertRaises(
+            HTTPNotModified, conditional_headers,
+            request, self.workspace.repo)
+
+    def test_if_none_match_stale(self):
+        request = testing.DummyRequest({}, headers={
+            'If-None-Match': '"%s"' % (self.sha,),
+        })
+        self.workspace.save(
+            TestPerson({'name': 'Bar', 'age': 2}), 'Saving a person.')
+        headers = conditional_headers(request, self.workspace.repo)
+        self.assertEqual(
+            headers['ETag'],
+            '"%s"' % (self.workspace.repo.head.commit.hexsha,))
+
+    def test_if_none_match_weak(self):
+        request = testing.DummyRequest({}, headers={
+            'If-None-Match': 'W/"%s"' % (make_etag(self.sha, 'foo'),),
+        })
+        conditional_headers(request, self.workspace.repo, 'foo')
+
+    def test_if_modified_since_ignored(self):
+        # NOTE: commits made within the same second share a date, only
+        #       the ETag tells them apart.
+        headers = conditional_headers(
+            testing.DummyRequest({}), self.workspace.repo)
+        request = testing.DummyRequest({}, headers={
+            'If-Modified-Since': headers['Last-Modified'],
+        })
+        self.workspace.save(
+            TestPerson({'name': 'Bar', 'age': 2}), 'Saving a person.')
+        headers = conditional_headers(request, self.workspace.repo)
+        self.assertEqual(
+            headers['ETag'],
+            '"%s"' % (self.workspace.repo.head.commit.hexsha,))
+
+    def test_views(self):
+        app = TestApp(main({}, **{
+            'repo.storage_path': self.WORKING_DIR,
+        }))
+        name = os.path.basename(self.workspace.working_dir)
+        urls = [
+            '/repos/%s.json' % (name,),
+            '/repos/%s/status.json' % (name,),
+            '/repos/%s/%s.json' % (name, fqcn(TestPerson)),
+            '/repos/%s/diff/%s.json' % (name, self.sha),
+            '/repos/%s/pull/%s.json' % (name, self.sha),
+            '/repos/%s/clone.json' % (name,),
+            '/repos/%s/clone.json?format=ndjson' % (name,),
+        ]
+        etags = set()
+        for url in urls:
+            response = app.get(url)
+            etag = response.headers['ETag']
+            self.assertEqual(
+                response.headers['Cache-Control'], 'public, max-age=0')
+            etags.add(etag)
+            response = app.get(
+                url, headers={'If-None-Match': etag}, status=304)
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(response.body, '')
+        self.assertEqual(len(etags), len(urls))
+
+    def test_clone_not_modified(self):
+        app = TestApp(main({}, **{
+            'repo.storage_path': self.WORKING_DIR,
+        }))
+        name = os.path.basename(self.workspace.working_dir)
+        for url, vary in [
+                ('/repos/%s/clone.json' % (name,), 'Accept'),
+                ('/repos/%s/clone.json?format=ndjson' % (name,),
+                 'Accept, Accept-Encoding')]:
+            etag = app.get(url).headers['ETag']
+            with patch('unicore.distribute.api.repo_status.get_commit') as (
+                    mocked_get_commit):
+                response = app.get(
+                    url, headers={'If-None-Match': etag}, status=304)
+            # NOTE: a 304 costs no git object lookups
+            self.assertFalse(mocked_get_commit.called)
+            self.assertEqual(response.headers['Vary'], vary)
+
+        # NOTE: the requested commit is part of the ETag
+        url = '/repos/%s/clone.json' % (name,)
+        self.assertNotEqual(
+            app.get(url).headers['ETag'],
+            app.get(url, {'commit': self.sha[:7]}).headers['ETag'])
@@ -1,4 +1,8 @@
+import gzip
 import json
+import threading
+import time
+from StringIO import StringIO
 
 from git import Repo
 import os
@@ -6,12 +10,44 @@ from elasticgit.commands.avro import serialize
 from elasticgit.tests.base import ModelBaseTest, TestPerson
 from pyramid import testing
 from pyramid.exceptions import NotFound
+from pyramid.request import Request
+from mock import patch
 from unicore.distribute.api.repo_status import (
-    RepositoryStatusResource, RepositoryDiffResource, RepositoryPullResource,
-    RepositoryCloneResource)
+    ServiceStatusResource, RepositoryStatusResource, RepositoryDiffResource,
+    RepositoryPullResource, RepositoryCloneResource)
 from unicore.distribute.utils import (
     format_repo_status, get_repository_diff, pull_repository_files,
     clone_repository)
+from unicore.distribute.api import main
+from unicore.distribute.singleflight import request_coalescer
+from webtest import TestApp
+
+
+class TestServiceStatusResource(ModelBaseTest):
+    def setUp(self):
+        self.workspace = self.mk_workspace()
+        self.config = testing.setUp(settings={
+            'repo.storage_path': self.WORKING_DIR,
+        })
+
+    def test_get(self):
+        repo_name = os.path.basename(self.workspace.working_dir)
+        request = testing.DummyRequest({})
+        request.matchdict = {
+            'name': repo_name,
+        }
+        RepositoryStatusResource(request).get()
+        RepositoryStatusResource(request).get()
+
+        status = ServiceStatusResource(testing.DummyRequest({})).get()
+        pool_stats = status['repository_pool']
+        self.assertEqual(pool_stats['hits'], 1)
+        self.assertEqual(pool_stats['misses'], 1)
+        self.assertEqual(pool_stats['size'], 1)
+        self.assertEqual(pool_stats['in_use'], 0)
+        self.assertEqual(
+            set(status['request_coalescing']),
+            set(['in_flight', 'executions', 'coalesced', 'kinds']))
 
 
 class TestRepositoryStatusResource(ModelBaseTest):
@@ -147,6 +183,50 @@ class TestRepositoryPullResource(ModelBaseTest):
         self.assertEqual(repo_json, pull_repository_files(
             self.workspace.repo, self.initial_commit))
 
+    def test_get_coalesced(self):
+        repo_name = os.path.basename(self.workspace.working_dir)
+        release = threading.Event()
+        results = []
+
+        def slow_pull_repository_files(repo, commit_id):
+            release.wait(5)
+            return pull_repository_files(repo, commit_id)
+
+        def mk_resource():
+            request = testing.DummyRequest({})
+            request.registry = self.config.registry
+            request.matchdict = {
+                'name': repo_name,
+                'commit_id': self.initial_commit
+            }
+            return RepositoryPullResource(request)
+
+        def get(resource):
+            results.append(resource.get())
+
+        before = request_coalescer.stats()['kinds'].get(
+            'pull', {'executions': 0, 'coalesced': 0})
+        with patch('unicore.distribute.api.repo_status.pull_repository_files',
+                   side_effect=slow_pull_repository_files) as mocked:
+            threads = [threading.Thread(target=get, args=(mk_resource(),))
+                       for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            deadline = time.time() + 5
+            while (request_coalescer.stats()['kinds']['pull']['coalesced'] <
+                    before['coalesced'] + 2) and time.time() < deadline:
+                time.sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(mocked.call_count, 1)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(result == results[0] for result in results))
+        after = request_coalescer.stats()['kinds']['pull']
+        self.assertEqual(after['executions'], before['executions'] + 1)
+        self.assertEqual(after['coalesced'], before['coalesced'] + 2)
+
     def test_get_404(self):
         request = testing.DummyRequest({})
         repo_name = os.path.basename(self.workspace.working_dir)
@@ -204,3 +284,48 @@ class TestRepositoryCloneResource(ModelBaseTest):
         }
         resource = RepositoryCloneResource(request)
         self.assertRaises(NotFound, resource.get)
+
+    def test_get_ndjson(self):
+        app = TestApp(main({}, **{
+            'repo.storage_path': self.WORKING_DIR,
+        }))
+        repo_name = os.path.basename(self.workspace.working_dir)
+        response = app.get('/repos/%s/clone.json' % (repo_name,),
+                           {'format': 'ndjson'})
+        self.assertEqual(response.content_type, 'application/x-ndjson')
+        self.assertEqual(response.headers['X-Commit'],
+                         self.workspace.repo.head.commit.hexsha)
+        lines = [json.loads(line) for line in response.body.splitlines()]
+        clone = clone_repository(self.workspace.repo)
+        self.assertEqual(len(lines), 2)
+        for line in lines:
+            self.assertIn(line['data'], clone[line['content_type']])
+
+        # NOTE: webtest decodes gzipped responses, bypass it
+        response = Request.blank(
+            '/repos/%s/clone.json' % (repo_name,), headers={
+                'Accept': 'application/x-ndjson',
+                'Accept-Encoding': 'gzip',
+            }).get_response(app.app)
+        self.assertEqual(response.content_encoding, 'gzip')
+        body = gzip.GzipFile(fileobj=StringIO(response.body)).read()
+        self.assertEqual(
+            [json.loads(line) for line in body.splitlines()], lines)
+
+        # NOTE: q=0 refuses gzip
+        response = Request.blank(
+            '/repos/%s/clone.json' % (repo_name,), headers={
+                'Accept': 'application/x-ndjson',
+                'Accept-Encoding': 'gzip;q=0, deflate',
+            }).get_response(app.app)
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(
+            [json.loads(line) for line in response.body.splitlines()],
+            lines)
+
+    def test_get_ndjson_404(self):
+        app = TestApp(main({}, **{
+            'repo.storage_path': self.WORKING_DIR,
+        }))
+        app.get('/repos/invalid-repo/clone.json', {'format': 'ndjson'},
+                status=404)
@@ -2,6 +2,8 @@ from __future__ import absolute_import
 
 import json
 import os
+import shutil
+import tempfile
 
 from cornice.errors import Errors
 
@@ -12,7 +14,6 @@ from elasticgit.search import ESManager
 from elasticgit.tests.base import TestPerson
 from elasticgit.commands.avro import serialize
 from elasticgit.utils import fqcn
-from elasticgit.workspace import Workspace
 
 from git.exc import GitCommandError
 
@@ -20,16 +21,25 @@ from pyramid import testing
 from pyramid.exceptions import NotFound
 
 from mock import patch, DEFAULT
+from webtest import TestApp
 import avro
 
+from unicore.distribute.api import main
+from unicore.distribute.api.repo_status import JobResource
 from unicore.distribute.api.repos import (
     RepositoryResource, ContentTypeResource, initialize_repo_index,
     update_repo_index, index_content_type_object)
+from unicore.distribute.catalog import get_repository_catalog
 from unicore.distribute.events import (
     RepositoryCloned, RepositoryUpdated, ContentTypeObjectUpdated)
+from unicore.distribute.indexing import (
+    IndexNotReady, get_indexed_sha, set_indexed_sha)
+from unicore.distribute.jobs import get_job_manager
+from unicore.distribute.storage import clone_repo
 from unicore.distribute.utils import (
     format_repo, format_content_type, format_content_type_object)
-from unicore.distribute.tests.base import DistributeTestCase
+from unicore.distribute.tests.base import (
+    DistributeTestCase, FakeElasticsearch)
 
 
 class TestRepositoryResource(DistributeTestCase):
@@ -68,6 +78,65 @@ class TestRepositoryResource(DistributeTestCase):
             'name': 'unicore.distribute.api.tests.test_repos.'
                     'TestRepositoryResource.test_collection_get_name_only'})
 
+    def test_collection_get_filters(self):
+        other_workspace = self.mk_workspace(name='%s_other' % (self.id(),))
+        other_workspace.sm.store_data(
+            'README.md', 'No schemas here.', 'Writing the README.')
+
+        def names(repos):
+            return [repo['name'] for repo in repos]
+
+        request = testing.DummyRequest({'prefix': self.id()})
+        self.assertEqual(
+            names(RepositoryResource(request).collection_get()),
+            [self.id(), '%s_other' % (self.id(),)])
+        self.assertEqual(request.response.headers['X-Total-Count'], '2')
+
+        request = testing.DummyRequest({
+            'prefix': self.id(), 'schema': fqcn(TestPerson)})
+        self.assertEqual(
+            names(RepositoryResource(request).collection_get()),
+            [self.id()])
+
+        request = testing.DummyRequest({
+            'prefix': '%s_' % (self.id(),), 'name_only': 'true'})
+        self.assertEqual(
+            RepositoryResource(request).collection_get(),
+            [{'name': '%s_other' % (self.id(),)}])
+
+    def test_collection_get_pagination(self):
+        other_name = '%s_other' % (self.id(),)
+        self.mk_model_workspace(TestPerson, name=other_name)
+        app = TestApp(main({}, **{
+            'repo.storage_path': self.WORKING_DIR,
+        }))
+
+        response = app.get('/repos.json', {'prefix': self.id(), 'limit': 1})
+        self.assertEqual(response.json, [format_repo(self.workspace.repo)])
+        self.assertEqual(response.headers['X-Total-Count'], '2')
+        self.assertIn('after=%s' % (self.id(),), response.headers['Link'])
+        self.assertIn('prefix=%s' % (self.id(),), response.headers['Link'])
+
+        response = app.get('/repos.json', {
+            'prefix': self.id(), 'limit': 1, 'after': self.id()})
+        self.assertEqual(
+            [repo['name'] for repo in response.json], [other_name])
+        self.assertNotIn('Link', response.headers)
+
+        response = app.get('/repos.json', {
+            'prefix': self.id(), 'offset': 1, 'name_only': 'true'})
+        self.assertEqual(response.json, [{'name': other_name}])
+
+        app.get('/repos.json', {'limit': 'foo'}, status=400)
+
+    def test_collection_get_cached(self):
+        request = testing.DummyRequest({})
+        RepositoryResource(request).collection_get()
+        catalog = get_repository_catalog(self.config.registry)
+        builds = catalog.stats()['builds']
+        RepositoryResource(request).collection_get()
+        self.assertEqual(catalog.stats()['builds'], builds)
+
     def test_collection_post_success(self):
         # NOTE: cloning to a different directory called `remote` because
         #       the API is trying to clone into the same folder as the
@@ -117,6 +186,128 @@ class TestRepositoryResource(DistributeTestCase):
             self.assertTrue(
                 os.path.exists(os.path.join(self.WORKING_DIR, 'foo-bar')))
 
+    def test_collection_post_bare(self):
+        api_repo_name = '%s_remote' % (self.id(),)
+        self.remote_workspace = self.mk_workspace(
+            working_dir=os.path.join(self.WORKING_DIR, 'remote'),
+            name=api_repo_name)
+        self.remote_workspace.save(
+            TestPerson({'name': 'Foo', 'age': 1}), 'Saving a person.')
+        self.addCleanup(
+            lambda: EG.workspace(
+                os.path.join(
+                    self.WORKING_DIR, api_repo_name)).destroy())
+        self.config.registry.settings['repo.bare'] = 'true'
+        request = testing.DummyRequest({})
+        request.validated = {
+            'repo_url': self.remote_workspace.working_dir,
+            'repo_name': None
+        }
+        request.route_url = lambda route, name: '/repos/%s.json' % (name,)
+        request.errors = Errors()
+        resource = RepositoryResource(request)
+
+        with patch.object(request.registry, 'notify'):
+            resource.collection_post()
+        self.assertEqual(request.response.status_code, 301)
+
+        request.matchdict = {'name': api_repo_name}
+        repo_json = resource.get()
+        self.assertEqual(repo_json['commit'],
+                         self.remote_workspace.repo.head.commit.hexsha)
+        self.assertEqual(repo_json['branch'], 'master')
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.WORKING_DIR, api_repo_name, 'HEAD')))
+
+    def test_collection_post_async(self):
+        api_repo_name = '%s_remote' % (self.id(),)
+        self.remote_workspace = self.mk_workspace(
+            working_dir=os.path.join(self.WORKING_DIR, 'remote'),
+            name=api_repo_name)
+        self.addCleanup(
+            lambda: EG.workspace(
+                os.path.join(
+                    self.WORKING_DIR, api_repo_name)).destroy())
+        self.config.registry.settings['repo.async_clone'] = 'true'
+        request = testing.DummyRequest({})
+        request.validated = {
+            'repo_url': self.remote_workspace.working_dir,
+            'repo_name': None
+        }
+        request.route_url = lambda route, **kwargs: '/%s/%s' % (
+            route, kwargs.values()[0])
+        request.errors = Errors()
+        resource = RepositoryResource(request)
+
+        with patch.object(self.config.registry, 'notify') as mocked_notify:
+            job_json = resource.collection_post()
+            self.assertEqual(request.response.status_code, 202)
+            self.assertEqual(
+                request.response.headers['Location'],
+                '/jobresource/%s' % (job_json['id'],))
+            get_job_manager(self.config.registry).join()
+            (event,) = mocked_notify.call_args[0]
+            self.assertIsInstance(event, RepositoryCloned)
+            self.assertTrue(callable(event.progress))
+
+        request.matchdict = {'id': job_json['id']}
+        job_json = JobResource(request).get()
+        self.assertEqual(job_json['status'], 'completed')
+        self.assertEqual(job_json['phase'], 'indexing')
+        self.assertEqual(job_json['result'], {
+            'name': api_repo_name,
+            'url': '/repositoryresource/%s' % (api_repo_name,),
+        })
+        self.assertTrue(os.path.exists(
+            os.path.join(self.WORKING_DIR, api_repo_name)))
+
+        request.matchdict = {'id': 'does-not-exist'}
+        self.assertRaises(NotFound, JobResource(request).get)
+
+    def test_collection_post_async_without_indexing(self):
+        api_repo_name = '%s_remote' % (self.id(),)
+        self.remote_workspace = self.mk_workspace(
+            working_dir=os.path.join(self.WORKING_DIR, 'remote'),
+            name=api_repo_name)
+        self.addCleanup(
+            lambda: EG.workspace(
+                os.path.join(
+                    self.WORKING_DIR, api_repo_name)).destroy())
+        self.config.registry.settings['repo.async_clone'] = 'true'
+        self.config.registry.settings['es.indexing_enabled'] = 'false'
+        request = testing.DummyRequest({})
+        request.validated = {
+            'repo_url': self.remote_workspace.working_dir,
+            'repo_name': None
+        }
+        request.route_url = lambda route, **kwargs: '/'
+        request.errors = Errors()
+        with patch.object(self.config.registry, 'notify'):
+            job_json = RepositoryResource(request).collection_post()
+            get_job_manager(self.config.registry).join()
+        job = get_job_manager(self.config.registry).get(job_json['id'])
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual(job.phase, 'cloning')
+
+    @patch.object(EG, 'clone_repo')
+    def test_collection_post_async_error(self, mock_method):
+        mock_method.side_effect = GitCommandError(
+            'git clone', 'Boom!', stderr='mocked response')
+        self.config.registry.settings['repo.async_clone'] = 'true'
+        request = testing.DummyRequest({})
+        request.validated = {
+            'repo_url': 'git://example.org/bar.git',
+            'repo_name': None
+        }
+        request.route_url = lambda route, **kwargs: '/'
+        request.errors = Errors()
+        job_json = RepositoryResource(request).collection_post()
+        get_job_manager(self.config.registry).join()
+        job = get_job_manager(self.config.registry).get(job_json['id'])
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.phase, 'cloning')
+        self.assertIn('mocked response', job.error)
+
     def test_initialize_repo_index(self):
         im = self.workspace.im
         sm = self.workspace.sm
@@ -138,6 +329,65 @@ class TestRepositoryResource(DistributeTestCase):
             self.assertEqual(
                 len(self.workspace.S(TestPerson).filter(name='foo')), 1)
 
+    def test_initialize_repo_index_bulk(self):
+        sm = self.workspace.sm
+        for i in range(5):
+            sm.store(TestPerson({'name': 'foo %s' % (i,)}), 'storing person')
+        es = FakeElasticsearch()
+        progress = []
+        self.config.registry.settings['es.bulk_chunk_size'] = '2'
+        event = RepositoryCloned(
+            repo=self.workspace.repo,
+            config=self.config.registry.settings,
+            progress=lambda done, total: progress.append((done, total)))
+
+        with patch('unicore.distribute.api.repos.get_es', return_value=es):
+            initialize_repo_index(event)
+
+        index = self.workspace.im.index_name(sm.active_branch())
+        doc_type = self.workspace.im.get_mapping_type(
+            TestPerson).get_mapping_type_name()
+        self.assertEqual(
+            sorted(doc['name'] for doc in es.docs(index, doc_type).values()),
+            ['foo %s' % (i,) for i in range(5)])
+        self.assertEqual(len(es.bulk_requests), 3)
+        self.assertEqual(progress[0], (0, 5))
+        self.assertEqual(progress[-1], (5, 5))
+        self.assertEqual(event.index_stats['indexed'], 5)
+        self.assertEqual(
+            es.indexes[index]['settings']['refresh_interval'], '1s')
+        self.assertEqual(
+            es.settings_history[0][1]['refresh_interval'], '-1')
+
+    def test_initialize_repo_index_alias(self):
+        es = FakeElasticsearch()
+        self.config.registry.settings['es.reindex_mode'] = 'alias'
+        event = RepositoryCloned(
+            repo=self.workspace.repo,
+            config=self.config.registry.settings)
+
+        with patch('unicore.distribute.indexing.get_es', return_value=es):
+            initialize_repo_index(event)
+
+        alias = self.workspace.im.index_name(
+            self.workspace.sm.active_branch())
+        self.assertEqual(event.index_stats['alias'], alias)
+        self.assertEqual(
+            es.aliases[alias], set([event.index_stats['index']]))
+
+    def test_initialize_repo_index_not_ready(self):
+        es = FakeElasticsearch()
+        es.cluster.statuses = ['red']
+        self.config.registry.settings['es.ready_timeout'] = '0'
+        event = RepositoryCloned(
+            repo=self.workspace.repo,
+            config=self.config.registry.settings)
+
+        with patch('unicore.distribute.api.repos.get_es', return_value=es):
+            self.assertRaises(IndexNotReady, initialize_repo_index, event)
+        self.assertEqual(es.indexes, {})
+        self.assertEqual(es.bulk_requests, [])
+
     @patch.object(
         ESManager, 'setup_custom_mapping', side_effect=ElasticsearchException)
     def test_initialize_repo_index_error(self, mocked_setup_mapping):
@@ -222,17 +472,29 @@ class TestRepositoryResource(DistributeTestCase):
                 'url': 'foo',
             })
 
-    @patch.object(Workspace, 'index_diff')
-    def test_update_repo_index(self, mocked_index_diff):
+    def test_update_repo_index(self):
+        initial_sha = self.workspace.repo.head.commit.hexsha
+        person = TestPerson({'age': 1, 'name': 'person1'})
+        self.workspace.save(person, 'Adding person1.')
         self.workspace.repo.create_head('foo')
+        es = FakeElasticsearch()
+        index = self.workspace.im.index_name('foo')
+        es.indices.create(index=index)
+        set_indexed_sha(self.workspace.repo, 'foo', initial_sha)
         event = RepositoryUpdated(
             repo=self.workspace.repo,
             config=self.config.registry.settings,
             branch='foo',
-            changes='diffindex')
+            changes=None)
 
-        update_repo_index(event)
-        mocked_index_diff.assert_called_with('diffindex')
+        with patch('unicore.distribute.indexing.get_es', return_value=es):
+            update_repo_index(event)
+        doc_type = self.workspace.im.get_mapping_type(
+            TestPerson).get_mapping_type_name()
+        self.assertEqual(es.docs(index, doc_type), {person.uuid: dict(person)})
+        self.assertEqual(
+            get_indexed_sha(self.workspace.repo, 'foo'),
+            self.workspace.repo.heads.foo.commit.hexsha)
         self.assertEqual(event.repo.active_branch.name, 'master')
 
     def test_pull_additions(self):
@@ -372,6 +634,116 @@ class TestContentTypeResource(DistributeTestCase):
             content_type_json, format_content_type(self.workspace.repo,
                                                    fqcn(TestPerson)))
 
+    def test_collection_commit(self):
+        first_commit = self.workspace.repo.head.commit.hexsha
+        self.workspace.save(
+            TestPerson({'name': 'Bar', 'age': 2}), 'Saving a person.')
+        self.workspace.save(
+            TestPerson(dict(self.person, name='Foo2')), 'Updating a person.')
+
+        app = TestApp(main({}, **{
+            'repo.storage_path': self.WORKING_DIR,
+        }))
+        name = os.path.basename(self.workspace.working_dir)
+        url = '/repos/%s/%s.json' % (name, fqcn(TestPerson))
+
+        response = app.get(url, {'commit': first_commit[:7]})
+        self.assertEqual(
+            [obj['name'] for obj in response.json], ['Foo'])
+        self.assertEqual(response.headers['X-Commit'], first_commit)
+        response = app.get(url)
+        self.assertEqual(len(response.json), 2)
+        self.assertEqual(response.headers['X-Commit'],
+                         self.workspace.repo.head.commit.hexsha)
+
+        response = app.get(
+            '/repos/%s/%s/%s.json' % (name, fqcn(TestPerson),
+                                      self.person.uuid),
+            {'commit': first_commit})
+        self.assertEqual(response.json['name'], 'Foo')
+        app.get(url, {'commit': 'abcdef1'}, status=404)
+
+    def test_collection_pagination(self):
+        people = [self.person] + [
+            TestPerson({'name': 'Foo %s' % (i,), 'age': i})
+            for i in range(2)]
+        for person in people[1:]:
+            self.workspace.save(person, 'Saving a person.')
+        people.sort(key=lambda person: person.uuid)
+
+        app = TestApp(main({}, **{
+            'repo.storage_path': self.WORKING_DIR,
+        }))
+        url = '/repos/%s/%s.json' % (
+            os.path.basename(self.workspace.working_dir), fqcn(TestPerson))
+
+        response = app.get(url, {'limit': 2})
+        self.assertEqual(
+            [obj['uuid'] for obj in response.json],
+            [p.uuid for p in people[:2]])
+        self.assertEqual(response.headers['X-Total-Count'], '3')
+        self.assertIn('after=%s' % (people[1].uuid,),
+                      response.headers['Link'])
+
+        response = app.get(url, {'limit': 2, 'after': people[1].uuid})
+        self.assertEqual(
+            [obj['uuid'] for obj in response.json], [people[2].uuid])
+        self.assertNotIn('Link', response.headers)
+
+        response = app.get(url, {'offset': 1})
+        self.assertEqual(
+            [obj['uuid'] for obj in response.json],
+            [p.uuid for p in people[1:]])
+
+        app.get(url, {'limit': 'foo'}, status=400)
+        app.get(url, {'offset': -1}, status=400)
+
+    def test_collection_stream(self):
+        app = TestApp(main({}, **{
+            'repo.storage_path': self.WORKING_DIR,
+        }))
+        url = '/repos/%s/%s.json' % (
+            os.path.basename(self.workspace.working_dir), fqcn(TestPerson))
+        response = app.get(url, {'stream': 'true'})
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(response.json, format_content_type(
+            self.workspace.repo, fqcn(TestPerson)))
+        self.assertEqual(response.headers['X-Total-Count'], '1')
+
+    def test_content_store(self):
+        store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, store_dir)
+        app = TestApp(main({}, **{
+            'repo.storage_path': self.WORKING_DIR,
+            'content_store.dir': store_dir,
+        }))
+        url = '/repos/%s/%s' % (
+            os.path.basename(self.workspace.working_dir), fqcn(TestPerson))
+        first_commit = self.workspace.repo.head.commit.hexsha
+        expected = format_content_type(self.workspace.repo, fqcn(TestPerson))
+        with patch('unicore.distribute.api.repos.iterate_content_type') as (
+                mocked_iterate):
+            self.assertEqual(app.get('%s.json' % (url,)).json, expected)
+            self.assertEqual(
+                app.get('%s.json' % (url,), {'stream': 'true'}).json,
+                expected)
+            self.assertEqual(
+                app.get('%s/%s.json' % (url, self.person.uuid)).json,
+                dict(self.person))
+            self.assertFalse(mocked_iterate.called)
+
+        # NOTE: the store catches up with commits made behind its back
+        #       and older commits are read from git.
+        person = TestPerson({'name': 'Bar', 'age': 2})
+        self.workspace.save(person, 'Saving a person.')
+        self.assertEqual(
+            app.get('%s/%s.json' % (url, person.uuid)).json, dict(person))
+        self.assertEqual(
+            len(app.get('%s.json' % (url,), {'commit': first_commit}).json),
+            1)
+        app.get('%s/%s.json' % (url, person.uuid), status=404,
+                params={'commit': first_commit})
+
     def test_get(self):
         request = testing.DummyRequest({})
         request.matchdict = {
@@ -416,6 +788,10 @@ class TestContentTypeResource(DistributeTestCase):
             self.assertEqual(event.repo, self.workspace.repo)
             self.assertEqual(event.model, self.person)
             self.assertEqual(event.change_type, 'update')
+            self.assertEqual(event.commit, self.workspace.repo.head.commit)
+        self.assertEqual(
+            request.response.headers['X-Commit'],
+            self.workspace.repo.head.commit.hexsha)
 
     def test_delete(self):
         request = testing.DummyRequest()
@@ -434,6 +810,9 @@ class TestContentTypeResource(DistributeTestCase):
             self.assertEqual(event.repo, self.workspace.repo)
             self.assertEqual(event.model, self.person)
             self.assertEqual(event.change_type, 'delete')
+        self.assertEqual(
+            request.response.headers['X-Commit'],
+            self.workspace.repo.head.commit.hexsha)
 
         request = testing.DummyRequest({})
         request.matchdict = {
@@ -457,3 +836,145 @@ class TestContentTypeResource(DistributeTestCase):
         event.change_type = 'delete'
         index_content_type_object(event)
         unindex.assert_called_with(self.person)
+
+    @patch.object(ESManager, 'index')
+    def test_index_content_type_object_advances_indexed_sha(self, index):
+        repo = self.workspace.repo
+        commit = repo.head.commit
+        set_indexed_sha(repo, 'master', commit.parents[0].hexsha)
+        event = ContentTypeObjectUpdated(
+            repo=repo,
+            model=self.person,
+            commit=commit,
+            change_type='update',
+            config=self.config.registry.settings)
+        index_content_type_object(event)
+        self.assertEqual(get_indexed_sha(repo, 'master'), commit.hexsha)
+
+
+class TestBatchResource(DistributeTestCase):
+
+    def setUp(self):
+        self.workspace = self.mk_model_workspace(TestPerson)
+        self.person = TestPerson({'name': 'Foo', 'age': 1})
+        self.other_person = TestPerson({'name': 'Bar', 'age': 2})
+        self.workspace.save(self.person, 'Saving a person.')
+        self.workspace.save(self.other_person, 'Saving a person.')
+        self.name = os.path.basename(self.workspace.working_dir)
+        self.url = '/repos/%s/batch.json' % (self.name,)
+
+    def mk_app(self, **settings):
+        settings.setdefault('repo.storage_path', self.WORKING_DIR)
+        return TestApp(main({}, **settings))
+
+    def operations(self):
+        new_person = dict(TestPerson({'name': 'Baz', 'age': 3}))
+        del new_person['uuid']
+        return [
+            {'action': 'create', 'content_type': fqcn(TestPerson),
+             'data': new_person},
+            {'action': 'update', 'content_type': fqcn(TestPerson),
+             'uuid': self.person.uuid,
+             'data': dict(self.person, name='Foo2')},
+            {'action': 'delete', 'content_type': fqcn(TestPerson),
+             'uuid': self.other_person.uuid},
+        ]
+
+    def test_post(self):
+        parent = self.workspace.repo.head.commit
+        response = self.mk_app().post_json(self.url, {
+            'message': 'Importing people.',
+            'operations': self.operations(),
+        })
+        commit = self.workspace.repo.head.commit
+        self.assertEqual(response.json['commit'], commit.hexsha)
+        self.assertEqual(list(commit.parents), [parent])
+        self.assertEqual(commit.message, 'Importing people.')
+        self.assertEqual(
+            [obj['action'] for obj in response.json['objects']],
+            ['create', 'update', 'delete'])
+        created_uuid = response.json['objects'][0]['uuid']
+
+        people = dict(
+            (data['uuid'], data['name']) for data in format_content_type(
+                self.workspace.repo, fqcn(TestPerson)))
+        self.assertEqual(people, {
+            created_uuid: 'Baz',
+            self.person.uuid: 'Foo2',
+        })
+        self.assertFalse(self.workspace.repo.is_dirty())
+
+    def test_post_fires_one_event(self):
+        with patch('unicore.distribute.api.repos.update_index') as (
+                mocked_update_index):
+            self.mk_app(**{'es.indexing_enabled': 'true'}).post_json(
+                self.url, {'operations': self.operations()})
+        (repo, config, branch), kwargs = mocked_update_index.call_args
+        self.assertEqual(mocked_update_index.call_count, 1)
+        self.assertEqual(branch, 'master')
+        # NOTE: the added and deleted person may be paired up as a rename
+        paths = set(
+            blob.path for diff in kwargs['changes']
+            for blob in (diff.a_blob, diff.b_blob) if blob is not None)
+        self.assertEqual(len(paths), 3)
+        self.assertEqual(
+            repo.head.commit.message, 'Updated via batch request.')
+
+    def test_post_invalid(self):
+        head = self.workspace.repo.head.commit.hexsha
+        app = self.mk_app()
+        operations = self.operations()
+        operations[0]['data']['age'] = 'not an int'
+        operations[2]['uuid'] = 'missing'
+        operations.append({'action': 'move'})
+        operations.append(dict(operations[1]))
+        response = app.post_json(
+            self.url, {'operations': operations}, status=400)
+        self.assertEqual(
+            sorted(error['name'] for error in response.json['errors']),
+            ['operations.0', 'operations.0.data.age', 'operations.2',
+             'operations.3', 'operations.4'])
+        self.assertEqual(self.workspace.repo.head.commit.hexsha, head)
+
+        app.post_json(self.url, {'operations': []}, status=400)
+        app.post(self.url, 'not json', status=400)
+
+    def test_post_root_commit(self):
+        # NOTE: a batch written as the repository's first commit
+        root = self.workspace.repo.commit(
+            self.workspace.repo.git.rev_list('--max-parents=0', 'HEAD'))
+        with patch(
+                'unicore.distribute.api.repos.apply_content_type_operations',
+                return_value=(root, [])):
+            response = self.mk_app().post_json(
+                self.url, {'operations': self.operations()})
+        self.assertEqual(response.json['commit'], root.hexsha)
+
+    def test_post_invalid_types(self):
+        head = self.workspace.repo.head.commit.hexsha
+        operations = self.operations()
+        operations[0]['content_type'] = [fqcn(TestPerson)]
+        operations[1]['content_type'] = {'name': fqcn(TestPerson)}
+        operations[2]['uuid'] = [self.other_person.uuid]
+        response = self.mk_app().post_json(
+            self.url, {'operations': operations}, status=400)
+        self.assertEqual(
+            [(error['name'], error['description'])
+             for error in response.json['errors']],
+            [('operations.0', 'A content type is required.'),
+             ('operations.1', 'A content type is required.'),
+             ('operations.2', 'UUIDs need to be strings.')])
+        self.assertEqual(self.workspace.repo.head.commit.hexsha, head)
+
+    def test_post_bare(self):
+        path = os.path.join(self.WORKING_DIR, '%s_bare' % (self.id(),))
+        repo = clone_repo(self.workspace.working_dir, path, bare=True)
+        self.addCleanup(shutil.rmtree, path)
+        response = self.mk_app().post_json(
+            '/repos/%s/batch.json' % (os.path.basename(path),),
+            {'operations': self.operations()})
+        self.assertEqual(response.json['commit'], repo.head.commit.hexsha)
+        self.assertEqual(
+            set(data['name'] for data in format_content_type(
+                repo, fqcn(TestPerson))),
+            set(['Baz', 'Foo2']))
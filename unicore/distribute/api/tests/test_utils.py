@@ -8,6 +8,7 @@ import os
 from elasticgit.tests.base import TestPerson
 from elasticgit.commands.avro import serialize
 from pyramid import testing
+from pyramid.exceptions import NotFound
 from git import Repo
 
 from unicore.distribute.tests.base import DistributeTestCase
@@ -15,7 +16,8 @@ from unicore.distribute.utils import (
     UCConfigParser, get_repositories, get_repository, format_repo,
     format_content_type, format_content_type_object, list_schemas, get_schema,
     get_repository_diff, pull_repository_files, add_model_item_to_pull_dict,
-    clone_repository, list_content_types)
+    clone_repository, list_content_types, paginate_uuids, stream_json_list,
+    list_content_type_uuids, get_mapping, get_commit)
 
 
 class TestUCConfigParser(TestCase):
@@ -46,6 +48,24 @@ class TestUCConfigParser(TestCase):
         })
 
 
+class TestPaginationUtils(TestCase):
+
+    def test_paginate_uuids(self):
+        uuids = ['a', 'b', 'c', 'd']
+        self.assertEqual(paginate_uuids(uuids), uuids)
+        self.assertEqual(paginate_uuids(uuids, limit=2), ['a', 'b'])
+        self.assertEqual(paginate_uuids(uuids, offset=3), ['d'])
+        self.assertEqual(
+            paginate_uuids(uuids, after='b', limit=1), ['c'])
+        self.assertEqual(paginate_uuids(uuids, after='d'), [])
+
+    def test_stream_json_list(self):
+        self.assertEqual(''.join(stream_json_list([])), '[]')
+        items = [{'a': 1}, {'b': 2}]
+        self.assertEqual(
+            json.loads(''.join(stream_json_list(iter(items)))), items)
+
+
 class TestRepositoryUtils(DistributeTestCase):
     maxDiff = None
     initial_commit = ""
@@ -217,3 +237,92 @@ class TestRepositoryUtils2(DistributeTestCase):
         self.assertEqual(set(clone), {'commit'} | self.schema_names)
         self.assertEqual(clone['commit'],
                          self.workspace.repo.head.commit.hexsha)
+
+    def test_pull_repository_files_content(self):
+        person = TestPerson({'age': 22, 'name': 'testing'})
+        self.workspace.save(person, 'saving person testing')
+        commit = self.workspace.repo.head.commit.hexsha
+        self.workspace.delete(person, 'deleting person testing')
+        pull = pull_repository_files(self.workspace.repo, commit)
+        content_type = '%s.%s' % (TestPerson.__module__, TestPerson.__name__)
+        self.assertEqual(pull[content_type], [])
+        [first_commit] = self.workspace.repo.iter_commits(
+            max_parents=0)
+        pull = pull_repository_files(
+            self.workspace.repo, first_commit.hexsha)
+        self.assertEqual(
+            sorted(data['name'] for data in pull[content_type]),
+            ['Bar', 'Foo'])
+
+
+class TestCommitReads(DistributeTestCase):
+
+    def setUp(self):
+        self.workspace = self.mk_workspace()
+        self.add_schema(self.workspace, TestPerson)
+        self.content_type = '%s.%s' % (
+            TestPerson.__module__, TestPerson.__name__)
+        self.person1 = TestPerson({'age': 12, 'name': 'Foo'})
+        self.workspace.save(self.person1, 'saving person 1')
+        self.first_commit = self.workspace.repo.head.commit.hexsha
+        self.person2 = TestPerson({'age': 34, 'name': 'Bar'})
+        self.workspace.save(self.person2, 'saving person 2')
+        self.workspace.save(
+            TestPerson(dict(self.person1, name='Foo2')), 'updating person 1')
+
+    def test_get_commit(self):
+        repo = self.workspace.repo
+        self.assertEqual(get_commit(repo), repo.head.commit)
+        self.assertEqual(
+            get_commit(repo, self.first_commit[:7]).hexsha,
+            self.first_commit)
+        self.assertRaises(NotFound, get_commit, repo, 'abcdef1')
+        self.assertRaises(NotFound, get_commit, repo, 'foo')
+
+    def test_historical_reads(self):
+        repo = self.workspace.repo
+        self.assertEqual(
+            list_content_type_uuids(repo, self.content_type),
+            sorted([self.person1.uuid, self.person2.uuid]))
+        self.assertEqual(
+            list_content_type_uuids(
+                repo, self.content_type, self.first_commit),
+            [self.person1.uuid])
+        [data] = format_content_type(
+            repo, self.content_type, commit_id=self.first_commit)
+        self.assertEqual(data['name'], 'Foo')
+        data = format_content_type_object(
+            repo, self.content_type, self.person1.uuid)
+        self.assertEqual(data['name'], 'Foo2')
+        data = format_content_type_object(
+            repo, self.content_type, self.person1.uuid, self.first_commit)
+        self.assertEqual(data['name'], 'Foo')
+        self.assertRaises(
+            NotFound, format_content_type_object, repo, self.content_type,
+            self.person2.uuid, self.first_commit)
+
+        clone = clone_repository(repo, self.first_commit)
+        self.assertEqual(clone['commit'], self.first_commit)
+        self.assertEqual(len(clone[self.content_type]), 1)
+
+    def test_working_directory_ignored(self):
+        repo = self.workspace.repo
+        path = os.path.join(
+            repo.working_dir, self.workspace.sm.git_name(self.person2))
+        os.remove(path)
+        with open(os.path.join(
+                os.path.dirname(path), 'uncommitted.json'), 'w') as fp:
+            fp.write('{}')
+        self.assertEqual(
+            list_content_type_uuids(repo, self.content_type),
+            sorted([self.person1.uuid, self.person2.uuid]))
+        self.assertEqual(format_content_type_object(
+            repo, self.content_type, self.person2.uuid)['name'], 'Bar')
+
+    def test_get_mapping(self):
+        self.add_mapping(self.workspace, TestPerson)
+        mapping = get_mapping(self.workspace.repo, self.content_type)
+        self.assertTrue('properties' in mapping)
+        self.assertRaises(
+            NotFound, get_mapping, self.workspace.repo, self.content_type,
+            self.first_commit)
@@ -62,6 +62,14 @@ class TestValidators(ModelBaseTest):
                 'description': (
                     'Data does not match the schema for '
                     'elasticgit.tests.base.TestPerson')
+            }, {
+                'location': 'body',
+                'name': 'age',
+                'description': "u'twenty two' is not a valid int",
+            }, {
+                'location': 'body',
+                'name': '_version',
+                'description': 'Required.',
             }])
 
     def test_validate_schema_invalid_uuid(self):
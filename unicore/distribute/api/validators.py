@@ -1,33 +1,60 @@
-import os
 import json
-
-from avro.io import validate
+from uuid import uuid4
 
 from colander import MappingSchema, SchemaNode, String, Invalid
 
-from unicore.distribute.utils import get_config, get_repository, get_schema
+from pyramid.exceptions import NotFound
+
+from unicore.distribute.pool import get_repository_pool
+from unicore.distribute.storage import get_storage_manager
+from unicore.distribute.utils import (
+    get_commit, get_schema_set, load_model_class)
+from unicore.distribute.validation import join_path
 
 
 REPO_NAME_CHARS = set('abcdefghijklmnopqrstuvwxyz0123456789.-_')
 
+BATCH_ACTIONS = ('create', 'update', 'delete')
+
+DEFAULT_BATCH_MESSAGE = 'Updated via batch request.'
+
+DEFAULT_PAGINATION = {
+    'offset': 0,
+    'after': None,
+    'limit': None,
+    'stream': False,
+}
+
+
+def schema_errors(errors, prefix):
+    # NOTE: errors about the datum itself rather than one of its fields
+    #       are named after the prefix, or ``schema``
+    return [(join_path(prefix, path) or 'schema', message)
+            for path, message in errors]
+
 
 def validate_schema(request):
-    config = get_config(request)
-    storage_path = config.get('repo.storage_path')
-    repo = get_repository(
-        os.path.join(storage_path, request.matchdict['name']))
+    pool = get_repository_pool(request.registry)
     uuid = request.matchdict['uuid']
     content_type = request.matchdict['content_type']
-    schema = get_schema(repo, content_type)
+    with pool.repository(request.matchdict['name']) as repo:
+        schema_set = get_schema_set(repo)
+    try:
+        validator = schema_set.get_validator(content_type)
+    except KeyError:
+        raise NotFound('Schema does not exist.')
     data = json.loads(request.body)
 
-    if not validate(schema, data):
+    errors = validator.errors(data)
+    if errors:
         request.errors.status = 400
         request.errors.add(
             'body',
             'schema',
             'Data does not match the schema for %s' % (content_type,)
         )
+        for name, message in schema_errors(errors, ''):
+            request.errors.add('body', name, message)
     elif uuid is not None and data['uuid'] != uuid:
         request.errors.status = 400
         request.errors.add(
@@ -36,10 +63,129 @@ def validate_schema(request):
             'Payload UUID does not match URL UUID.'
         )
     else:
-        request.schema = schema.to_json()
+        # NOTE: shared with other requests, must not be changed
+        request.schema = schema_set.json[content_type]
         request.schema_data = data
 
 
+def validate_batch_operation(repo, operation, seen):
+    """
+    Validate a single batch operation, returning it normalised or a
+    list of ``(path, message)`` errors.
+    """
+    if not isinstance(operation, dict):
+        return None, [('', 'Operations need to be objects.')]
+    action = operation.get('action')
+    if action not in BATCH_ACTIONS:
+        return None, [('', '%r is not a valid action' % (action,))]
+    content_type = operation.get('content_type')
+    if not isinstance(content_type, basestring):
+        return None, [('', 'A content type is required.')]
+    schema_set = get_schema_set(repo)
+    try:
+        validator = schema_set.get_validator(content_type)
+    except KeyError:
+        return None, [('', 'Schema does not exist for %s' % (content_type,))]
+
+    data = operation.get('data')
+    uuid = operation.get('uuid')
+    if action != 'delete':
+        if not isinstance(data, dict):
+            return None, [('', 'Data needs to be an object.')]
+        uuid = uuid or data.get('uuid') or (
+            uuid4().hex if action == 'create' else None)
+    if not uuid:
+        return None, [('', 'A uuid is required to %s an object.' % (action,))]
+    if not isinstance(uuid, basestring):
+        return None, [('', 'UUIDs need to be strings.')]
+    if (content_type, uuid) in seen:
+        return None, [('', 'Object %s is changed more than once.' % (uuid,))]
+    seen.add((content_type, uuid))
+
+    if action == 'delete':
+        storage_manager = get_storage_manager(repo)
+        path = storage_manager.git_path(
+            load_model_class(repo, content_type),
+            '%s.%s' % (uuid, storage_manager.serializer.suffix))
+        try:
+            get_commit(repo).tree[path]
+        except KeyError:
+            return None, [('', 'Object %s does not exist.' % (uuid,))]
+        data = None
+    elif data.get('uuid', uuid) != uuid:
+        return None, [('', 'Payload UUID does not match operation UUID.')]
+    else:
+        data = dict(data, uuid=uuid)
+        errors = validator.errors(data)
+        if errors:
+            return None, [('', 'Data does not match the schema for %s' % (
+                content_type,))] + schema_errors(errors, 'data')
+
+    return {
+        'action': action,
+        'content_type': content_type,
+        'uuid': uuid,
+        'data': data,
+    }, []
+
+
+def validate_batch(request):
+    try:
+        body = json.loads(request.body)
+    except ValueError:
+        body = None
+    if not isinstance(body, dict) or not isinstance(
+            body.get('operations'), list) or not body['operations']:
+        request.errors.status = 400
+        request.errors.add(
+            'body', 'operations', 'A list of operations is required.')
+        return
+
+    message = body.get('message') or DEFAULT_BATCH_MESSAGE
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+
+    operations = []
+    seen = set()
+    pool = get_repository_pool(request.registry)
+    with pool.repository(request.matchdict['name']) as repo:
+        for i, operation in enumerate(body['operations']):
+            operation, errors = validate_batch_operation(
+                repo, operation, seen)
+            for path, description in errors:
+                request.errors.status = 400
+                request.errors.add(
+                    'body', join_path('operations.%d' % (i,), path),
+                    description)
+            operations.append(operation)
+
+    request.batch = {
+        'message': message,
+        'operations': operations,
+    }
+
+
+def validate_pagination(request):
+    pagination = dict(DEFAULT_PAGINATION)
+    pagination['after'] = request.GET.get('after')
+    pagination['stream'] = request.GET.get(
+        'stream', '').lower() in ('1', 'true')
+    for name in ('offset', 'limit'):
+        value = request.GET.get(name)
+        if value is None:
+            continue
+        try:
+            pagination[name] = int(value)
+            if pagination[name] < 0:
+                raise ValueError(value)
+        except ValueError:
+            request.errors.status = 400
+            request.errors.add(
+                'querystring', name,
+                '%r is not a valid %s' % (value, name))
+    request.pagination = pagination
+
+
 def repo_url_type_schema_validator(node, value):
     valid_prefixes = ['git://', 'http://', 'https://', 'ssh://']
     if not any([value.startswith(prefix) for prefix in valid_prefixes]):
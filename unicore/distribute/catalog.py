@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+
+from pyramid.exceptions import NotFound
+
+from unicore.distribute.pool import get_repository_pool
+from unicore.distribute.schemas import get_head_sha
+from unicore.distribute.utils import format_repo, get_repository_names
+
+
+class RepositoryCatalog(object):
+    """
+    The ``/repos.json`` listing kept in memory.
+
+    Each repository's entry is computed with
+    :py:func:`unicore.distribute.utils.format_repo` and tagged with the
+    HEAD commit it was computed for. Entries are updated when a
+    repository is cloned, pulled or written to. At most every
+    ``validate_interval`` seconds the catalog checks every repository's
+    HEAD, by reading its refs, and recomputes the entries that are out
+    of date, so that changes made by other processes show up too.
+    Repositories are checked out of ``pool``.
+
+    :param RepositoryPool pool:
+        The pool of the repositories to list.
+    :param float validate_interval:
+        The number of seconds between checks of the repositories' HEADs.
+    """
+
+    def __init__(self, pool, validate_interval=1, clock=time.time):
+        self.pool = pool
+        self.storage_path = pool.storage_path
+        self.validate_interval = validate_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.validate_lock = threading.Lock()
+        # name -> (sha, dict)
+        self.entries = {}
+        self.validated_at = None
+        self.builds = 0
+        self.validations = 0
+
+    def update(self, name, repo=None):
+        """
+        Recompute a repository's entry.
+
+        :param str name:
+            The name of the repository.
+        :param git.Repo repo:
+            The repository, checked out of the pool if not given.
+        """
+        if repo is None:
+            try:
+                with self.pool.repository(name) as repo:
+                    return self.update(name, repo)
+            except NotFound:
+                # NOTE: removed in the meantime
+                return self.remove(name)
+        if get_head_sha(repo) is None:
+            # NOTE: nothing to list before the first commit
+            self.remove(name)
+            return
+        entry = format_repo(repo)
+        with self.lock:
+            self.entries[name] = (entry['commit'], entry)
+            self.builds += 1
+
+    def remove(self, name):
+        """
+        Remove a repository's entry.
+
+        :param str name:
+            The name of the repository.
+        """
+        with self.lock:
+            self.entries.pop(name, None)
+
+    def validate(self, check_heads=True):
+        """
+        Add and remove entries to match the repositories on disk and
+        recompute the entries whose HEAD moved.
+
+        :param bool check_heads:
+            Whether to check the HEADs of repositories that already have
+            an entry.
+        """
+        with self.validate_lock:
+            names = set(get_repository_names(self.storage_path))
+            with self.lock:
+                for name in set(self.entries) - names:
+                    del self.entries[name]
+                shas = dict(
+                    (name, sha) for name, (sha, _) in self.entries.items())
+            for name in names:
+                if name in shas and not check_heads:
+                    continue
+                try:
+                    with self.pool.repository(name) as repo:
+                        if (name not in shas or
+                                get_head_sha(repo) != shas[name]):
+                            self.update(name, repo)
+                except NotFound:
+                    # NOTE: removed in the meantime
+                    self.remove(name)
+            if check_heads:
+                self.validated_at = self.clock()
+                self.validations += 1
+
+    def list(self, prefix=None, content_type=None):
+        """
+        Return the entries, sorted by name. Repositories added or removed
+        on disk are picked up straight away, HEADs are checked if they
+        were last checked more than ``validate_interval`` seconds ago.
+
+        :param str prefix:
+            Only return repositories whose name starts with this.
+        :param str content_type:
+            Only return repositories with a schema for this content type.
+        :returns: list
+        """
+        self.validate(check_heads=(
+            self.validated_at is None or
+            self.clock() - self.validated_at >= self.validate_interval))
+        with self.lock:
+            entries = [entry for _, (_, entry) in sorted(self.entries.items())]
+        if prefix:
+            entries = [entry for entry in entries
+                       if entry['name'].startswith(prefix)]
+        if content_type:
+            entries = [entry for entry in entries
+                       if content_type in entry['schemas']]
+        return entries
+
+    def stats(self):
+        """
+        Return the catalog's counters.
+
+        :returns: dict
+        """
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'builds': self.builds,
+                'validations': self.validations,
+            }
+
+
+_catalog_lock = threading.Lock()
+
+
+def get_repository_catalog(registry):
+    """
+    Return the :py:class:`RepositoryCatalog` for an application
+    registry, creating it from the settings if it does not exist yet.
+
+    :param pyramid.registry.Registry registry:
+        The application registry.
+    :returns: RepositoryCatalog
+    """
+    catalog = getattr(registry, 'repository_catalog', None)
+    if catalog is not None:
+        return catalog
+
+    with _catalog_lock:
+        catalog = getattr(registry, 'repository_catalog', None)
+        if catalog is None:
+            settings = registry.settings or {}
+            catalog = RepositoryCatalog(
+                get_repository_pool(registry),
+                validate_interval=float(settings.get(
+                    'repo.catalog_validate_interval', 1)))
+            registry.repository_catalog = catalog
+        return catalog
+
+
+def update_repository_catalog(event):
+    get_repository_catalog(event.registry).update(
+        os.path.basename(event.repo.working_dir), event.repo)
@@ -0,0 +1,430 @@
+import json
+import os
+import sqlite3
+import threading
+
+from git.exc import BadName, GitCommandError
+
+from unicore.distribute.storage import get_storage_manager
+from unicore.distribute.utils import (
+    get_commit, iterate_repository_objects, list_content_types,
+    load_model_class)
+
+
+# NOTE: bump when the tables change, stores are rebuilt from git then
+SCHEMA_VERSION = '1'
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS meta ('
+    '    key TEXT PRIMARY KEY,'
+    '    value TEXT)',
+    'CREATE TABLE IF NOT EXISTS content_types ('
+    '    name TEXT PRIMARY KEY)',
+    'CREATE TABLE IF NOT EXISTS objects ('
+    '    content_type TEXT,'
+    '    uuid TEXT,'
+    '    data TEXT,'
+    '    PRIMARY KEY (content_type, uuid))',
+]
+
+# NOTE: SQLite limits the number of parameters in a query
+MAX_PARAMETERS = 500
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def content_path_info(path, suffix):
+    """
+    Return the content type and uuid of an object stored at ``path`` or
+    ``None`` if the path is not an object's.
+
+    :param str path:
+        The path of the file in the repository.
+    :param str suffix:
+        The serializer's file suffix.
+    :returns: tuple
+    """
+    directory, _, file_name = path.rpartition('/')
+    if not directory or not file_name.endswith(suffix):
+        return None
+    return directory.replace('/', '.'), file_name[:-len(suffix)]
+
+
+class ContentStore(object):
+    """
+    A SQLite database holding every object in a repository, keyed by
+    content type and uuid, so that reads are indexed lookups rather
+    than reads of git objects.
+
+    The database records the commit it reflects and is brought up to
+    date with :py:meth:`sync`, which only applies what changed since
+    that commit. The commit and the objects are updated in a single
+    transaction so a read that finds the commit it expects also finds
+    that commit's objects. Reads return ``None`` when the database
+    doesn't reflect the commit asked for, callers then read from git.
+
+    :param str path:
+        The path of the database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # NOTE: bumped when the database is removed, connections opened
+        #       before that are to the removed file.
+        self.generation = 0
+        self.syncs = 0
+        self.rebuilds = 0
+
+    def connect(self):
+        dir_name = os.path.dirname(self.path)
+        if dir_name and not os.path.isdir(dir_name):
+            try:
+                os.makedirs(dir_name)
+            except OSError:  # pragma: no cover
+                # NOTE: another thread got here first
+                pass
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        # NOTE: readers don't block the writer and vice versa
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            conn.execute(statement)
+        return conn
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        generation = self.generation
+        if conn is not None and self.local.generation != generation:
+            # NOTE: sqlite connections can only be closed by the thread
+            #       that opened them.
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = self.local.conn = self.connect()
+            self.local.generation = generation
+        return conn
+
+    def read_meta(self, conn, key):
+        row = conn.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def write_meta(self, conn, key, value):
+        conn.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            (key, value))
+
+    def read_sha(self, conn):
+        if self.read_meta(conn, 'version') != SCHEMA_VERSION:
+            return None
+        return self.read_meta(conn, 'sha')
+
+    def sha(self):
+        """
+        Return the commit the store reflects or ``None`` if it is empty.
+
+        :returns: str
+        """
+        return self.read_sha(self.connection())
+
+    def sync(self, repo, commit_id=None):
+        """
+        Bring the store up to date with a commit, applying the changes
+        since the commit it reflects or rebuilding it if that commit is
+        gone or the schemas changed.
+
+        :param git.Repo repo:
+            The repository.
+        :param str commit_id:
+            The commit to sync to, defaults to HEAD.
+        :returns: bool
+            Whether the store changed.
+        """
+        commit = get_commit(repo, commit_id)
+        with self.lock:
+            conn = self.connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                sha = self.read_sha(conn)
+                if sha == commit.hexsha:
+                    conn.execute('ROLLBACK')
+                    return False
+                diff = self.diff(repo, sha, commit)
+                if diff is None or any(
+                        (path or '').startswith('_schemas/')
+                        for change in diff
+                        for path in self.change_paths(change)):
+                    self.rebuild(conn, repo, commit)
+                    self.rebuilds += 1
+                else:
+                    self.apply(conn, repo, commit, diff)
+                self.write_meta(conn, 'version', SCHEMA_VERSION)
+                self.write_meta(conn, 'sha', commit.hexsha)
+                conn.execute('COMMIT')
+                self.syncs += 1
+                return True
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def diff(self, repo, sha, commit):
+        if sha is None:
+            return None
+        try:
+            return repo.commit(sha).diff(commit)
+        except (BadName, ValueError, GitCommandError):
+            # NOTE: the recorded commit is gone, history was rewritten
+            return None
+
+    def change_paths(self, change):
+        return [blob.path for blob in (change.a_blob, change.b_blob)
+                if blob is not None]
+
+    def rebuild(self, conn, repo, commit):
+        conn.execute('DELETE FROM content_types')
+        conn.execute('DELETE FROM objects')
+        conn.executemany(
+            'INSERT INTO content_types (name) VALUES (?)',
+            [(name,) for name in list_content_types(repo, commit.hexsha)])
+        conn.executemany(
+            'INSERT INTO objects (content_type, uuid, data) '
+            'VALUES (?, ?, ?)',
+            ((obj['content_type'], obj['data']['uuid'],
+              json.dumps(obj['data']))
+             for obj in iterate_repository_objects(repo, commit.hexsha)))
+
+    def apply(self, conn, repo, commit, diff):
+        storage_manager = get_storage_manager(repo)
+        serializer = storage_manager.serializer
+        suffix = '.%s' % (serializer.suffix,)
+        content_types = set(
+            row[0] for row in conn.execute('SELECT name FROM content_types'))
+        for change in diff:
+            if change.a_blob is not None:
+                info = content_path_info(change.a_blob.path, suffix)
+                if info is not None and info[0] in content_types:
+                    conn.execute(
+                        'DELETE FROM objects '
+                        'WHERE content_type = ? AND uuid = ?', info)
+            if change.b_blob is not None:
+                info = content_path_info(change.b_blob.path, suffix)
+                if info is None or info[0] not in content_types:
+                    continue
+                content_type, uuid = info
+                model_class = load_model_class(
+                    repo, content_type, commit.hexsha)
+                model = serializer.deserialize(
+                    model_class, change.b_blob.data_stream.read())
+                conn.execute(
+                    'INSERT OR REPLACE INTO objects '
+                    '(content_type, uuid, data) VALUES (?, ?, ?)',
+                    (content_type, uuid, json.dumps(dict(model))))
+
+    def has_content_type(self, conn, content_type):
+        return conn.execute(
+            'SELECT 1 FROM content_types WHERE name = ?',
+            (content_type,)).fetchone() is not None
+
+    def uuids(self, sha, content_type):
+        """
+        Return the sorted uuids of a content type's objects.
+
+        :param str sha:
+            The commit to read from.
+        :param str content_type:
+            The content type.
+        :returns: list
+            ``None`` if the store doesn't reflect ``sha`` or the content
+            type doesn't exist.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN')
+        try:
+            if (self.read_sha(conn) != sha or
+                    not self.has_content_type(conn, content_type)):
+                return None
+            return [row[0] for row in conn.execute(
+                'SELECT uuid FROM objects WHERE content_type = ? '
+                'ORDER BY uuid', (content_type,))]
+        finally:
+            conn.execute('ROLLBACK')
+
+    def get(self, sha, content_type, uuid):
+        """
+        Return an object.
+
+        :param str sha:
+            The commit to read from.
+        :param str content_type:
+            The content type.
+        :param str uuid:
+            The object's uuid.
+        :returns: dict
+            ``None`` if the store doesn't reflect ``sha`` or the object
+            doesn't exist.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN')
+        try:
+            if self.read_sha(conn) != sha:
+                return None
+            row = conn.execute(
+                'SELECT data FROM objects '
+                'WHERE content_type = ? AND uuid = ?',
+                (content_type, uuid)).fetchone()
+            return json.loads(row[0]) if row is not None else None
+        finally:
+            conn.execute('ROLLBACK')
+
+    def select(self, conn, content_type, uuids):
+        for chunk in chunked(uuids, MAX_PARAMETERS):
+            rows = dict(conn.execute(
+                'SELECT uuid, data FROM objects '
+                'WHERE content_type = ? AND uuid IN (%s)' % (
+                    ', '.join('?' * len(chunk)),),
+                [content_type] + list(chunk)))
+            for uuid in chunk:
+                if uuid in rows:
+                    yield rows[uuid]
+
+    def objects(self, sha, content_type, uuids):
+        """
+        Return objects in the order of ``uuids``, skipping missing ones.
+
+        :param str sha:
+            The commit to read from.
+        :param str content_type:
+            The content type.
+        :param list uuids:
+            The uuids of the objects.
+        :returns: list
+            ``None`` if the store doesn't reflect ``sha``.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN')
+        try:
+            if self.read_sha(conn) != sha:
+                return None
+            return [json.loads(data)
+                    for data in self.select(conn, content_type, uuids)]
+        finally:
+            conn.execute('ROLLBACK')
+
+    def iterate_json(self, sha, content_type, uuids):
+        """
+        Return a generator of the JSON encoded objects in the order of
+        ``uuids``, read in a single transaction on a connection of its
+        own so that it can be consumed while streaming a response.
+
+        :param str sha:
+            The commit to read from.
+        :param str content_type:
+            The content type.
+        :param list uuids:
+            The uuids of the objects.
+        :returns: generator
+            ``None`` if the store doesn't reflect ``sha``.
+        """
+        conn = self.connect()
+        conn.execute('BEGIN')
+        if self.read_sha(conn) != sha:
+            conn.execute('ROLLBACK')
+            conn.close()
+            return None
+
+        def iterate():
+            try:
+                for data in self.select(conn, content_type, uuids):
+                    yield data.encode('utf-8')
+            finally:
+                conn.execute('ROLLBACK')
+                conn.close()
+
+        return iterate()
+
+    def destroy(self):
+        """
+        Remove the database.
+        """
+        with self.lock:
+            conn = getattr(self.local, 'conn', None)
+            if conn is not None:
+                conn.close()
+                self.local.conn = None
+            # NOTE: other threads reopen theirs on their next read
+            self.generation += 1
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.remove(self.path + suffix)
+                except OSError:
+                    pass
+
+    def stats(self):
+        """
+        Return the store's counters.
+
+        :returns: dict
+        """
+        return {
+            'sha': self.sha(),
+            'syncs': self.syncs,
+            'rebuilds': self.rebuilds,
+        }
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_content_store(config, repo_name):
+    """
+    Return the :py:class:`ContentStore` for a repository, kept in
+    ``content_store.dir``, or ``None`` if the content store is not
+    enabled.
+
+    :param dict config:
+        The app configuration
+    :param str repo_name:
+        The name of the repository.
+    :returns: ContentStore
+    """
+    store_dir = config.get('content_store.dir')
+    if not store_dir:
+        return None
+
+    path = os.path.join(store_dir, '%s.sqlite' % (repo_name,))
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = ContentStore(path)
+            _stores[path] = store
+        return store
+
+
+def refresh_content_store(store, repo, sha):
+    """
+    Sync a content store if ``sha`` is the repository's HEAD and the
+    store is behind, the repository may have been pulled by another
+    process.
+
+    :param ContentStore store:
+        The store.
+    :param git.Repo repo:
+        The repository.
+    :param str sha:
+        The commit about to be read from.
+    """
+    if store.sha() != sha and get_commit(repo).hexsha == sha:
+        store.sync(repo, sha)
+
+
+def sync_content_store(event):
+    store = get_content_store(
+        event.config, os.path.basename(event.repo.working_dir))
+    if store is not None:
+        store.sync(event.repo)
@@ -1,18 +1,33 @@
 from git import Repo
 
+from pyramid.threadlocal import get_current_registry
+
 
 class RepositoryEvent(object):
 
-    def __init__(self, config, repo=None, repo_dir=None, repo_url=None):
+    def __init__(self, config, repo=None, repo_dir=None, repo_url=None,
+                 registry=None):
         self.config = config
         if repo is None:
             repo = Repo(repo_dir)
         self.repo = repo
         self.repo_url = repo_url
+        # NOTE: the registry the event is published on, for subscribers
+        #       that need the app's repository pool. Pass it when
+        #       publishing from outside a request.
+        if registry is None:
+            registry = get_current_registry()
+        self.registry = registry
 
 
 class RepositoryCloned(RepositoryEvent):
-    pass
+
+    def __init__(self, *args, **kwargs):
+        # NOTE: an optional ``progress(done, total)`` callable subscribers
+        #       can report their progress to, set when cloning in the
+        #       background.
+        self.progress = kwargs.pop('progress', None)
+        super(RepositoryCloned, self).__init__(*args, **kwargs)
 
 
 class RepositoryUpdated(RepositoryEvent):
@@ -26,6 +41,20 @@ class RepositoryUpdated(RepositoryEvent):
 class ContentTypeObjectUpdated(RepositoryEvent):
 
     def __init__(self, model, change_type, *args, **kwargs):
+        # NOTE: the commit the change landed in, if known. With group
+        #       commits it may hold other changes too.
+        self.commit = kwargs.pop('commit', None)
         super(ContentTypeObjectUpdated, self).__init__(*args, **kwargs)
         self.model = model
         self.change_type = change_type
+
+
+class ContentTypeObjectsUpdated(RepositoryUpdated):
+
+    def __init__(self, models, *args, **kwargs):
+        # NOTE: fired once for a batch of objects written as a single
+        #       commit, ``models`` is a list of ``(action, model)`` tuples.
+        #       Subscribers to RepositoryUpdated get it too, ``changes``
+        #       is the commit's diff.
+        super(ContentTypeObjectsUpdated, self).__init__(*args, **kwargs)
+        self.models = models
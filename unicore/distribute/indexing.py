@@ -0,0 +1,758 @@
+import fcntl
+import json
+import os
+import random
+import threading
+import time
+
+from ConfigParser import NoOptionError, NoSectionError
+from contextlib import contextmanager
+
+from elasticsearch import (
+    ElasticsearchException, RequestError, TransportError)
+
+from elasticgit.search import ESManager
+from elasticgit.storage import StorageManager
+
+from gitdb.exc import BadName
+
+from pyramid.exceptions import NotFound
+
+from unicore.distribute.storage import is_ancestor
+from unicore.distribute.utils import (
+    get_commit, get_es, get_index_prefix, get_mapping, iterate_model_objects,
+    list_content_type_uuids, list_content_types, load_model_class)
+
+INDEXED_SHA_SECTION = 'unicore-index "%s"'
+
+HEALTH_STATUSES = ('red', 'yellow', 'green')
+
+
+class BulkIndexError(ElasticsearchException):
+    """
+    Raised when Elasticsearch rejects documents in a ``_bulk`` request.
+
+    :param list errors:
+        The failed items from the ``_bulk`` response.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(BulkIndexError, self).__init__(
+            '%s document(s) failed to index: %s' % (
+                len(errors), errors[:5]))
+
+
+class IndexNotReady(ElasticsearchException):
+    """
+    Raised when an index does not become ready before the deadline.
+    """
+
+
+class ReadinessStats(object):
+    """
+    Counters for the time spent waiting for indexes to become ready.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waits = 0
+        self.timeouts = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds, ready=True):
+        with self.lock:
+            self.waits += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            if not ready:
+                self.timeouts += 1
+
+    def stats(self):
+        """
+        Return the counters.
+
+        :returns: dict
+        """
+        with self.lock:
+            return {
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'total_seconds': self.total_seconds,
+                'max_seconds': self.max_seconds,
+            }
+
+
+readiness_stats = ReadinessStats()
+
+
+def wait_for_index(es, index, timeout=30, status='yellow',
+                   initial_delay=0.1, max_delay=5,
+                   sleep=time.sleep, clock=time.time):
+    """
+    Block until an index's health is at least ``status`` or raise
+    :py:class:`IndexNotReady` once ``timeout`` seconds have passed.
+
+    The waiting is done by Elasticsearch through the cluster health API's
+    ``wait_for_status``. If the health request itself fails or comes back
+    early it is retried with exponential backoff and jitter.
+
+    :param elasticsearch.Elasticsearch es:
+        The Elasticsearch client.
+    :param str index:
+        The name of the index.
+    :param int timeout:
+        The number of seconds to wait for at most.
+    :param str status:
+        The minimum health status, ``yellow`` or ``green``.
+    :returns: float
+        The number of seconds spent waiting.
+    """
+    started_at = clock()
+    deadline = started_at + timeout
+    delay = initial_delay
+    while True:
+        remaining = deadline - clock()
+        if remaining <= 0:
+            readiness_stats.record(clock() - started_at, ready=False)
+            raise IndexNotReady(
+                'Index %s did not reach status %s within %s seconds.' % (
+                    index, status, timeout))
+
+        try:
+            health = es.cluster.health(
+                index=index, wait_for_status=status,
+                timeout='%ds' % (max(1, int(remaining)),),
+                request_timeout=remaining + 5)
+        except TransportError:
+            health = {}
+
+        if (not health.get('timed_out', True) and
+                HEALTH_STATUSES.index(health.get('status', 'red')) >=
+                HEALTH_STATUSES.index(status)):
+            seconds = clock() - started_at
+            readiness_stats.record(seconds)
+            return seconds
+
+        sleep(min(delay * random.uniform(0.5, 1.0),
+                  max(0, deadline - clock())))
+        delay = min(delay * 2, max_delay)
+
+
+class BulkIndexer(object):
+    """
+    Buffers index and delete operations and sends them to Elasticsearch
+    in ``_bulk`` requests of at most ``chunk_size`` documents or
+    ``max_chunk_bytes`` bytes, whichever is reached first.
+
+    Use it as a context manager to make sure the last chunk is sent::
+
+        with BulkIndexer(es, 'prefix-master') as indexer:
+            for model in models:
+                indexer.index(doc_type, model.uuid, dict(model))
+
+    :param elasticsearch.Elasticsearch es:
+        The Elasticsearch client.
+    :param str index:
+        The name of the index.
+    :param int chunk_size:
+        The maximum number of operations per request.
+    :param int max_chunk_bytes:
+        The maximum size of a request body in bytes.
+    """
+
+    def __init__(self, es, index, chunk_size=500,
+                 max_chunk_bytes=5 * 1024 * 1024):
+        self.es = es
+        self.index_name = index
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.lines = []
+        self.operations = 0
+        self.size = 0
+        self.indexed = 0
+        self.deleted = 0
+        self.requests = 0
+        self.started_at = time.time()
+        self.finished_at = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def add(self, action, document=None):
+        lines = [json.dumps(action)]
+        if document is not None:
+            lines.append(json.dumps(document))
+        data = ''.join('%s\n' % (line,) for line in lines)
+        if self.lines and (
+                self.operations >= self.chunk_size or
+                self.size + len(data) > self.max_chunk_bytes):
+            self.flush()
+        self.lines.append(data)
+        self.operations += 1
+        self.size += len(data)
+
+    def index(self, doc_type, doc_id, document):
+        """
+        Queue a document to be indexed.
+
+        :param str doc_type:
+            The document's mapping type.
+        :param str doc_id:
+            The document's id.
+        :param dict document:
+            The document.
+        """
+        self.add({'index': {
+            '_index': self.index_name,
+            '_type': doc_type,
+            '_id': doc_id,
+        }}, document)
+
+    def delete(self, doc_type, doc_id):
+        """
+        Queue a document to be removed from the index.
+
+        :param str doc_type:
+            The document's mapping type.
+        :param str doc_id:
+            The document's id.
+        """
+        self.add({'delete': {
+            '_index': self.index_name,
+            '_type': doc_type,
+            '_id': doc_id,
+        }})
+
+    def flush(self):
+        """
+        Send the buffered operations to Elasticsearch.
+
+        :raises BulkIndexError:
+            if any of the operations failed.
+        """
+        if not self.lines:
+            return
+        body = ''.join(self.lines)
+        self.lines = []
+        self.operations = 0
+        self.size = 0
+
+        response = self.es.bulk(body=body)
+        self.requests += 1
+        errors = []
+        for item in response.get('items', []):
+            [(op_type, result)] = item.items()
+            if op_type == 'delete' and result.get('status') == 404:
+                # NOTE: deleting a document that isn't there is not an error
+                continue
+            elif 'error' in result:
+                errors.append(item)
+            elif op_type == 'delete':
+                self.deleted += 1
+            else:
+                self.indexed += 1
+        if errors:
+            raise BulkIndexError(errors)
+
+    def close(self):
+        self.flush()
+        self.finished_at = time.time()
+
+    def stats(self):
+        """
+        Return the indexer's counters, including the number of
+        documents indexed per second.
+
+        :returns: dict
+        """
+        seconds = (self.finished_at or time.time()) - self.started_at
+        return {
+            'indexed': self.indexed,
+            'deleted': self.deleted,
+            'requests': self.requests,
+            'seconds': seconds,
+            'docs_per_second': (
+                (self.indexed + self.deleted) / seconds if seconds else None),
+        }
+
+
+@contextmanager
+def bulk_load_settings(es, index, enabled=True):
+    """
+    A context manager that disables refreshing and replicas on an index
+    for the duration of the block, for faster bulk loading. The original
+    settings are restored and the index refreshed afterwards.
+
+    :param elasticsearch.Elasticsearch es:
+        The Elasticsearch client.
+    :param str index:
+        The name of the index.
+    :param bool enabled:
+        Whether to change the settings at all.
+    """
+    if not enabled:
+        yield
+        return
+
+    settings = es.indices.get_settings(index=index)
+    index_settings = settings[index]['settings']['index']
+    original = {
+        'refresh_interval': index_settings.get('refresh_interval', '1s'),
+        'number_of_replicas': index_settings.get('number_of_replicas', 1),
+    }
+    es.indices.put_settings(index=index, body={'index': {
+        'refresh_interval': '-1',
+        'number_of_replicas': 0,
+    }})
+    try:
+        yield
+    finally:
+        es.indices.put_settings(index=index, body={'index': original})
+        es.indices.refresh(index=index)
+
+
+def get_bulk_indexer(es, index, config):
+    """
+    Return a :py:class:`BulkIndexer` configured with
+    ``es.bulk_chunk_size`` and ``es.bulk_max_chunk_bytes``.
+
+    :param elasticsearch.Elasticsearch es:
+        The Elasticsearch client.
+    :param str index:
+        The name of the index.
+    :param dict config:
+        The app configuration
+    :returns: BulkIndexer
+    """
+    return BulkIndexer(
+        es, index,
+        chunk_size=int(config.get('es.bulk_chunk_size', 500)),
+        max_chunk_bytes=int(config.get(
+            'es.bulk_max_chunk_bytes', 5 * 1024 * 1024)))
+
+
+def load_model_mappings(repo):
+    """
+    Return the model class and Elasticsearch mapping for each content
+    type in a repository along with the total number of objects.
+
+    :param Repo repo:
+        The git repository.
+    :returns: tuple
+    """
+    content_types = list_content_types(repo)
+    model_mappings = [(load_model_class(repo, content_type),
+                       get_mapping(repo, content_type))
+                      for content_type in content_types]
+    total = sum(len(list_content_type_uuids(repo, content_type))
+                for content_type in content_types)
+    return model_mappings, total
+
+
+def build_index(im, name, model_mappings, total, config, progress=None):
+    """
+    Create the index ``name`` and bulk load all of the objects in the
+    repository into it. The index is removed again if anything goes
+    wrong.
+
+    :param elasticgit.search.ESManager im:
+        The index manager for the repository.
+    :param str name:
+        The name of the index, without the repository's index prefix.
+    :param list model_mappings:
+        The model classes and mappings to index, see
+        :py:func:`load_model_mappings`.
+    :param int total:
+        The total number of objects, for reporting progress.
+    :param dict config:
+        The app configuration
+    :param callable progress:
+        Called with the number of objects indexed so far and ``total``.
+    :returns: dict
+    """
+    progress = progress or (lambda done, total: None)
+    index = im.index_name(name)
+    commit = get_commit(im.sm.repo)
+    im.create_index(name)
+    try:
+        wait_seconds = wait_for_index(
+            im.es, index,
+            timeout=int(config.get('es.ready_timeout', 30)),
+            status=config.get('es.ready_status', 'yellow'))
+
+        for model_class, mapping in model_mappings:
+            im.setup_custom_mapping(name, model_class, mapping)
+
+        progress(0, total)
+        indexer = get_bulk_indexer(im.es, index, config)
+        tune = config.get('es.bulk_load_settings', 'true').lower()
+        with bulk_load_settings(im.es, index, enabled=(tune == 'true')):
+            with indexer:
+                for model_class, _ in model_mappings:
+                    doc_type = im.get_mapping_type(
+                        model_class).get_mapping_type_name()
+                    # NOTE: read from the tree of the commit that is
+                    #       recorded as indexed, not the working copy.
+                    for model in iterate_model_objects(
+                            im.sm, model_class, commit):
+                        indexer.index(doc_type, model.uuid, dict(model))
+                        progress(indexer.indexed, total)
+        progress(indexer.indexed, total)
+    except ElasticsearchException:
+        im.destroy_index(name)
+        raise
+    # NOTE: the new index holds exactly this commit, record it even if
+    #       a later one was recorded for the index it replaces.
+    with get_index_lock(im.sm.repo):
+        set_indexed_sha(im.sm.repo, im.sm.active_branch(), commit.hexsha)
+    return dict(indexer.stats(), index=index, wait_seconds=wait_seconds)
+
+
+def swap_alias(es, alias, index):
+    """
+    Atomically point ``alias`` at ``index`` and delete the indexes it
+    pointed at before.
+
+    :param elasticsearch.Elasticsearch es:
+        The Elasticsearch client.
+    :param str alias:
+        The name of the alias.
+    :param str index:
+        The name of the index.
+    :returns: list
+        The names of the indexes that were replaced.
+    """
+    if es.indices.exists_alias(name=alias):
+        old_indexes = sorted(es.indices.get_alias(name=alias).keys())
+    elif es.indices.exists(index=alias):
+        # NOTE: an index from before aliases were used has the name we
+        #       want for the alias, it is removed in the same request
+        #       the alias is added in.
+        old_indexes = [alias]
+    else:
+        old_indexes = []
+
+    actions = [{'remove': {'index': old_index, 'alias': alias}}
+               for old_index in old_indexes if old_index != alias]
+    add = {'add': {'index': index, 'alias': alias}}
+    if alias not in old_indexes:
+        es.indices.update_aliases(body={'actions': actions + [add]})
+    else:
+        try:
+            es.indices.update_aliases(body={'actions': actions + [
+                {'remove_index': {'index': alias}}, add]})
+        except RequestError:
+            # NOTE: Elasticsearch before 6.4 does not know remove_index,
+            #       the index has to be deleted before the alias can be
+            #       added.
+            es.indices.delete(index=alias)
+            es.indices.update_aliases(body={'actions': actions + [add]})
+
+    for old_index in old_indexes:
+        if old_index not in (alias, index):
+            es.indices.delete(index=old_index)
+    return old_indexes
+
+
+def reindex_repository(repo, config, progress=None):
+    """
+    Rebuild a repository's index without downtime. The objects are
+    loaded into a new, versioned index which the branch's index name is
+    then pointed at as an alias. Until the alias is swapped the old
+    index keeps serving searches and it is left untouched if building
+    the new index fails.
+
+    :param Repo repo:
+        The git repository.
+    :param dict config:
+        The app configuration
+    :param callable progress:
+        Called with the number of objects indexed so far and the total.
+    :returns: dict
+    """
+    # load models and mappings before creating index in case of errors
+    model_mappings, total = load_model_mappings(repo)
+    sm = StorageManager(repo)
+    im = ESManager(
+        storage_manager=sm,
+        es=get_es(config),
+        index_prefix=get_index_prefix(repo.working_dir))
+    branch = sm.active_branch()
+    name = '%s-%d' % (branch, int(time.time() * 1000))
+    stats = build_index(im, name, model_mappings, total, config, progress)
+    alias = im.index_name(branch)
+    try:
+        replaced = swap_alias(im.es, alias, stats['index'])
+    except ElasticsearchException:
+        im.destroy_index(name)
+        raise
+    return dict(stats, alias=alias, replaced=replaced)
+
+
+def get_indexed_sha(repo, branch):
+    """
+    Return the last commit of a branch that was indexed, as recorded
+    in the repository's git config, or ``None``.
+
+    :param Repo repo:
+        The git repository.
+    :param str branch:
+        The name of the branch.
+    :returns: str
+    """
+    try:
+        return repo.config_reader().get(INDEXED_SHA_SECTION % (branch,), 'sha')
+    except (NoSectionError, NoOptionError):
+        return None
+
+
+def set_indexed_sha(repo, branch, sha):
+    """
+    Record the last commit of a branch that was indexed in the
+    repository's git config.
+
+    :param Repo repo:
+        The git repository.
+    :param str branch:
+        The name of the branch.
+    :param str sha:
+        The commit's hexsha.
+    """
+    writer = repo.config_writer()
+    try:
+        writer.set_value(INDEXED_SHA_SECTION % (branch,), 'sha', sha)
+    finally:
+        writer.release()
+
+
+INDEX_LOCK_FILE = 'unicore-index.lock'
+
+
+class IndexLock(object):
+    """
+    A reentrant lock that serializes updates to a repository's index
+    across threads and, with :py:func:`fcntl.flock` on a file in the git
+    directory, across processes. The web app, ``poll-daemon`` and
+    ``reindex`` all update the same indexes.
+
+    :param str path:
+        The path of the lock file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.fp = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self.depth == 0:
+            fp = None
+            try:
+                fp = open(self.path, 'a')
+                fcntl.flock(fp, fcntl.LOCK_EX)
+            except (IOError, OSError):
+                if fp is not None:
+                    fp.close()
+                self.lock.release()
+                raise
+            self.fp = fp
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            # NOTE: closing the file releases the flock
+            fp, self.fp = self.fp, None
+            fp.close()
+        self.lock.release()
+
+
+_index_locks = {}
+_index_locks_lock = threading.Lock()
+
+
+def get_index_lock(repo):
+    """
+    Return the lock that serializes updates to a repository's index and
+    to the indexed commit recorded for it, so that concurrent updates,
+    in this process or another, don't index the same changes, fight
+    over ``.git/config.lock`` or move the recorded commit back.
+
+    :param Repo repo:
+        The git repository.
+    :returns: IndexLock
+    """
+    key = os.path.realpath(repo.git_dir)
+    with _index_locks_lock:
+        lock = _index_locks.get(key)
+        if lock is None:
+            lock = _index_locks[key] = IndexLock(
+                os.path.join(key, INDEX_LOCK_FILE))
+        return lock
+
+
+def advance_indexed_sha(repo, branch, commit):
+    """
+    Record ``commit`` as the last commit of a branch that was indexed,
+    unless a later commit was recorded already.
+
+    :param Repo repo:
+        The git repository.
+    :param str branch:
+        The name of the branch.
+    :param git.Commit commit:
+        The commit.
+    :returns: bool
+    """
+    with get_index_lock(repo):
+        indexed_sha = get_indexed_sha(repo, branch)
+        if indexed_sha == commit.hexsha:
+            return False
+        if indexed_sha is not None:
+            try:
+                indexed_commit = repo.commit(indexed_sha)
+            except (BadName, ValueError):
+                indexed_commit = None
+            if (indexed_commit is not None and
+                    is_ancestor(repo, commit, indexed_commit)):
+                return False
+        set_indexed_sha(repo, branch, commit.hexsha)
+        return True
+
+
+def advance_indexed_sha_for_paths(repo, branch, commit, paths):
+    """
+    Record ``commit`` as the last commit of a branch that was indexed
+    if its parent was and ``paths`` are all it changed, for when only
+    the objects at ``paths`` were indexed.
+
+    :param Repo repo:
+        The git repository.
+    :param str branch:
+        The name of the branch.
+    :param git.Commit commit:
+        The commit.
+    :param list paths:
+        The paths of the objects that were indexed.
+    :returns: bool
+    """
+    if not commit.parents:
+        return False
+    parent = commit.parents[0]
+    with get_index_lock(repo):
+        if get_indexed_sha(repo, branch) != parent.hexsha:
+            return False
+        changed = set()
+        for diff in parent.diff(commit):
+            changed.update(filter(None, [diff.a_path, diff.b_path]))
+        if not changed.issubset(paths):
+            return False
+        set_indexed_sha(repo, branch, commit.hexsha)
+        return True
+
+
+def update_index(repo, config, branch, changes=None):
+    """
+    Bring a branch's index up to date with the branch's latest commit.
+
+    The changes are read from the diff between the last indexed commit
+    recorded in the repository's git config and the branch's latest
+    commit, falling back to ``changes`` if no commit was recorded. The
+    objects are read from the commit's tree, the working tree is not
+    touched. The recorded commit is only moved on once all changes have
+    been indexed, so a failed update is retried in full next time.
+
+    Updates of a repository are serialized with
+    :py:func:`get_index_lock` and never move the recorded commit back
+    to an earlier one.
+
+    :param Repo repo:
+        The git repository.
+    :param dict config:
+        The app configuration
+    :param str branch:
+        The name of the branch.
+    :param git.diff.DiffIndex changes:
+        The changes to index if no commit was recorded.
+    :returns: dict
+    """
+    with get_index_lock(repo):
+        commit = repo.heads[branch].commit
+        indexed_sha = get_indexed_sha(repo, branch)
+        if indexed_sha == commit.hexsha:
+            return {'skipped': True, 'commit': commit.hexsha}
+
+        # NOTE: the commits deleted and renamed paths are read from, the
+        #       parents when changes are passed in for lack of anything better
+        a_shas = [parent.hexsha for parent in commit.parents]
+        if indexed_sha is not None:
+            try:
+                indexed_commit = repo.commit(indexed_sha)
+                changes = indexed_commit.diff(commit)
+                a_shas = [indexed_commit.hexsha]
+            except (BadName, ValueError):
+                # NOTE: the recorded commit is gone, history was rewritten
+                pass
+
+        sm = StorageManager(repo)
+        im = ESManager(
+            storage_manager=sm,
+            es=get_es(config),
+            index_prefix=get_index_prefix(repo.working_dir))
+        # (commit, content type) -> model class
+        model_classes = {}
+
+        def path_info(path, shas):
+            try:
+                directory, file_name = path.rsplit('/', 1)
+                uuid, suffix = file_name.split('.', 1)
+            except ValueError:
+                return None
+            content_type = directory.replace('/', '.')
+            for sha in shas:
+                key = (sha, content_type)
+                if key not in model_classes:
+                    try:
+                        model_classes[key] = load_model_class(
+                            repo, content_type, sha)
+                    except NotFound:
+                        model_classes[key] = None
+                if model_classes[key] is not None:
+                    return model_classes[key], uuid
+            return None
+
+        with get_bulk_indexer(im.es, im.index_name(branch), config) as indexer:
+            for diff in (changes or []):
+                if diff.deleted_file or diff.renamed:
+                    # NOTE: the schema may have been removed along with the
+                    #       objects, look it up where the objects still exist
+                    info = path_info(
+                        diff.a_blob.path, a_shas + [commit.hexsha])
+                    if info is not None:
+                        model_class, uuid = info
+                        indexer.delete(
+                            im.get_mapping_type(
+                                model_class).get_mapping_type_name(),
+                            uuid)
+                if not diff.deleted_file:
+                    info = path_info(diff.b_blob.path, [commit.hexsha])
+                    if info is not None:
+                        model_class, uuid = info
+                        model = sm.serializer.deserialize(
+                            model_class, diff.b_blob.data_stream.read())
+                        indexer.index(
+                            im.get_mapping_type(
+                                model_class).get_mapping_type_name(),
+                            uuid, dict(model))
+
+        advance_indexed_sha(repo, branch, commit)
+        return dict(indexer.stats(), skipped=False, commit=commit.hexsha)
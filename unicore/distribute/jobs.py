@@ -0,0 +1,291 @@
+import Queue
+import threading
+import time
+
+from collections import OrderedDict
+from uuid import uuid4
+
+
+def format_error(error):
+    """
+    Return a description of an exception raised by a job, preferring
+    git's own output for failed git commands.
+
+    :param Exception error:
+        The exception.
+    :returns: str
+    """
+    stderr = getattr(error, 'stderr', None)
+    if stderr:
+        return '%s: %s' % (type(error).__name__, stderr)
+    return '%s: %s' % (type(error).__name__, error)
+
+
+class Job(object):
+    """
+    A unit of work run in the background by a :py:class:`JobManager`.
+
+    Jobs move from ``pending`` to ``running`` and end up either
+    ``completed`` or ``failed``. While running, the work can report
+    which phase it is in and how many of the phase's items have been
+    processed so far.
+
+    :param str kind:
+        What sort of job this is, ``clone`` for example.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+
+    def __init__(self, kind):
+        self.id = uuid4().hex
+        self.kind = kind
+        self.lock = threading.Lock()
+        self.status = self.PENDING
+        self.phase = None
+        self.done = 0
+        self.total = None
+        self.error = None
+        self.result = {}
+        self.created_at = time.time()
+        self.started_at = None
+        self.phase_started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in (self.COMPLETED, self.FAILED)
+
+    def start(self):
+        with self.lock:
+            self.status = self.RUNNING
+            self.started_at = time.time()
+
+    def set_phase(self, phase, total=None):
+        """
+        Start a new phase of the job, resetting the progress counters.
+
+        :param str phase:
+            The name of the phase.
+        :param int total:
+            The number of items the phase will process, if known.
+        """
+        with self.lock:
+            self.phase = phase
+            self.done = 0
+            self.total = total
+            self.phase_started_at = time.time()
+
+    def progress(self, done, total=None):
+        """
+        Report the number of items processed in the current phase.
+
+        :param int done:
+            The number of items processed so far.
+        :param int total:
+            The number of items the phase will process, if known.
+        """
+        with self.lock:
+            self.done = done
+            if total is not None:
+                self.total = total
+
+    def complete(self, **result):
+        with self.lock:
+            self.status = self.COMPLETED
+            self.result.update(result)
+            self.finished_at = time.time()
+
+    def fail(self, error):
+        with self.lock:
+            self.status = self.FAILED
+            self.error = error
+            self.finished_at = time.time()
+
+    def to_dict(self):
+        """
+        Return the job's state as a JSON serializable dictionary.
+        ``throughput`` is the number of items per second processed in
+        the current (or last) phase.
+
+        :returns: dict
+        """
+        with self.lock:
+            end = self.finished_at or time.time()
+            elapsed = (end - self.phase_started_at
+                       if self.phase_started_at else 0)
+            return {
+                'id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'phase': self.phase,
+                'progress': {
+                    'done': self.done,
+                    'total': self.total,
+                },
+                'throughput': self.done / elapsed if elapsed else None,
+                'error': self.error,
+                'result': dict(self.result),
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
+
+
+class JobManager(object):
+    """
+    Runs jobs on a fixed number of daemon worker threads and keeps
+    track of their state.
+
+    Jobs only live in memory, the state of a job is only available from
+    the process that ran it.
+
+    :param int workers:
+        The number of worker threads.
+    :param int max_jobs:
+        The maximum number of finished jobs to remember.
+    """
+
+    def __init__(self, workers=2, max_jobs=100):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.threads = []
+        # job id -> Job
+        self.jobs = OrderedDict()
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        # NOTE: must be called with the lock held. Threads are only
+        #       started once there's work for them to do.
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, kind, func, *args, **kwargs):
+        """
+        Queue ``func`` to be run in the background. ``func`` is called
+        with the :py:class:`Job` as its first argument followed by
+        ``args`` and ``kwargs``. Its return value, if a dictionary, is
+        stored as the job's result.
+
+        :param str kind:
+            What sort of job this is.
+        :param callable func:
+            The work to do.
+        :returns: Job
+        """
+        job = Job(kind)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.trim()
+            self.start()
+        self.queue.put((job, func, args, kwargs))
+        return job
+
+    def trim(self):
+        # NOTE: must be called with the lock held
+        finished = [job_id for job_id, job in self.jobs.items()
+                    if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_jobs)]:
+            del self.jobs[job_id]
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            job, func, args, kwargs = item
+            job.start()
+            try:
+                result = func(job, *args, **kwargs)
+            except Exception, e:
+                job.fail(format_error(e))
+                with self.lock:
+                    self.failed += 1
+            else:
+                if not isinstance(result, dict):
+                    result = {}
+                job.complete(**result)
+                with self.lock:
+                    self.completed += 1
+            finally:
+                self.queue.task_done()
+
+    def get(self, job_id):
+        """
+        Return a job by id or ``None`` if it is not known.
+
+        :param str job_id:
+            The job's id.
+        :returns: Job
+        """
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def join(self):
+        """
+        Block until all queued jobs have finished.
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        Stop the worker threads once the queued jobs have finished.
+        """
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def stats(self):
+        """
+        Return the manager's counters.
+
+        :returns: dict
+        """
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'queued': self.queue.qsize(),
+                'running': len([job for job in self.jobs.values()
+                                if job.status == Job.RUNNING]),
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+
+
+_manager_lock = threading.Lock()
+
+
+def get_job_manager(registry):
+    """
+    Return the :py:class:`JobManager` for an application registry,
+    creating it from the settings if it does not exist yet.
+
+    :param pyramid.registry.Registry registry:
+        The application registry.
+    :returns: JobManager
+    """
+    manager = getattr(registry, 'job_manager', None)
+    if manager is not None:
+        return manager
+
+    with _manager_lock:
+        manager = getattr(registry, 'job_manager', None)
+        if manager is None:
+            settings = registry.settings or {}
+            manager = JobManager(
+                workers=int(settings.get('jobs.workers', 2)),
+                max_jobs=int(settings.get('jobs.max_jobs', 100)))
+            registry.job_manager = manager
+        return manager
@@ -0,0 +1,207 @@
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from unicore.distribute.utils import get_repository
+
+
+class RepositoryPool(object):
+    """
+    A bounded, thread-safe pool of open :py:class:`git.Repo` objects
+    keyed by repository name.
+
+    Opening a :py:class:`git.Repo` is cheap but the ``git cat-file``
+    helper processes it starts on first use are not. The pool keeps
+    idle handles around so that subsequent requests for the same
+    repository can reuse them. A handle is only ever used by one
+    thread at a time; concurrent requests for the same repository
+    each get their own handle.
+
+    :param str storage_path:
+        The directory the repositories live in.
+    :param int max_size:
+        The maximum number of idle handles to keep open.
+    :param int idle_timeout:
+        The number of seconds an idle handle is kept open for.
+    """
+
+    def __init__(self, storage_path, max_size=32, idle_timeout=300):
+        self.storage_path = storage_path
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # (name, id(repo)) -> (repo, inode, last_used)
+        self.idle = OrderedDict()
+        self.generations = {}
+        # id(repo) -> generation, for handles currently checked out
+        self.checked_out = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def path(self, name):
+        return os.path.join(self.storage_path, name)
+
+    def git_dir_inode(self, repo):
+        try:
+            return os.stat(repo.git_dir).st_ino
+        except OSError:
+            return None
+
+    def acquire(self, name):
+        """
+        Check out a repository handle from the pool, opening a new one
+        if no idle handle is available.
+
+        :param str name:
+            The name of the repository.
+        :returns: git.Repo
+        """
+        now = time.time()
+        with self.lock:
+            self.expire(now)
+            for key in reversed(self.idle.keys()):
+                if key[0] != name:
+                    continue
+                repo, inode, last_used = self.idle.pop(key)
+                # NOTE: guard against the repository having been removed
+                #       or replaced on disk behind our back.
+                if inode is not None and self.git_dir_inode(repo) == inode:
+                    self.hits += 1
+                    self.checked_out[id(repo)] = self.generations.get(
+                        name, 0)
+                    return repo
+                self.close(repo)
+                self.evictions += 1
+            self.misses += 1
+            generation = self.generations.get(name, 0)
+
+        repo = get_repository(self.path(name))
+        with self.lock:
+            self.checked_out[id(repo)] = generation
+        return repo
+
+    def release(self, name, repo):
+        """
+        Return a repository handle to the pool.
+
+        :param str name:
+            The name of the repository.
+        :param git.Repo repo:
+            The handle previously returned by :py:meth:`acquire`.
+        """
+        with self.lock:
+            generation = self.checked_out.pop(id(repo), None)
+            if (self.max_size < 1 or
+                    generation != self.generations.get(name, 0)):
+                self.close(repo)
+                return
+            self.idle[(name, id(repo))] = (
+                repo, self.git_dir_inode(repo), time.time())
+            while len(self.idle) > self.max_size:
+                _, (evicted, _, _) = self.idle.popitem(last=False)
+                self.close(evicted)
+                self.evictions += 1
+
+    @contextmanager
+    def repository(self, name):
+        """
+        A context manager that checks out a repository handle for the
+        duration of the block.
+
+        :param str name:
+            The name of the repository.
+        """
+        repo = self.acquire(name)
+        try:
+            yield repo
+        finally:
+            self.release(name, repo)
+
+    def invalidate(self, name):
+        """
+        Close all idle handles for a repository and make sure handles
+        currently checked out are not returned to the pool. Call this
+        whenever a repository is cloned, deleted or pulled.
+
+        :param str name:
+            The name of the repository.
+        """
+        with self.lock:
+            self.generations[name] = self.generations.get(name, 0) + 1
+            self.invalidations += 1
+            for key in [key for key in self.idle if key[0] == name]:
+                repo, _, _ = self.idle.pop(key)
+                self.close(repo)
+
+    def clear(self):
+        """
+        Close all idle handles.
+        """
+        with self.lock:
+            while self.idle:
+                _, (repo, _, _) = self.idle.popitem()
+                self.close(repo)
+
+    def expire(self, now):
+        # NOTE: must be called with the lock held
+        deadline = now - self.idle_timeout
+        for key, (repo, _, last_used) in self.idle.items():
+            if last_used < deadline:
+                del self.idle[key]
+                self.close(repo)
+                self.evictions += 1
+
+    def close(self, repo):
+        # NOTE: this terminates the persistent ``git cat-file`` processes
+        repo.git.clear_cache()
+
+    def stats(self):
+        """
+        Return the pool's counters.
+
+        :returns: dict
+        """
+        with self.lock:
+            return {
+                'size': len(self.idle),
+                'max_size': self.max_size,
+                'in_use': len(self.checked_out),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+_pool_lock = threading.Lock()
+
+
+def get_repository_pool(registry):
+    """
+    Return the :py:class:`RepositoryPool` for an application registry,
+    creating it from the settings if it does not exist yet.
+
+    :param pyramid.registry.Registry registry:
+        The application registry.
+    :returns: RepositoryPool
+    """
+    pool = getattr(registry, 'repository_pool', None)
+    if pool is not None:
+        return pool
+
+    with _pool_lock:
+        pool = getattr(registry, 'repository_pool', None)
+        if pool is None:
+            settings = registry.settings or {}
+            pool = RepositoryPool(
+                settings.get('repo.storage_path'),
+                max_size=int(settings.get('repo.pool_size', 32)),
+                idle_timeout=int(
+                    settings.get('repo.pool_idle_timeout', 300)))
+            registry.repository_pool = pool
+        return pool
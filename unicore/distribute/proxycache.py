@@ -0,0 +1,428 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict, namedtuple
+from urlparse import parse_qsl
+
+from unicore.distribute.utils import get_index_prefix
+
+
+CACHEABLE_ENDPOINTS = frozenset(['_search', '_count'])
+
+# NOTE: the key responses for requests that aren't limited to specific
+#       indexes are invalidated under.
+ANY_INDEX = '_any'
+
+MARKER_DIR = 'invalidated'
+
+
+CachedResponse = namedtuple(
+    'CachedResponse',
+    ['created_at', 'indexes', 'status', 'headerlist', 'body'])
+
+
+def request_indexes(parts):
+    """
+    Return the indexes a proxied request reads from or ``None`` if it
+    reads from all of them, ``_search`` or ``_all/_search`` for
+    example.
+
+    :param str parts:
+        The path of the request relative to the upstream URL.
+    :returns: list
+    """
+    first = parts.lstrip('/').split('/', 1)[0]
+    if not first or first.startswith('_'):
+        return None
+    indexes = sorted(set(first.lower().split(',')))
+    if any('*' in index for index in indexes):
+        return None
+    return indexes
+
+
+def is_cacheable(method, parts, query_string):
+    """
+    Return whether a proxied request only reads from Elasticsearch and
+    its response can be cached.
+
+    :param str method:
+        The HTTP method.
+    :param str parts:
+        The path of the request relative to the upstream URL.
+    :param str query_string:
+        The request's query string.
+    :returns: bool
+    """
+    if method not in ('GET', 'POST'):
+        return False
+    endpoint = parts.rstrip('/').rsplit('/', 1)[-1]
+    if endpoint not in CACHEABLE_ENDPOINTS:
+        return False
+    # NOTE: scrolling keeps a cursor open upstream
+    params = dict(parse_qsl(query_string, keep_blank_values=True))
+    return 'scroll' not in params
+
+
+def normalize_body(body):
+    """
+    Return a request body with JSON objects' keys sorted and insignificant
+    whitespace removed, so that equivalent queries share a cache entry.
+
+    :param str body:
+        The request body.
+    :returns: str
+    """
+    if not body:
+        return ''
+    try:
+        return json.dumps(
+            json.loads(body), sort_keys=True, separators=(',', ':'))
+    except ValueError:
+        return body
+
+
+def cache_key(parts, query_string, body, accept_encoding=''):
+    """
+    Return the cache key for a proxied request.
+
+    :param str parts:
+        The path of the request relative to the upstream URL.
+    :param str query_string:
+        The request's query string.
+    :param str body:
+        The request body.
+    :param str accept_encoding:
+        The request's ``Accept-Encoding`` header, bodies are passed
+        through as is so compressed and uncompressed ones are cached
+        separately.
+    :returns: str
+    """
+    query = sorted(parse_qsl(query_string, keep_blank_values=True))
+    return hashlib.sha1('\n'.join([
+        parts.strip('/'),
+        json.dumps(query),
+        normalize_body(body),
+        accept_encoding or '',
+    ])).hexdigest()
+
+
+def invalidation_keys(indexes):
+    """
+    Return the keys an entry for ``indexes`` is invalidated under. An
+    index named ``repo-master-123`` could belong to a repository named
+    ``repo``, ``repo-master`` or ``repo-master-123`` so all of them are
+    returned.
+
+    :param list indexes:
+        The indexes, ``None`` for all of them.
+    :returns: list
+    """
+    if indexes is None:
+        return [ANY_INDEX]
+    keys = set()
+    for index in indexes:
+        segments = index.split('-')
+        keys.update('-'.join(segments[:i])
+                    for i in range(1, len(segments) + 1))
+    return sorted(keys)
+
+
+class ProxyCache(object):
+    """
+    A cache of responses to read-only Elasticsearch requests made
+    through the proxy.
+
+    Entries are kept in memory, least recently used first out, and
+    optionally in ``cache_dir`` so that processes sharing the directory
+    share the cache. An entry expires after ``ttl`` seconds or once
+    the index of a repository it read from is updated, see
+    :py:meth:`invalidate`. Updates only become visible in searches
+    after Elasticsearch refreshes the index, so responses to requests
+    made up to ``invalidation_delay`` seconds after an update are not
+    cached either.
+
+    :param float ttl:
+        The number of seconds entries are kept for.
+    :param int max_entries:
+        The maximum number of entries kept in memory.
+    :param int max_size:
+        The maximum total size in bytes of the bodies kept in memory,
+        and of the files in ``cache_dir``.
+    :param int max_entry_size:
+        The size in bytes above which bodies are not cached.
+    :param float invalidation_delay:
+        The number of seconds updates take to become searchable.
+    :param str cache_dir:
+        The directory to share entries and invalidations through.
+    """
+
+    def __init__(self, ttl=60, max_entries=1000, max_size=10 * 1024 * 1024,
+                 max_entry_size=1024 * 1024, invalidation_delay=1,
+                 cache_dir=None, clock=time.time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.invalidation_delay = invalidation_delay
+        self.cache_dir = cache_dir
+        self.clock = clock
+        self.lock = threading.Lock()
+        # key -> CachedResponse
+        self.entries = OrderedDict()
+        self.size = 0
+        # invalidation key -> time entries created before are stale
+        self.invalidated_at = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        if cache_dir is not None:
+            marker_dir = os.path.join(cache_dir, MARKER_DIR)
+            if not os.path.isdir(marker_dir):
+                os.makedirs(marker_dir)
+            self.disk_size = sum(size for _, _, size in self.disk_entries())
+
+    def last_invalidated(self, indexes):
+        keys = invalidation_keys(indexes)
+        last = max(self.invalidated_at.get(key, 0) for key in keys)
+        if self.cache_dir is not None:
+            for key in keys:
+                try:
+                    last = max(last, os.stat(self.marker_path(key)).st_mtime)
+                except OSError:
+                    pass
+        return last
+
+    def is_fresh(self, entry, now):
+        return (now - entry.created_at < self.ttl and
+                entry.created_at > self.last_invalidated(entry.indexes))
+
+    def get(self, key):
+        """
+        Return a fresh cached response or ``None``.
+
+        :param str key:
+            The key from :py:func:`cache_key`.
+        :returns: CachedResponse
+        """
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and self.is_fresh(entry, now):
+                self.entries[key] = entry
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self.size -= len(entry.body)
+
+        entry = self.read(key)
+        with self.lock:
+            if entry is not None and self.is_fresh(entry, now):
+                self.store(key, entry)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        return None
+
+    def put(self, key, indexes, started_at, status, headerlist, body):
+        """
+        Store a response, unless a repository it reads from was updated
+        after the request was made.
+
+        :param str key:
+            The key from :py:func:`cache_key`.
+        :param list indexes:
+            The indexes the request read from, see
+            :py:func:`request_indexes`.
+        :param float started_at:
+            The time the request was sent upstream.
+        :param int status:
+            The response's status code.
+        :param list headerlist:
+            The response's headers.
+        :param str body:
+            The response's body.
+        :returns: bool
+            Whether the response was stored.
+        """
+        if len(body) > self.max_entry_size:
+            return False
+        entry = CachedResponse(
+            started_at, indexes, status, list(headerlist), body)
+        with self.lock:
+            if not self.is_fresh(entry, self.clock()):
+                return False
+            self.store(key, entry)
+        if self.cache_dir is not None:
+            self.write(key, entry)
+        return True
+
+    def store(self, key, entry):
+        # NOTE: must be called with the lock held
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous.body)
+        self.entries[key] = entry
+        self.size += len(entry.body)
+        while self.entries and (len(self.entries) > self.max_entries or
+                                self.size > self.max_size):
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.body)
+            self.evictions += 1
+
+    def invalidate(self, prefix):
+        """
+        Expire the entries for a repository's indexes and for requests
+        that aren't limited to specific indexes.
+
+        :param str prefix:
+            The repository's index prefix, see
+            :py:func:`unicore.distribute.utils.get_index_prefix`.
+        """
+        invalidated_at = self.clock() + self.invalidation_delay
+        with self.lock:
+            for key in (prefix, ANY_INDEX):
+                self.invalidated_at[key] = max(
+                    self.invalidated_at.get(key, 0), invalidated_at)
+            self.invalidations += 1
+        if self.cache_dir is not None:
+            for key in (prefix, ANY_INDEX):
+                path = self.marker_path(key)
+                with open(path, 'a'):
+                    pass
+                os.utime(path, (invalidated_at, invalidated_at))
+
+    def marker_path(self, key):
+        return os.path.join(self.cache_dir, MARKER_DIR, key)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], '%s.cache' % (key,))
+
+    def read(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self.path(key), 'rb') as fp:
+                meta = json.loads(fp.readline())
+                body = fp.read()
+        except (IOError, OSError, ValueError):
+            return None
+        return CachedResponse(
+            meta['created_at'], meta['indexes'], meta['status'],
+            [tuple(header) for header in meta['headerlist']], body)
+
+    def write(self, key, entry):
+        path = self.path(key)
+        dir_name = os.path.dirname(path)
+        if not os.path.isdir(dir_name):
+            try:
+                os.makedirs(dir_name)
+            except OSError:  # pragma: no cover
+                # NOTE: another thread got here first
+                pass
+
+        meta = json.dumps({
+            'created_at': entry.created_at,
+            'indexes': entry.indexes,
+            'status': entry.status,
+            'headerlist': entry.headerlist,
+        })
+        fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(meta)
+            fp.write('\n')
+            fp.write(entry.body)
+        os.rename(tmp_path, path)
+
+        with self.lock:
+            self.disk_size += len(meta) + 1 + len(entry.body)
+            if self.disk_size > self.max_size:
+                self.evict_disk()
+
+    def disk_entries(self):
+        for dir_path, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if not file_name.endswith('.cache'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # pragma: no cover
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def evict_disk(self):
+        # NOTE: must be called with the lock held. Removes the oldest
+        #       entries until we're at 90% of max_size to avoid evicting
+        #       on every write.
+        entries = sorted(self.disk_entries(), key=lambda entry: entry[1])
+        self.disk_size = sum(size for _, _, size in entries)
+        target = self.max_size * 0.9
+        for path, _, size in entries:
+            if self.disk_size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:  # pragma: no cover
+                continue
+            self.disk_size -= size
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Return the cache's counters.
+
+        :returns: dict
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+            }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_proxy_cache(config):
+    """
+    Return the :py:class:`ProxyCache` configured with the ``proxy.cache_*``
+    settings or ``None`` if ``proxy.cache_enabled`` is not set.
+
+    :param dict config:
+        The app configuration
+    :returns: ProxyCache
+    """
+    if config.get('proxy.cache_enabled', 'false').lower() != 'true':
+        return None
+
+    options = (
+        float(config.get('proxy.cache_ttl', 60)),
+        int(config.get('proxy.cache_max_entries', 1000)),
+        int(config.get('proxy.cache_max_size', 10 * 1024 * 1024)),
+        int(config.get('proxy.cache_max_entry_size', 1024 * 1024)),
+        float(config.get('proxy.cache_invalidation_delay', 1)),
+        config.get('proxy.cache_dir') or None,
+    )
+    with _caches_lock:
+        cache = _caches.get(options)
+        if cache is None:
+            cache = ProxyCache(*options)
+            _caches[options] = cache
+        return cache
+
+
+def invalidate_proxy_cache(event):
+    cache = get_proxy_cache(event.config)
+    if cache is not None:
+        cache.invalidate(get_index_prefix(event.repo.working_dir))
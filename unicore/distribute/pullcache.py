@@ -0,0 +1,256 @@
+import json
+import os
+import tempfile
+import threading
+
+from unicore.distribute.utils import (
+    get_commit, get_repository_diff, pull_repository_files)
+
+
+class PullCache(object):
+    """
+    An on-disk cache of computed diff and pull payloads keyed by
+    repository name, payload kind and the commits the payload was
+    computed between.
+
+    The payloads are fully determined by the two commits so entries
+    never go stale, they are only ever evicted (oldest access first)
+    to keep the total size of the cache below ``max_size`` bytes.
+
+    :param str cache_dir:
+        The directory to store the payloads in.
+    :param int max_size:
+        The maximum total size of the cache in bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=100 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.size = sum(size for _, _, size in self.entries())
+
+    def path(self, repo_name, kind, from_sha, to_sha):
+        return os.path.join(
+            self.cache_dir, repo_name,
+            '%s-%s-%s.json' % (kind, from_sha, to_sha))
+
+    def get(self, repo_name, kind, from_sha, to_sha):
+        """
+        Return a cached payload or ``None``.
+
+        :param str repo_name:
+            The name of the repository.
+        :param str kind:
+            The kind of payload, ``diff`` or ``pull``.
+        :param str from_sha:
+            The full hexsha of the commit the client has.
+        :param str to_sha:
+            The full hexsha of the commit the payload brings it up to.
+        :returns: dict
+        """
+        path = self.path(repo_name, kind, from_sha, to_sha)
+        try:
+            with open(path, 'r') as fp:
+                payload = json.load(fp)
+            # NOTE: record the access time for eviction, atime is not
+            #       reliable on most mounts.
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        return payload
+
+    def put(self, repo_name, kind, from_sha, to_sha, payload):
+        """
+        Store a payload.
+
+        :param str repo_name:
+            The name of the repository.
+        :param str kind:
+            The kind of payload, ``diff`` or ``pull``.
+        :param str from_sha:
+            The full hexsha of the commit the client has.
+        :param str to_sha:
+            The full hexsha of the commit the payload brings it up to.
+        :param dict payload:
+            The JSON serializable payload.
+        """
+        path = self.path(repo_name, kind, from_sha, to_sha)
+        dir_name = os.path.dirname(path)
+        if not os.path.isdir(dir_name):
+            try:
+                os.makedirs(dir_name)
+            except OSError:  # pragma: no cover
+                # NOTE: another thread got here first
+                pass
+
+        data = json.dumps(payload)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(data)
+
+        with self.lock:
+            # NOTE: concurrent misses for the same key each store it,
+            #       only count the difference when replacing an entry.
+            try:
+                self.size -= os.stat(path).st_size
+            except OSError:
+                pass
+            os.rename(tmp_path, path)
+            self.size += len(data)
+            if self.size > self.max_size:
+                self.evict()
+
+    def entries(self):
+        for dir_path, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if not file_name.endswith('.json'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # pragma: no cover
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def evict(self):
+        # NOTE: must be called with the lock held. Removes the least
+        #       recently used entries until we're at 90% of max_size
+        #       to avoid evicting on every write.
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        self.size = sum(size for _, _, size in entries)
+        target = self.max_size * 0.9
+        for path, _, size in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:  # pragma: no cover
+                continue
+            self.size -= size
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Return the cache's counters.
+
+        :returns: dict
+        """
+        with self.lock:
+            return {
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_pull_cache(config):
+    """
+    Return the :py:class:`PullCache` configured with ``cache.pull_dir``
+    or ``None`` if pull caching is not enabled.
+
+    :param dict config:
+        The app configuration
+    :returns: PullCache
+    """
+    cache_dir = config.get('cache.pull_dir')
+    if not cache_dir:
+        return None
+
+    with _caches_lock:
+        cache = _caches.get(cache_dir)
+        if cache is None:
+            cache = PullCache(
+                cache_dir,
+                max_size=int(config.get(
+                    'cache.pull_max_size', 100 * 1024 * 1024)))
+            _caches[cache_dir] = cache
+        return cache
+
+
+def cached_repository_diff(cache, repo_name, repo, commit_id):
+    """
+    Return :py:func:`unicore.distribute.utils.get_repository_diff`,
+    from the cache if possible.
+
+    :param PullCache cache:
+        The cache.
+    :param str repo_name:
+        The name of the repository.
+    :param Repo repo:
+        The git repository.
+    :param str commit_id:
+        The commit to diff against.
+    :returns: dict
+    """
+    from_sha = get_commit(repo, commit_id).hexsha
+    to_sha = repo.head.commit.hexsha
+    payload = cache.get(repo_name, 'diff', from_sha, to_sha)
+    if payload is None:
+        payload = get_repository_diff(repo, from_sha)
+        if payload['current-index'] == to_sha:
+            cache.put(repo_name, 'diff', from_sha, to_sha, payload)
+    payload['previous-index'] = commit_id
+    return payload
+
+
+def cached_pull_repository_files(cache, repo_name, repo, commit_id):
+    """
+    Return :py:func:`unicore.distribute.utils.pull_repository_files`,
+    from the cache if possible.
+
+    :param PullCache cache:
+        The cache.
+    :param str repo_name:
+        The name of the repository.
+    :param Repo repo:
+        The git repository.
+    :param str commit_id:
+        The commit to pull changes since.
+    :returns: dict
+    """
+    from_sha = get_commit(repo, commit_id).hexsha
+    to_sha = repo.head.commit.hexsha
+    payload = cache.get(repo_name, 'pull', from_sha, to_sha)
+    if payload is None:
+        payload = pull_repository_files(repo, from_sha)
+        if payload['commit'] == to_sha:
+            cache.put(repo_name, 'pull', from_sha, to_sha, payload)
+    return payload
+
+
+def prewarm_pull_cache(cache, repo_name, repo, count):
+    """
+    Compute and cache the diff and pull payloads from each of the
+    last ``count`` commits up to the repository's HEAD.
+
+    :param PullCache cache:
+        The cache.
+    :param str repo_name:
+        The name of the repository.
+    :param Repo repo:
+        The git repository.
+    :param int count:
+        The number of commits to compute payloads for.
+    """
+    to_sha = repo.head.commit.hexsha
+    for commit in repo.iter_commits(to_sha, max_count=count + 1):
+        if commit.hexsha == to_sha:
+            continue
+        cached_repository_diff(cache, repo_name, repo, commit.hexsha)
+        cached_pull_repository_files(cache, repo_name, repo, commit.hexsha)
@@ -0,0 +1,129 @@
+import heapq
+import random
+
+
+class PollSchedule(object):
+    """
+    Decides when each repository is polled next.
+
+    Every repository has its own interval. It is halved, down to
+    ``min_interval``, each time a poll finds changes and multiplied by
+    ``backoff``, up to ``max_interval``, each time it does not. The
+    actual delay is randomized by ``jitter`` so that repositories
+    added at the same time drift apart.
+
+    :param float min_interval:
+        The minimum number of seconds between polls of a repository.
+    :param float max_interval:
+        The maximum number of seconds between polls of a repository.
+    :param float backoff:
+        The factor an unchanged repository's interval grows by.
+    :param float jitter:
+        The fraction of the interval the delay is randomized by.
+    """
+
+    def __init__(self, min_interval=60, max_interval=3600, backoff=1.5,
+                 jitter=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        # (due_at, name), entries that don't match due_at are stale
+        self.heap = []
+        self.due_at = {}
+        self.intervals = {}
+
+    def names(self):
+        return set(self.intervals)
+
+    def push(self, name, due_at):
+        self.due_at[name] = due_at
+        heapq.heappush(self.heap, (due_at, name))
+
+    def add(self, name, now):
+        """
+        Start polling a repository. The first polls of repositories are
+        spread out over ``min_interval``.
+
+        :param str name:
+            The name of the repository.
+        :param float now:
+            The current time.
+        """
+        if name in self.intervals:
+            return
+        self.intervals[name] = self.min_interval
+        self.push(name, now + random.uniform(0, self.min_interval))
+
+    def remove(self, name):
+        """
+        Stop polling a repository.
+
+        :param str name:
+            The name of the repository.
+        """
+        self.intervals.pop(name, None)
+        self.due_at.pop(name, None)
+
+    def discard_stale(self):
+        while self.heap and (
+                self.due_at.get(self.heap[0][1]) != self.heap[0][0]):
+            heapq.heappop(self.heap)
+
+    def next_due(self):
+        """
+        Return the time the next repository is due or ``None`` if no
+        repositories are scheduled.
+
+        :returns: float
+        """
+        self.discard_stale()
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now, limit):
+        """
+        Return up to ``limit`` repositories that are due, most overdue
+        first. They are not scheduled again until :py:meth:`reschedule`
+        is called for them.
+
+        :param float now:
+            The current time.
+        :param int limit:
+            The maximum number of repositories to return.
+        :returns: list
+        """
+        names = []
+        while len(names) < limit:
+            self.discard_stale()
+            if not self.heap or self.heap[0][0] > now:
+                break
+            _, name = heapq.heappop(self.heap)
+            del self.due_at[name]
+            names.append(name)
+        return names
+
+    def reschedule(self, name, changed, now):
+        """
+        Schedule the next poll of a repository.
+
+        :param str name:
+            The name of the repository.
+        :param bool changed:
+            Whether the last poll found changes.
+        :param float now:
+            The current time.
+        :returns: float
+            The repository's new interval.
+        """
+        if name not in self.intervals:
+            # NOTE: removed while it was being polled
+            return None
+        interval = self.intervals[name]
+        if changed:
+            interval = max(self.min_interval, interval / 2.0)
+        else:
+            interval = min(self.max_interval, interval * self.backoff)
+        self.intervals[name] = interval
+        self.push(name, now + interval * random.uniform(
+            1 - self.jitter, 1 + self.jitter))
+        return interval
@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+
+from collections import OrderedDict
+
+import avro.schema
+
+from elasticgit.commands.avro import deserialize
+
+from git.exc import GitCommandError
+from git.refs.symbolic import SymbolicReference
+
+from unicore.distribute.validation import validator_cache
+
+
+SCHEMA_DIR = '_schemas'
+SCHEMA_SUFFIX = '.avsc'
+
+
+def get_head_sha(repo):
+    """
+    Return the hexsha of a repository's HEAD commit or ``None`` if the
+    repository does not have any commits yet.
+
+    This only reads the refs from disk, it does not look up the commit
+    object.
+
+    :param git.Repo repo:
+        The git repository.
+    :returns: str
+    """
+    try:
+        return SymbolicReference.dereference_recursive(repo, 'HEAD')
+    except ValueError:
+        return None
+    except TypeError:
+        # NOTE: GitPython doesn't understand the packed-refs written by
+        #       newer versions of git, have git resolve HEAD instead.
+        try:
+            return repo.git.rev_parse('--verify', '--quiet', 'HEAD')
+        except GitCommandError:
+            return None
+
+
+class SchemaSet(object):
+    """
+    The schemas stored in a single commit of a repository.
+
+    The raw ``.avsc`` files are read from the commit's tree once, the
+    parsed Avro schemas, compiled validators and generated model classes
+    are created lazily and kept for as long as the :py:class:`SchemaSet`
+    lives.
+
+    :param git.Repo repo:
+        The git repository.
+    :param str sha:
+        The commit to read the schemas from.
+    """
+
+    def __init__(self, repo, sha):
+        self.sha = sha
+        self.lock = threading.Lock()
+        self.sources = self.read_sources(repo, sha)
+        self.json = dict(
+            (content_type, json.loads(source))
+            for content_type, source in self.sources.items())
+        self.parsed = {}
+        self.model_classes = {}
+        self.validators = {}
+
+    def read_sources(self, repo, sha):
+        if sha is None:
+            return {}
+
+        try:
+            schema_tree = repo.commit(sha).tree[SCHEMA_DIR]
+        except KeyError:
+            return {}
+
+        sources = {}
+        for blob in schema_tree.blobs:
+            content_type, suffix = os.path.splitext(blob.name)
+            if suffix == SCHEMA_SUFFIX:
+                sources[content_type] = blob.data_stream.read()
+        return sources
+
+    def content_types(self):
+        return sorted(self.sources.keys())
+
+    def schemas(self):
+        return dict(
+            ('%(namespace)s.%(name)s' % schema, schema)
+            for schema in self.json.values())
+
+    def get_schema(self, content_type):
+        with self.lock:
+            if content_type not in self.parsed:
+                self.parsed[content_type] = avro.schema.parse(
+                    self.sources[content_type])
+            return self.parsed[content_type]
+
+    def get_validator(self, content_type):
+        with self.lock:
+            if content_type not in self.validators:
+                self.validators[content_type] = validator_cache.get(
+                    self.sources[content_type])
+            return self.validators[content_type]
+
+    def get_model_class(self, content_type):
+        with self.lock:
+            if content_type not in self.model_classes:
+                schema = self.json[content_type]
+                self.model_classes[content_type] = deserialize(
+                    schema, module_name=schema['namespace'])
+            return self.model_classes[content_type]
+
+
+class SchemaRegistry(object):
+    """
+    A cache of :py:class:`SchemaSet` objects keyed by repository and
+    HEAD commit. When a repository's HEAD moves the stale entry is
+    replaced on next access.
+
+    :param int max_size:
+        The maximum number of repositories to cache schemas for.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # git_dir -> SchemaSet
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, repo, sha=None):
+        """
+        Return the :py:class:`SchemaSet` for a repository's HEAD commit,
+        or for the commit ``sha``.
+
+        :param git.Repo repo:
+            The git repository.
+        :param str sha:
+            The full hexsha of the commit, defaults to HEAD.
+        :returns: SchemaSet
+        """
+        head_sha = get_head_sha(repo)
+        if sha is not None and sha != head_sha:
+            # NOTE: only the schemas of HEAD are cached
+            return SchemaSet(repo, sha)
+
+        sha = head_sha
+        key = repo.git_dir
+        with self.lock:
+            schema_set = self.entries.pop(key, None)
+            if schema_set is not None and schema_set.sha == sha:
+                self.entries[key] = schema_set
+                self.hits += 1
+                return schema_set
+            self.misses += 1
+
+        schema_set = SchemaSet(repo, sha)
+        with self.lock:
+            self.entries[key] = schema_set
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return schema_set
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Return the registry's counters.
+
+        :returns: dict
+        """
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+schema_registry = SchemaRegistry()
@@ -1,12 +1,23 @@
 import os
+import sys
+import time
+import Queue
 import argparse
+import threading
 
-from elasticgit.storage import StorageManager
+from git.exc import GitCommandError
 
 from pyramid.paster import bootstrap
 from pyramid.request import Request
 
-from unicore.distribute.utils import get_repositories
+from unicore.distribute.indexing import reindex_repository
+from unicore.distribute.jobs import format_error
+from unicore.distribute.pool import RepositoryPool
+from unicore.distribute.proxycache import get_proxy_cache
+from unicore.distribute.schedule import PollSchedule
+from unicore.distribute.storage import get_storage_manager, git_deadline
+from unicore.distribute.utils import (
+    get_index_prefix, get_repositories, get_repository_names)
 from unicore.webhooks.events import WebhookEvent
 
 
@@ -14,30 +25,203 @@ class PollRepositories(object):
 
     # This gets set at run time or is overriden for tests
     notify = None
+    stdout = sys.stdout
+    # Ask the remote for its branch's sha before pulling
+    check_remote = True
 
-    def run(self, repo_dir, ini_file, base_url):
+    def run(self, repo_dir, ini_file, base_url, workers=1, timeout=None):
         request = Request.blank('/', base_url=base_url)
         env = bootstrap(ini_file, request=request)
         self.notify = env['registry'].notify
-        for repo in get_repositories(repo_dir):
-            self.pull_repo(env, repo)
+        summary = self.poll(
+            env, get_repositories(repo_dir), workers=workers,
+            timeout=timeout)
+        self.report(summary)
 
         # http://docs.pylonsproject.org/projects/pyramid/en/1.3-branch/narr/commandline.html#cleanup # noqa
         env['closer']()
 
+    def poll(self, env, repos, workers=1, timeout=None):
+        """
+        Pull repositories, ``workers`` at a time.
+
+        A repository that takes longer than ``timeout`` seconds is
+        reported as timed out. Its git commands that talk to the remote
+        are killed at that point, see
+        :py:class:`unicore.distribute.storage.DeadlineGit`, and it keeps
+        its worker until its pull has finished. This returns once every
+        pull has finished, so that none are killed halfway through a
+        merge when the process exits.
+
+        :param dict env:
+            The bootstrapped environment.
+        :param list repos:
+            The repositories to pull.
+        :param int workers:
+            The number of repositories to pull concurrently.
+        :param float timeout:
+            The number of seconds to wait for a single repository.
+        :returns: dict
+        """
+        started_at = time.time()
+        summary = {
+            'pulled': [],
+            'unchanged': [],
+            'skipped': [],
+            'failed': {},
+            'timed_out': [],
+        }
+        pending = list(repos)
+        results = Queue.Queue()
+        # name -> time the pull started
+        active = {}
+        while pending or active:
+            while pending and len(active) < max(1, workers):
+                repo = pending.pop(0)
+                now = time.time()
+                thread = threading.Thread(
+                    target=self.poll_repo, args=(
+                        env, repo, results,
+                        now + timeout if timeout is not None else None))
+                thread.daemon = True
+                active[os.path.basename(repo.working_dir)] = now
+                thread.start()
+
+            try:
+                name, changed, error = results.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+            else:
+                active.pop(name, None)
+                # NOTE: results of pulls that timed out are ignored
+                if name in summary['timed_out']:
+                    pass
+                elif error is not None:
+                    summary['failed'][name] = error
+                elif changed is None:
+                    summary['skipped'].append(name)
+                elif changed:
+                    summary['pulled'].append(name)
+                else:
+                    summary['unchanged'].append(name)
+
+            if timeout is not None:
+                now = time.time()
+                for name, pull_started_at in active.items():
+                    if (now - pull_started_at > timeout and
+                            name not in summary['timed_out']):
+                        summary['timed_out'].append(name)
+
+        summary['seconds'] = time.time() - started_at
+        return summary
+
+    def poll_repo(self, env, repo, results, deadline=None):
+        name = os.path.basename(repo.working_dir)
+        try:
+            with git_deadline(repo, deadline):
+                changed = self.pull_repo(env, repo)
+        except Exception, e:
+            results.put((name, None, format_error(e)))
+        else:
+            results.put((name, changed, None))
+
+    def report(self, summary):
+        self.stdout.write(
+            'Polled %s repositories in %.1fs: %s pulled, %s unchanged, '
+            '%s skipped, %s failed, %s timed out.\n' % (
+                sum(len(summary[key])
+                    for key in ('pulled', 'unchanged', 'skipped', 'failed',
+                                'timed_out')),
+                summary['seconds'], len(summary['pulled']),
+                len(summary['unchanged']), len(summary['skipped']),
+                len(summary['failed']), len(summary['timed_out'])))
+        for name, error in sorted(summary['failed'].items()):
+            self.stdout.write('%s failed: %s\n' % (name, error))
+        for name in sorted(summary['timed_out']):
+            self.stdout.write('%s timed out\n' % (name,))
+
+    def remote_sha(self, repo, remote_name, branch_name):
+        """
+        Return the sha a branch points to on a remote, without fetching
+        anything, or ``None`` if the remote does not have the branch.
+
+        :param git.Repo repo:
+            The git repository.
+        :param str remote_name:
+            The name of the remote.
+        :param str branch_name:
+            The name of the branch.
+        :returns: str
+        """
+        ref = 'refs/heads/%s' % (branch_name,)
+        # NOTE: ls-remote matches patterns against the end of the ref
+        #       name, so refs/heads/foo/master would match too.
+        for line in repo.git.ls_remote(remote_name, ref).splitlines():
+            sha, _, name = line.partition('\t')
+            if name == ref:
+                return sha
+        return None
+
+    def is_up_to_date(self, repo, remote_name, branch):
+        """
+        Return whether a branch already contains the commit its remote
+        branch points to, in which case pulling would not change
+        anything.
+
+        :param git.Repo repo:
+            The git repository.
+        :param str remote_name:
+            The name of the remote.
+        :param git.Head branch:
+            The local branch.
+        :returns: bool
+        """
+        remote_sha = self.remote_sha(repo, remote_name, branch.name)
+        if remote_sha is None:
+            # NOTE: leave it to the pull to report the missing branch
+            return False
+        local_sha = branch.commit.hexsha
+        if remote_sha == local_sha:
+            return True
+        try:
+            # NOTE: fails if the remote commit hasn't been fetched yet or
+            #       hasn't been merged into the local branch.
+            repo.git.merge_base('--is-ancestor', remote_sha, local_sha)
+        except GitCommandError:
+            return False
+        return True
+
     def pull_repo(self, env, repo):
-        sm = StorageManager(repo)
+        """
+        Pull a repository's active branch and notify webhooks if it
+        changed. The remote is asked which commit the branch points to
+        first and the pull is skipped if the local branch already has
+        it.
+
+        :param dict env:
+            The bootstrapped environment.
+        :param git.Repo repo:
+            The git repository.
+        :returns: bool
+            Whether the pull changed the branch or ``None`` if the pull
+            was skipped.
+        """
+        sm = get_storage_manager(repo)
         branch = repo.active_branch
         tracking_branch = branch.tracking_branch()
         if tracking_branch:
             remote_name = tracking_branch.remote_name
         else:
             remote_name = repo.remotes[0].name
+        if self.check_remote and self.is_up_to_date(
+                repo, remote_name, branch):
+            return None
         original_commit = branch.commit
         sm.pull(branch_name=branch.name,
                 remote_name=remote_name)
         last_commit = branch.commit
-        if original_commit.hexsha != last_commit.hexsha:
+        changed = original_commit.hexsha != last_commit.hexsha
+        if changed:
             name = os.path.basename(repo.working_dir)
             request = env['request']
             self.notify(
@@ -49,6 +233,168 @@ class PollRepositories(object):
                         'url': request.route_url(
                             'repositoryresource', name=name)
                     }))
+        return changed
+
+
+class PollDaemon(PollRepositories):
+    """
+    Polls repositories continuously, each on its own schedule, see
+    :py:class:`unicore.distribute.schedule.PollSchedule`. The
+    application is bootstrapped once and repositories are kept open
+    between polls.
+    """
+
+    pool = None
+    schedule = None
+
+    def run(self, repo_dir, ini_file, base_url, workers=4, timeout=None,
+            min_interval=60, max_interval=3600):
+        request = Request.blank('/', base_url=base_url)
+        env = bootstrap(ini_file, request=request)
+        self.notify = env['registry'].notify
+        self.pool = RepositoryPool(repo_dir)
+        self.schedule = PollSchedule(
+            min_interval=min_interval, max_interval=max_interval)
+        try:
+            self.serve(env, repo_dir, workers=workers, timeout=timeout)
+        except KeyboardInterrupt:  # pragma: no cover
+            pass
+        finally:
+            self.pool.clear()
+            env['closer']()
+
+    def scan(self, repo_dir, now):
+        names = set(get_repository_names(repo_dir))
+        for name in names - self.schedule.names():
+            self.schedule.add(name, now)
+        for name in self.schedule.names() - names:
+            self.schedule.remove(name)
+            self.pool.invalidate(name)
+
+    def serve(self, env, repo_dir, workers=4, timeout=None, max_polls=None):
+        """
+        Poll repositories as they become due, at most ``workers`` at a
+        time, until ``max_polls`` polls have finished or forever.
+
+        :param dict env:
+            The bootstrapped environment.
+        :param str repo_dir:
+            The directory with repositories, it is rescanned for new and
+            removed repositories every ``min_interval`` seconds.
+        :param int workers:
+            The number of repositories to pull concurrently.
+        :param float timeout:
+            The number of seconds after which a pull's git commands that
+            talk to the remote are killed. A pull that timed out keeps
+            its worker until it has finished.
+        :param int max_polls:
+            The number of polls to stop after.
+        """
+        results = Queue.Queue()
+        # name -> time the pull started
+        active = {}
+        timed_out = set()
+        polls = 0
+        scanned_at = None
+        try:
+            while max_polls is None or polls < max_polls:
+                now = time.time()
+                if (scanned_at is None or
+                        now - scanned_at >= self.schedule.min_interval):
+                    self.scan(repo_dir, now)
+                    scanned_at = now
+
+                for name in self.schedule.pop_due(
+                        now, max(0, workers - len(active))):
+                    thread = threading.Thread(
+                        target=self.poll_name, args=(
+                            env, name, results,
+                            now + timeout if timeout is not None else None))
+                    thread.daemon = True
+                    active[name] = now
+                    thread.start()
+
+                next_due = self.schedule.next_due()
+                wait = self.schedule.min_interval
+                if next_due is not None:
+                    wait = min(wait, max(0, next_due - now))
+                if active:
+                    wait = min(wait, 1)
+
+                try:
+                    name, changed, error = results.get(
+                        timeout=max(0.01, wait))
+                except Queue.Empty:
+                    pass
+                else:
+                    # NOTE: pulls that timed out are only rescheduled once
+                    #       they do finish.
+                    active.pop(name, None)
+                    timed_out.discard(name)
+                    polls += 1
+                    interval = self.schedule.reschedule(
+                        name, bool(changed), time.time())
+                    if error is not None:
+                        self.stdout.write('%s failed: %s\n' % (name, error))
+                    elif changed and interval is not None:
+                        self.stdout.write(
+                            '%s pulled, polling again in %ds\n' % (
+                                name, interval))
+
+                if timeout is not None:
+                    now = time.time()
+                    for name, pull_started_at in active.items():
+                        if (now - pull_started_at > timeout and
+                                name not in timed_out):
+                            timed_out.add(name)
+                            self.stdout.write('%s timed out\n' % (name,))
+        finally:
+            # NOTE: don't leave pulls behind to be killed halfway through
+            #       a merge when the process exits.
+            while active:
+                name, _, _ = results.get()
+                active.pop(name, None)
+
+    def poll_name(self, env, name, results, deadline=None):
+        try:
+            with self.pool.repository(name) as repo:
+                with git_deadline(repo, deadline):
+                    changed = self.pull_repo(env, repo)
+            if changed:
+                self.pool.invalidate(name)
+        except Exception, e:
+            results.put((name, None, format_error(e)))
+        else:
+            results.put((name, changed, None))
+
+
+class ReindexRepositories(object):
+
+    # This gets overriden for tests
+    stdout = sys.stdout
+
+    def run(self, repo_dir, ini_file, repo_names):
+        env = bootstrap(ini_file)
+        settings = env['registry'].settings
+        for repo in get_repositories(repo_dir):
+            name = os.path.basename(repo.working_dir)
+            if repo_names and name not in repo_names:
+                continue
+            self.reindex(settings, repo)
+        env['closer']()
+
+    def reindex(self, settings, repo):
+        stats = reindex_repository(repo, settings)
+        proxy_cache = get_proxy_cache(settings)
+        if proxy_cache is not None:
+            # NOTE: only reaches other processes through proxy.cache_dir
+            proxy_cache.invalidate(get_index_prefix(repo.working_dir))
+        self.stdout.write(
+            '%s: indexed %s documents into %s in %.1fs '
+            '(%.1f docs/sec)\n' % (
+                stats['alias'], stats['indexed'], stats['index'],
+                stats['seconds'], stats['docs_per_second'] or 0))
+        return stats
 
 
 def get_parser():  # pragma: no cover
@@ -72,8 +418,83 @@ def get_parser():  # pragma: no cover
         dest='base_url',
         help='This server\'s public URL (for webhooks)',
         default='http://localhost/')
+    command.add_argument(
+        '-w', '--workers',
+        dest='workers',
+        help='The number of repositories to pull concurrently.',
+        type=int,
+        default=1)
+    command.add_argument(
+        '-t', '--timeout',
+        dest='timeout',
+        help='The number of seconds to wait for a remote.',
+        type=float,
+        default=None)
     command.set_defaults(dispatcher=PollRepositories)
 
+    command = subparser.add_parser(
+        'poll-daemon', help='poll repositories continuously')
+    command.add_argument(
+        '-d', '--repo-dir',
+        dest='repo_dir',
+        help='The directory with repositories.',
+        default='./repos')
+    command.add_argument(
+        '-i', '--ini-file',
+        dest='ini_file',
+        help='The project\'s ini file.',
+        default='development.ini')
+    command.add_argument(
+        '-u', '--base-url',
+        dest='base_url',
+        help='This server\'s public URL (for webhooks)',
+        default='http://localhost/')
+    command.add_argument(
+        '-w', '--workers',
+        dest='workers',
+        help='The number of repositories to pull concurrently.',
+        type=int,
+        default=4)
+    command.add_argument(
+        '-t', '--timeout',
+        dest='timeout',
+        help='The number of seconds to wait for a remote.',
+        type=float,
+        default=None)
+    command.add_argument(
+        '--min-interval',
+        dest='min_interval',
+        help='The minimum number of seconds between polls of a repository.',
+        type=float,
+        default=60)
+    command.add_argument(
+        '--max-interval',
+        dest='max_interval',
+        help='The maximum number of seconds between polls of a repository.',
+        type=float,
+        default=3600)
+    command.set_defaults(dispatcher=PollDaemon)
+
+    command = subparser.add_parser(
+        'reindex',
+        help='rebuild repository indexes without downtime')
+    command.add_argument(
+        '-d', '--repo-dir',
+        dest='repo_dir',
+        help='The directory with repositories.',
+        default='./repos')
+    command.add_argument(
+        '-i', '--ini-file',
+        dest='ini_file',
+        help='The project\'s ini file.',
+        default='development.ini')
+    command.add_argument(
+        'repo_names',
+        metavar='repo_name',
+        nargs='*',
+        help='The repositories to reindex, defaults to all of them.')
+    command.set_defaults(dispatcher=ReindexRepositories)
+
     return parser
 
 
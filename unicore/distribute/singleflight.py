@@ -0,0 +1,102 @@
+import threading
+
+
+class Call(object):
+    """
+    A computation in flight and the result it ends up with.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent identical computations: while a computation
+    for a key is running, callers asking for the same key wait for it
+    and share its result (or exception) instead of starting their own.
+
+    Results are not kept once the computation finishes, keys should
+    include everything the result depends on, such as the repository's
+    HEAD commit.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> Call
+        self.calls = {}
+        # kind -> {'executions': int, 'coalesced': int}
+        self.counters = {}
+
+    def count(self, kind, counter):
+        # NOTE: must be called with the lock held
+        counters = self.counters.setdefault(
+            kind, {'executions': 0, 'coalesced': 0})
+        counters[counter] += 1
+
+    def do(self, kind, key, func, *args, **kwargs):
+        """
+        Return ``func(*args, **kwargs)``, sharing the result with other
+        callers of the same ``kind`` and ``key`` while it is computed.
+
+        :param str kind:
+            What is being computed, ``pull`` for example, used for the
+            counters.
+        :param tuple key:
+            Identifies the computation within ``kind``.
+        :param callable func:
+            The computation.
+        :returns: The result of ``func``.
+        """
+        with self.lock:
+            call = self.calls.get((kind, key))
+            leader = call is None
+            if leader:
+                call = Call()
+                self.calls[(kind, key)] = call
+                self.count(kind, 'executions')
+            else:
+                self.count(kind, 'coalesced')
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception, e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[(kind, key)]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """
+        Return the number of computations in flight and, per kind, the
+        number of computations run and of callers that shared one.
+
+        :returns: dict
+        """
+        with self.lock:
+            return {
+                'in_flight': len(self.calls),
+                'executions': sum(
+                    counters['executions']
+                    for counters in self.counters.values()),
+                'coalesced': sum(
+                    counters['coalesced']
+                    for counters in self.counters.values()),
+                'kinds': dict(
+                    (kind, dict(counters))
+                    for kind, counters in self.counters.items()),
+            }
+
+
+request_coalescer = SingleFlight()
@@ -0,0 +1,622 @@
+import os
+import signal
+import threading
+import time
+
+from contextlib import contextmanager
+from io import BytesIO
+
+from git import Actor, Git, Repo
+from git.diff import DiffIndex
+from git.exc import GitCommandError
+from git.objects import Blob, Commit, Tree
+from git.objects.fun import tree_to_stream
+from gitdb import IStream
+
+from elasticgit import EG
+from elasticgit.storage import StorageManager, StorageException
+
+
+BLOB_MODE = 0100644
+TREE_MODE = 040000
+
+NULL_SHA = '0' * 40
+
+# NOTE: git knows the empty tree whether or not it is stored
+EMPTY_TREE_SHA = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+# NOTE: git commands that talk to a remote and can hang on it
+REMOTE_COMMANDS = frozenset(['fetch', 'ls-remote'])
+
+
+def is_repository_dir(path):
+    """
+    Return whether a directory holds a repository, either a working
+    directory with a ``.git`` directory or a bare repository.
+
+    :param str path:
+        The directory.
+    :returns: bool
+    """
+    return (os.path.isdir(os.path.join(path, '.git')) or (
+        os.path.isfile(os.path.join(path, 'HEAD')) and
+        os.path.isdir(os.path.join(path, 'objects')) and
+        os.path.isdir(os.path.join(path, 'refs'))))
+
+
+def clone_repo(repo_url, path, bare=False):
+    """
+    Clone a repository, optionally without a working directory.
+
+    :param str repo_url:
+        The URL of the repository to clone.
+    :param str path:
+        The directory to clone into.
+    :param bool bare:
+        Whether to only clone the object database and refs. Content is
+        read from commits and written with :py:func:`commit_changes` so
+        the working directory isn't needed and repositories take up
+        half the disk space.
+    :returns: git.Repo
+    """
+    if not bare:
+        return EG.clone_repo(repo_url, path)
+    if os.path.isdir(repo_url):
+        # NOTE: git commands run in the repository, like git clone we
+        #       store local paths as absolute paths.
+        repo_url = os.path.abspath(repo_url)
+    # NOTE: ``git clone --bare`` doesn't set up remote tracking branches,
+    #       which pulls need, so fetch into an empty repository instead.
+    repo = Repo.init(path, bare=True)
+    remote = repo.create_remote('origin', repo_url)
+    remote.fetch()
+    if not repo.git.for_each_ref('refs/remotes/origin'):
+        # NOTE: like git clone, cloning an empty repository is fine
+        return repo
+    repo.git.remote('set-head', 'origin', '--auto')
+    remote_head = repo.git.symbolic_ref('refs/remotes/origin/HEAD')
+    branch_name = remote_head[len('refs/remotes/origin/'):]
+    branch_ref = 'refs/heads/%s' % (branch_name,)
+    repo.git.update_ref(branch_ref, remote_head)
+    repo.git.symbolic_ref('HEAD', branch_ref)
+    config_writer = repo.config_writer()
+    section = 'branch "%s"' % (branch_name,)
+    config_writer.set_value(section, 'remote', 'origin')
+    config_writer.set_value(section, 'merge', branch_ref)
+    config_writer.release()
+    return repo
+
+
+def store_object(repo, type_name, data):
+    """
+    Write an object to a repository's object database.
+
+    :param git.Repo repo:
+        The repository.
+    :param str type_name:
+        The object type, ``blob`` or ``tree``.
+    :param str data:
+        The object's contents.
+    :returns: str
+        The object's binary sha.
+    """
+    istream = repo.odb.store(IStream(type_name, len(data), BytesIO(data)))
+    return istream.binsha
+
+
+def tree_sort_key(entry):
+    binsha, mode, name = entry
+    # NOTE: git sorts trees as if their names ended in a slash
+    return name + '/' if mode == TREE_MODE else name
+
+
+def write_tree(repo, tree, changes):
+    """
+    Write a tree with changes applied to it, without an index.
+
+    :param git.Repo repo:
+        The repository.
+    :param git.Tree tree:
+        The tree to change, ``None`` to start from an empty one.
+    :param dict changes:
+        Maps paths relative to ``tree`` to a ``(binsha, mode)`` tuple
+        or to ``None`` to remove the path.
+    :returns: str
+        The binary sha of the new tree, ``None`` if it is empty.
+    """
+    entries = {}
+    subtrees = {}
+    if tree is not None:
+        for item in tree:
+            name = item.name.encode('utf-8')
+            entries[name] = (item.binsha, item.mode)
+            if item.type == 'tree':
+                subtrees[name] = item
+
+    subchanges = {}
+    for path, entry in changes.items():
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        name, _, rest = path.strip('/').partition('/')
+        if rest:
+            subchanges.setdefault(name, {})[rest] = entry
+        elif entry is None:
+            entries.pop(name, None)
+        else:
+            entries[name] = entry
+
+    for name, sub in subchanges.items():
+        binsha = write_tree(repo, subtrees.get(name), sub)
+        if binsha is None:
+            entries.pop(name, None)
+        else:
+            entries[name] = (binsha, TREE_MODE)
+
+    if not entries:
+        return None
+    items = sorted(
+        ((binsha, mode, name) for name, (binsha, mode) in entries.items()),
+        key=tree_sort_key)
+    stream = BytesIO()
+    tree_to_stream(items, stream.write)
+    return store_object(repo, Tree.type, stream.getvalue())
+
+
+def tree_entries(tree):
+    """
+    Return every file in a tree.
+
+    :param git.Tree tree:
+        The tree.
+    :returns: dict
+        Maps paths to ``(binsha, mode)`` tuples.
+    """
+    return dict(
+        (item.path.encode('utf-8'), (item.binsha, item.mode))
+        for item in tree.traverse() if item.type != 'tree')
+
+
+def merge_trees(base, ours, theirs):
+    """
+    Return the changes to make to ``ours`` to merge ``theirs`` into it.
+
+    :param git.Tree base:
+        The tree of the commits' merge base.
+    :param git.Tree ours:
+        The tree to merge into.
+    :param git.Tree theirs:
+        The tree to merge.
+    :returns: dict
+        The changes, see :py:func:`write_tree`.
+    :raises StorageException: if both sides changed the same file.
+    """
+    base_entries = tree_entries(base)
+    our_entries = tree_entries(ours)
+    their_entries = tree_entries(theirs)
+    changes = {}
+    for path in set(base_entries) | set(their_entries):
+        base_entry = base_entries.get(path)
+        our_entry = our_entries.get(path)
+        their_entry = their_entries.get(path)
+        if their_entry == base_entry or their_entry == our_entry:
+            continue
+        if our_entry != base_entry:
+            raise StorageException('Merge conflict in %s.' % (path,))
+        changes[path] = their_entry
+    return changes
+
+
+def is_ancestor(repo, ancestor, commit):
+    """
+    Return whether a commit is an ancestor of, or the same as, another.
+
+    :param git.Repo repo:
+        The repository.
+    :param git.Commit ancestor:
+        The possible ancestor.
+    :param git.Commit commit:
+        The commit.
+    :returns: bool
+    """
+    try:
+        repo.git.merge_base('--is-ancestor', ancestor.hexsha, commit.hexsha)
+        return True
+    except GitCommandError:
+        return False
+
+
+def update_ref(repo, ref_path, commit, old_commit):
+    """
+    Point a ref at a commit if it still points at ``old_commit``.
+
+    :param git.Repo repo:
+        The repository.
+    :param str ref_path:
+        The ref, ``refs/heads/master`` for example.
+    :param git.Commit commit:
+        The new commit.
+    :param git.Commit old_commit:
+        The commit the ref should point at now, ``None`` if the ref
+        should not exist yet.
+    :returns: bool
+        Whether the ref was updated.
+    """
+    old_sha = old_commit.hexsha if old_commit is not None else NULL_SHA
+    try:
+        repo.git.update_ref(ref_path, commit.hexsha, old_sha)
+        return True
+    except GitCommandError:
+        return False
+
+
+def head_commit(repo):
+    """
+    Return the commit HEAD points at or ``None`` for an empty repository.
+
+    :param git.Repo repo:
+        The repository.
+    :returns: git.Commit
+    """
+    if not repo.head.is_valid():
+        return None
+    return repo.head.commit
+
+
+def check_storable(model):
+    """
+    Make the checks :py:meth:`elasticgit.storage.StorageManager.store`
+    makes, for models written with :py:func:`store_changes` or through a
+    write queue instead.
+
+    :param elasticgit.models.Model model:
+        The model instance.
+    :raises StorageException:
+    """
+    if model.uuid is None:
+        raise StorageException('Cannot save a model without a UUID set.')
+
+    if model.is_read_only():
+        raise StorageException('Trying to save a read only model.')
+
+
+def commit_diff(commit):
+    """
+    Return the changes made by a commit, compared to its first parent
+    or, for a root commit, to the empty tree.
+
+    :param git.Commit commit:
+        The commit.
+    :returns: git.diff.DiffIndex
+    """
+    if commit.parents:
+        return commit.parents[0].diff(commit)
+    return commit.diff(EMPTY_TREE_SHA, R=True)
+
+
+def commit_changes(repo, changes, message, author=None, committer=None,
+                   retries=3):
+    """
+    Commit changes to files on the active branch without an index or a
+    working directory. Trees are written straight to the object
+    database and the branch is moved with a compare-and-swap, so if
+    another writer moves it first the changes are applied again on
+    top of its commit.
+
+    :param git.Repo repo:
+        The repository.
+    :param dict changes:
+        Maps file paths to their new data or to ``None`` to delete
+        them.
+    :param str message:
+        The commit message.
+    :param tuple author:
+        The author information (name, email address)
+        Defaults repo default if unspecified.
+    :param tuple committer:
+        The committer information (name, email address).
+        Defaults to the author if unspecified.
+    :param int retries:
+        The number of times to retry when another writer moved the
+        branch.
+    :returns: git.Commit
+    """
+    if not isinstance(message, str):
+        raise StorageException('Messages need to be bytestrings.')
+
+    blob_changes = {}
+    for path, data in changes.items():
+        if data is None:
+            blob_changes[path] = None
+            continue
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        blob_changes[path] = (store_object(repo, Blob.type, data), BLOB_MODE)
+
+    author_actor = Actor(*author) if author else None
+    committer_actor = Actor(*committer) if committer else author_actor
+    ref_path = repo.head.reference.path
+    for attempt in range(retries + 1):
+        parent = head_commit(repo)
+        binsha = write_tree(
+            repo, parent.tree if parent is not None else None, blob_changes)
+        if binsha is None:
+            binsha = store_object(repo, Tree.type, '')
+        commit = Commit.create_from_tree(
+            repo, Tree(repo, binsha, TREE_MODE, ''), message,
+            parent_commits=[parent] if parent is not None else [],
+            author=author_actor, committer=committer_actor)
+        if update_ref(repo, ref_path, commit, parent):
+            return commit
+    raise StorageException(
+        '%s was updated concurrently, giving up.' % (ref_path,))
+
+
+def store_changes(repo, changes, message, author=None, committer=None):
+    """
+    Write changes to many files as a single commit. Bare repositories
+    are committed to with :py:func:`commit_changes`, in repositories
+    with a working directory the files are written and committed
+    through the index, like
+    :py:meth:`elasticgit.storage.StorageManager.store_data` does.
+
+    :param git.Repo repo:
+        The repository.
+    :param dict changes:
+        Maps file paths to their new data or to ``None`` to delete
+        them.
+    :param str message:
+        The commit message.
+    :param tuple author:
+        The author information (name, email address)
+        Defaults repo default if unspecified.
+    :param tuple committer:
+        The committer information (name, email address).
+        Defaults to the author if unspecified.
+    :returns: git.Commit
+    """
+    if not isinstance(message, str):
+        raise StorageException('Messages need to be bytestrings.')
+
+    if repo.bare:
+        commit = head_commit(repo)
+        for repo_path, data in changes.items():
+            if data is not None:
+                continue
+            try:
+                commit.tree[repo_path]
+            except (AttributeError, KeyError):
+                raise StorageException('File does not exist.')
+        return commit_changes(
+            repo, changes, message, author=author, committer=committer)
+
+    removed = [
+        os.path.join(repo.working_dir, repo_path)
+        for repo_path, data in sorted(changes.items()) if data is None]
+    if not all(os.path.isfile(file_path) for file_path in removed):
+        raise StorageException('File does not exist.')
+
+    added = []
+    for repo_path, data in sorted(changes.items()):
+        if data is None:
+            continue
+        file_path = os.path.join(repo.working_dir, repo_path)
+        dir_name = os.path.dirname(file_path)
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        with open(file_path, 'w') as fp:
+            fp.write(data)
+        added.append(file_path)
+
+    author_actor = Actor(*author) if author else None
+    committer_actor = Actor(*committer) if committer else author_actor
+    index = repo.index
+    if added:
+        index.add(added)
+    if removed:
+        index.remove(removed, working_tree=True)
+    return index.commit(message,
+                        author=author_actor,
+                        committer=committer_actor)
+
+
+class BareStorageManager(StorageManager):
+    """
+    A :py:class:`elasticgit.storage.StorageManager` for bare
+    repositories. Objects are read from the active branch's commit and
+    written with :py:func:`commit_changes`.
+    """
+
+    def iterate(self, model_class):
+        commit = head_commit(self.repo)
+        if commit is None:
+            return
+        try:
+            tree = commit.tree[self.git_path(model_class)]
+        except KeyError:
+            return
+        suffix = '.%s' % (self.serializer.suffix,)
+        for blob in tree.blobs:
+            if blob.name.endswith(suffix):
+                yield self.get(model_class, blob.name[:-len(suffix)])
+
+    def store_data(self, repo_path, data, message,
+                   author=None, committer=None):
+        return commit_changes(
+            self.repo, {repo_path: data}, message,
+            author=author, committer=committer)
+
+    def delete_data(self, repo_path, message,
+                    author=None, committer=None):
+        if not isinstance(message, str):
+            raise StorageException('Messages need to be bytestrings.')
+
+        commit = head_commit(self.repo)
+        try:
+            commit.tree[repo_path]
+        except (AttributeError, KeyError):
+            raise StorageException('File does not exist.')
+        return commit_changes(
+            self.repo, {repo_path: None}, message,
+            author=author, committer=committer)
+
+    def create_storage(self, bare=True):
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        self.repo = Repo.init(self.workdir, bare=True)
+        return commit_changes(self.repo, {}, 'Initialize repository.')
+
+    def pull(self, branch_name='master', remote_name=None):
+        """
+        Fetch an upstream's commits and fast forward the active branch
+        to them, or merge them in with a merge commit if both sides
+        have new commits.
+
+        :param str branch_name:
+            The name of the branch to fast forward & merge in
+        :param str remote_name:
+            The name of the remote to fetch from.
+        :raises StorageException:
+            if both sides changed the same file.
+        """
+        remote_name = remote_name or 'origin'
+        remote = self.repo.remote(name=remote_name)
+        fetch_list = remote.fetch()
+        fetch_info = fetch_list['%s/%s' % (remote_name, branch_name)]
+        theirs = fetch_info.commit
+        ref_path = self.repo.head.reference.path
+
+        ours = head_commit(self.repo)
+        if ours is None:
+            # NOTE: This can happen when we've not done anything yet on a
+            #       repository
+            update_ref(self.repo, ref_path, theirs, None)
+            return DiffIndex()
+
+        diff = ours.diff(theirs)
+        if is_ancestor(self.repo, theirs, ours):
+            return diff
+        if is_ancestor(self.repo, ours, theirs):
+            commit = theirs
+        else:
+            [base_sha] = self.repo.git.merge_base(
+                ours.hexsha, theirs.hexsha).split()
+            base = self.repo.commit(base_sha)
+            binsha = write_tree(self.repo, ours.tree, merge_trees(
+                base.tree, ours.tree, theirs.tree))
+            if binsha is None:
+                binsha = store_object(self.repo, Tree.type, '')
+            commit = Commit.create_from_tree(
+                self.repo, Tree(self.repo, binsha, TREE_MODE, ''),
+                "Merge remote-tracking branch '%s/%s'" % (
+                    remote_name, branch_name),
+                parent_commits=[ours, theirs])
+        if not update_ref(self.repo, ref_path, commit, ours):
+            raise StorageException(
+                '%s was updated concurrently.' % (ref_path,))
+        return diff
+
+
+def get_storage_manager(repo):
+    """
+    Return the storage manager for a repository, a
+    :py:class:`BareStorageManager` for bare repositories.
+
+    :param git.Repo repo:
+        The repository.
+    :returns: elasticgit.storage.StorageManager
+    """
+    if repo.bare:
+        return BareStorageManager(repo)
+    return StorageManager(repo)
+
+
+class DeadlineGit(Git):
+    """
+    A :py:class:`git.Git` that kills the commands talking to a remote,
+    ``fetch`` and ``ls-remote``, once ``deadline`` has passed. Local
+    commands such as ``merge`` are left to finish, killing those could
+    leave ``.git/index.lock`` behind.
+
+    :param str working_dir:
+        The repository's working directory.
+    :param float deadline:
+        The time, as returned by :py:func:`time.time`, to kill remote
+        commands at.
+    """
+
+    def __init__(self, working_dir, deadline):
+        super(DeadlineGit, self).__init__(working_dir)
+        self.deadline = deadline
+
+    def execute(self, command, as_process=False, with_exceptions=True,
+                with_extended_output=False, **kwargs):
+        if (isinstance(command, basestring) or
+                command[1:2] not in [[name] for name in REMOTE_COMMANDS]):
+            return super(DeadlineGit, self).execute(
+                command, as_process=as_process,
+                with_exceptions=with_exceptions,
+                with_extended_output=with_extended_output, **kwargs)
+
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise GitCommandError(
+                command, -1, 'The deadline passed before it started.')
+        # NOTE: git runs the transport (ssh, git-remote-https, ...) as a
+        #       child process that would keep the pipes open, start a
+        #       process group so the lot can be killed.
+        kwargs.pop('kill_after_timeout', None)
+        process = super(DeadlineGit, self).execute(
+            command, as_process=True, preexec_fn=os.setsid, **kwargs)
+        timer = threading.Timer(
+            remaining, kill_process_group, [process.proc])
+        timer.daemon = True
+        timer.start()
+        if as_process:
+            return process
+
+        try:
+            stdout, stderr = process.proc.communicate()
+        finally:
+            timer.cancel()
+        stdout, stderr = [
+            value[:-1] if value and value.endswith('\n') else value
+            for value in (stdout, stderr)]
+        status = process.proc.returncode
+        if with_exceptions and status != 0:
+            raise GitCommandError(command, status, stderr)
+        if with_extended_output:
+            return status, stdout, stderr
+        return stdout
+
+
+def kill_process_group(proc):
+    if proc.poll() is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:  # pragma: no cover
+            # NOTE: it exited in the meantime
+            pass
+
+
+@contextmanager
+def git_deadline(repo, deadline):
+    """
+    Run the git commands of ``repo`` that talk to a remote with a
+    deadline, see :py:class:`DeadlineGit`.
+
+    :param git.Repo repo:
+        The repository.
+    :param float deadline:
+        The time to kill remote commands at, ``None`` for no deadline.
+    """
+    if deadline is None:
+        yield
+        return
+    git = repo.git
+    repo.git = DeadlineGit(repo.working_dir, deadline)
+    try:
+        yield
+    finally:
+        repo.git = git
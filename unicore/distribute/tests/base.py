@@ -4,6 +4,7 @@ import json
 from unittest import TestCase
 
 from elasticgit import EG
+from elasticsearch import RequestError
 from elasticgit.commands.avro import serialize
 from elasticgit.search import ESManager
 
@@ -62,3 +63,150 @@ class DistributeTestCase(TestCase):
         self.add_schema(workspace, model_class)
         self.add_mapping(workspace, model_class)
         return workspace
+
+
+class FakeIndices(object):
+
+    def __init__(self, es):
+        self.es = es
+
+    def exists(self, index):
+        return index in self.es.indexes or index in self.es.aliases
+
+    def create(self, index, body=None):
+        self.es.indexes[index] = {
+            'settings': {
+                'refresh_interval': '1s',
+                'number_of_replicas': '1',
+            },
+            'mappings': {},
+            'docs': {},
+        }
+
+    def delete(self, index):
+        del self.es.indexes[index]
+        for indexes in self.es.aliases.values():
+            indexes.discard(index)
+
+    def exists_alias(self, name):
+        return bool(self.es.aliases.get(name))
+
+    def get_alias(self, name):
+        return dict(
+            (index, {'aliases': {name: {}}})
+            for index in self.es.aliases[name])
+
+    def update_aliases(self, body):
+        self.es.alias_requests.append(body)
+        # NOTE: all or nothing, like Elasticsearch
+        indexes = dict(self.es.indexes)
+        aliases = dict(
+            (name, set(alias_indexes))
+            for name, alias_indexes in self.es.aliases.items())
+        for action in body['actions']:
+            [(op_type, params)] = action.items()
+            if op_type == 'remove_index':
+                if not self.es.remove_index_supported:
+                    raise RequestError(400, 'ElasticsearchIllegalArgument')
+                del indexes[params['index']]
+                continue
+            if params['alias'] in indexes:
+                raise RequestError(400, 'InvalidAliasNameException')
+            alias_indexes = aliases.setdefault(params['alias'], set())
+            if op_type == 'add':
+                alias_indexes.add(params['index'])
+            else:
+                alias_indexes.discard(params['index'])
+        self.es.indexes, self.es.aliases = indexes, aliases
+
+    def status(self, index):
+        return {'indices': {index: {'shards': {'0': [{'state': 'STARTED'}]}}}}
+
+    def put_mapping(self, index, doc_type, body):
+        self.es.indexes[index]['mappings'][doc_type] = body
+
+    def get_settings(self, index):
+        return {index: {'settings': {
+            'index': dict(self.es.indexes[index]['settings'])}}}
+
+    def put_settings(self, index, body):
+        self.es.settings_history.append((index, body['index']))
+        self.es.indexes[index]['settings'].update(body['index'])
+
+    def refresh(self, index):
+        self.es.refreshes.append(index)
+
+
+class FakeCluster(object):
+
+    def __init__(self, es):
+        self.es = es
+        # NOTE: the health statuses to report, the last one repeats
+        self.statuses = ['green']
+        self.health_requests = []
+
+    def health(self, index=None, wait_for_status=None, timeout=None,
+               request_timeout=None):
+        self.health_requests.append(index)
+        if len(self.statuses) > 1:
+            status = self.statuses.pop(0)
+        else:
+            status = self.statuses[0]
+        if isinstance(status, Exception):
+            raise status
+        return {
+            'status': status,
+            'timed_out': status == 'red',
+        }
+
+
+class FakeElasticsearch(object):
+    """
+    An in-memory stand-in for :py:class:`elasticsearch.Elasticsearch`
+    that supports just enough of the API for indexing.
+    """
+
+    def __init__(self):
+        self.indexes = {}
+        self.aliases = {}
+        self.alias_requests = []
+        # NOTE: Elasticsearch before 6.4 does not know remove_index
+        self.remove_index_supported = True
+        self.indices = FakeIndices(self)
+        self.cluster = FakeCluster(self)
+        self.bulk_requests = []
+        self.settings_history = []
+        self.refreshes = []
+
+    def docs(self, index, doc_type):
+        return dict(
+            (doc_id, doc)
+            for (type_, doc_id), doc in self.indexes[index]['docs'].items()
+            if type_ == doc_type)
+
+    def bulk(self, body):
+        self.bulk_requests.append(body)
+        lines = [json.loads(line) for line in body.splitlines()]
+        items = []
+        while lines:
+            [(op_type, meta)] = lines.pop(0).items()
+            [index_name] = self.aliases.get(
+                meta['_index']) or [meta['_index']]
+            index = self.indexes.get(index_name)
+            key = (meta['_type'], meta['_id'])
+            result = dict(meta, status=200)
+            if op_type == 'index':
+                doc = lines.pop(0)
+                if index is None:
+                    result.update(status=404, error='IndexMissingException')
+                else:
+                    index['docs'][key] = doc
+            elif index is None or key not in index['docs']:
+                result.update(status=404, error='NotFound')
+            else:
+                del index['docs'][key]
+            items.append({op_type: result})
+        return {
+            'errors': any('error' in item.values()[0] for item in items),
+            'items': items,
+        }
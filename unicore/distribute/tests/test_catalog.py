@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+
+from mock import Mock
+
+from elasticgit.tests.base import TestPerson
+from elasticgit.utils import fqcn
+
+from pyramid.registry import Registry
+
+from unicore.distribute.catalog import (
+    RepositoryCatalog, get_repository_catalog, update_repository_catalog)
+from unicore.distribute.pool import RepositoryPool, get_repository_pool
+from unicore.distribute.storage import clone_repo
+from unicore.distribute.tests.base import DistributeTestCase
+from unicore.distribute.utils import format_repo
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRepositoryCatalog(DistributeTestCase):
+
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.storage_path)
+        self.workspace = self.mk_model_workspace(
+            TestPerson, working_dir=self.storage_path, name='b-people')
+        self.other_workspace = self.mk_workspace(
+            working_dir=self.storage_path, name='a-empty')
+        self.clock = FakeClock()
+        self.pool = RepositoryPool(self.storage_path)
+        self.addCleanup(self.pool.clear)
+        self.catalog = RepositoryCatalog(
+            self.pool, validate_interval=10, clock=self.clock)
+
+    def test_bare(self):
+        path = os.path.join(self.storage_path, 'c-bare')
+        clone_repo(self.workspace.repo.working_dir, path, bare=True)
+        self.assertEqual(
+            [entry['commit'] for entry in self.catalog.list()],
+            [self.workspace.repo.head.commit.hexsha] * 2)
+
+    def test_pool(self):
+        self.add_schema(self.other_workspace, TestPerson)
+        self.catalog.list()
+        # NOTE: every handle went back to the pool
+        stats = self.pool.stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['size'], 2)
+        self.clock.now = 10
+        self.catalog.list()
+        self.assertEqual(self.pool.stats()['misses'], stats['misses'])
+
+    def test_list(self):
+        # NOTE: a-empty has no commits yet and isn't listed
+        [entry] = self.catalog.list()
+        self.assertEqual(entry, format_repo(self.workspace.repo))
+        self.assertEqual(self.catalog.stats(), {
+            'size': 1,
+            'builds': 1,
+            'validations': 1,
+        })
+        self.catalog.list()
+        self.assertEqual(self.catalog.stats()['builds'], 1)
+
+    def test_list_filters(self):
+        self.add_schema(self.other_workspace, TestPerson)
+        self.assertEqual(
+            [entry['name'] for entry in self.catalog.list()],
+            ['a-empty', 'b-people'])
+        self.assertEqual(
+            [entry['name'] for entry in self.catalog.list(prefix='b-')],
+            ['b-people'])
+        self.assertEqual(
+            [entry['name'] for entry in self.catalog.list(
+                content_type=fqcn(TestPerson))],
+            ['a-empty', 'b-people'])
+        self.assertEqual(
+            self.catalog.list(content_type='does.not.Exist'), [])
+
+    def test_validate_interval(self):
+        [entry] = self.catalog.list()
+        old_sha = entry['commit']
+        self.workspace.save(
+            TestPerson({'name': 'Foo', 'age': 1}), 'Saving a person.')
+        # NOTE: within the interval HEADs are not checked
+        [entry] = self.catalog.list()
+        self.assertEqual(entry['commit'], old_sha)
+        self.clock.now = 10
+        [entry] = self.catalog.list()
+        self.assertEqual(entry, format_repo(self.workspace.repo))
+        self.assertEqual(self.catalog.stats()['validations'], 2)
+
+    def test_added_and_removed_repositories(self):
+        self.catalog.list()
+        self.add_schema(self.other_workspace, TestPerson)
+        path = os.path.join(self.storage_path, 'c-clone')
+        clone_repo(self.workspace.repo.working_dir, path)
+        self.assertEqual(
+            [entry['name'] for entry in self.catalog.list()],
+            ['a-empty', 'b-people', 'c-clone'])
+        shutil.rmtree(path)
+        self.assertEqual(
+            [entry['name'] for entry in self.catalog.list()],
+            ['a-empty', 'b-people'])
+
+    def test_update_and_remove(self):
+        self.catalog.list()
+        self.workspace.save(
+            TestPerson({'name': 'Foo', 'age': 1}), 'Saving a person.')
+        self.catalog.update('b-people', self.workspace.repo)
+        [entry] = self.catalog.list()
+        self.assertEqual(entry['commit'],
+                         self.workspace.repo.head.commit.hexsha)
+        self.catalog.remove('b-people')
+        self.assertEqual(self.catalog.stats()['size'], 0)
+
+    def test_update_repository_catalog(self):
+        registry = Registry()
+        registry.settings = {'repo.storage_path': self.storage_path}
+        catalog = get_repository_catalog(registry)
+        self.assertIs(get_repository_catalog(registry), catalog)
+        self.assertIs(catalog.pool, get_repository_pool(registry))
+        update_repository_catalog(
+            Mock(registry=registry, repo=self.workspace.repo))
+        self.assertEqual(
+            catalog.entries['b-people'][1], format_repo(self.workspace.repo))
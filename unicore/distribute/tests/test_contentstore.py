@@ -0,0 +1,174 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from mock import Mock
+
+from elasticgit.commands.avro import serialize
+from elasticgit.tests.base import TestPerson
+from elasticgit.utils import fqcn
+
+from unicore.distribute.contentstore import (
+    ContentStore, content_path_info, get_content_store,
+    refresh_content_store, sync_content_store)
+from unicore.distribute.tests.base import DistributeTestCase
+from unicore.distribute.utils import format_content_type
+
+
+class TestContentStore(DistributeTestCase):
+
+    def setUp(self):
+        self.workspace = self.mk_model_workspace(TestPerson)
+        self.people = [TestPerson({'name': name, 'age': age})
+                       for age, name in enumerate(['Foo', 'Bar', 'Baz'])]
+        for person in self.people:
+            self.workspace.save(person, 'Saving a person.')
+        self.repo = self.workspace.repo
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir)
+        self.store = ContentStore(os.path.join(self.store_dir, 'repo.sqlite'))
+
+    def head(self):
+        return self.repo.head.commit.hexsha
+
+    def test_content_path_info(self):
+        self.assertEqual(
+            content_path_info('a.b/Person/the-uuid.json', '.json'),
+            ('a.b.Person', 'the-uuid'))
+        self.assertEqual(content_path_info('README.md', '.json'), None)
+        self.assertEqual(
+            content_path_info('_schemas/a.b.Person.avsc', '.json'), None)
+
+    def test_sync(self):
+        self.assertEqual(self.store.sha(), None)
+        self.assertTrue(self.store.sync(self.repo))
+        self.assertFalse(self.store.sync(self.repo))
+        self.assertEqual(self.store.sha(), self.head())
+
+        uuids = self.store.uuids(self.head(), fqcn(TestPerson))
+        self.assertEqual(uuids, sorted(person.uuid for person in self.people))
+        self.assertEqual(
+            self.store.objects(self.head(), fqcn(TestPerson), uuids),
+            format_content_type(self.repo, fqcn(TestPerson)))
+        self.assertEqual(
+            self.store.get(self.head(), fqcn(TestPerson),
+                           self.people[0].uuid),
+            dict(self.people[0]))
+        self.assertEqual(
+            self.store.get(self.head(), fqcn(TestPerson), 'missing'), None)
+        self.assertEqual(
+            self.store.uuids(self.head(), 'does.not.Exist'), None)
+        self.assertEqual(self.store.stats()['rebuilds'], 1)
+
+    def test_stale(self):
+        old_sha = self.head()
+        self.store.sync(self.repo)
+        self.workspace.save(
+            TestPerson({'name': 'Qux', 'age': 4}), 'Saving a person.')
+        self.assertEqual(
+            self.store.uuids(self.head(), fqcn(TestPerson)), None)
+        self.assertEqual(
+            self.store.get(self.head(), fqcn(TestPerson),
+                           self.people[0].uuid), None)
+        self.assertEqual(
+            self.store.iterate_json(self.head(), fqcn(TestPerson), []), None)
+        self.assertEqual(
+            len(self.store.uuids(old_sha, fqcn(TestPerson))), 3)
+
+        refresh_content_store(self.store, self.repo, old_sha)
+        self.assertEqual(self.store.sha(), old_sha)
+        refresh_content_store(self.store, self.repo, self.head())
+        self.assertEqual(self.store.sha(), self.head())
+
+    def test_incremental_sync(self):
+        self.store.sync(self.repo)
+        added = TestPerson({'name': 'Qux', 'age': 4})
+        self.workspace.save(added, 'Saving a person.')
+        modified = self.people[0].update({'age': 10})
+        self.workspace.save(modified, 'Updating a person.')
+        self.workspace.delete(self.people[1], 'Deleting a person.')
+        self.store.sync(self.repo)
+
+        uuids = self.store.uuids(self.head(), fqcn(TestPerson))
+        self.assertEqual(
+            self.store.objects(self.head(), fqcn(TestPerson), uuids),
+            format_content_type(self.repo, fqcn(TestPerson)))
+        self.assertEqual(
+            self.store.get(self.head(), fqcn(TestPerson), modified.uuid),
+            dict(modified))
+        self.assertEqual(self.store.stats()['rebuilds'], 1)
+        self.assertEqual(self.store.stats()['syncs'], 2)
+
+    def test_schema_change_rebuilds(self):
+        self.store.sync(self.repo)
+        schema = json.loads(serialize(TestPerson))
+        schema['doc'] = 'A changed schema.'
+        self.workspace.sm.store_data(
+            '_schemas/%s.avsc' % (fqcn(TestPerson),),
+            json.dumps(schema), 'Changing the schema.')
+        self.store.sync(self.repo)
+        self.assertEqual(self.store.stats()['rebuilds'], 2)
+
+    def test_rewritten_history_rebuilds(self):
+        self.store.sync(self.repo)
+        with self.store.lock:
+            conn = self.store.connection()
+            self.store.write_meta(conn, 'sha', 'f' * 40)
+        self.store.sync(self.repo)
+        self.assertEqual(self.store.stats()['rebuilds'], 2)
+        self.assertEqual(
+            len(self.store.uuids(self.head(), fqcn(TestPerson))), 3)
+
+    def test_iterate_json(self):
+        self.store.sync(self.repo)
+        uuids = [self.people[2].uuid, 'missing', self.people[0].uuid]
+        encoded = self.store.iterate_json(
+            self.head(), fqcn(TestPerson), uuids)
+        self.assertEqual(
+            [json.loads(data) for data in encoded],
+            [dict(self.people[2]), dict(self.people[0])])
+
+    def test_destroy(self):
+        self.store.sync(self.repo)
+        self.store.destroy()
+        self.assertFalse(os.path.exists(self.store.path))
+        self.assertEqual(self.store.sha(), None)
+
+    def test_destroy_other_threads(self):
+        self.store.sync(self.repo)
+        shas = []
+        destroyed = threading.Event()
+
+        def read_sha():
+            shas.append(self.store.sha())
+            destroyed.wait(5)
+            shas.append(self.store.sha())
+
+        thread = threading.Thread(target=read_sha)
+        thread.start()
+        while not shas:
+            time.sleep(0.01)
+        self.store.destroy()
+        destroyed.set()
+        thread.join()
+        # NOTE: the thread's connection to the removed database was
+        #       replaced, it doesn't keep reading stale rows
+        self.assertEqual(shas, [self.head(), None])
+
+    def test_get_content_store(self):
+        self.assertEqual(get_content_store({}, 'repo'), None)
+        config = {'content_store.dir': self.store_dir}
+        store = get_content_store(config, 'repo')
+        self.assertEqual(store.path,
+                         os.path.join(self.store_dir, 'repo.sqlite'))
+        self.assertIs(get_content_store(config, 'repo'), store)
+
+    def test_sync_content_store(self):
+        config = {'content_store.dir': self.store_dir}
+        sync_content_store(Mock(config=config, repo=self.repo))
+        store = get_content_store(
+            config, os.path.basename(self.repo.working_dir))
+        self.assertEqual(store.sha(), self.head())
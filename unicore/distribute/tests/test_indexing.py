@@ -0,0 +1,399 @@
+import fcntl
+import json
+import os
+import threading
+
+from elasticsearch import TransportError
+
+from elasticgit.tests.base import TestPerson
+from elasticgit.utils import fqcn
+
+from mock import patch
+
+from unicore.distribute.indexing import (
+    INDEX_LOCK_FILE, BulkIndexer, BulkIndexError, IndexNotReady,
+    advance_indexed_sha, advance_indexed_sha_for_paths, bulk_load_settings,
+    get_bulk_indexer, get_index_lock, get_indexed_sha, readiness_stats,
+    reindex_repository, set_indexed_sha, update_index, wait_for_index)
+from unicore.distribute.storage import store_changes
+from unicore.distribute.tests.base import (
+    DistributeTestCase, FakeElasticsearch)
+
+
+class TestBulkIndexer(DistributeTestCase):
+
+    def setUp(self):
+        self.es = FakeElasticsearch()
+        self.es.indices.create(index='foo-master')
+
+    def test_index(self):
+        with BulkIndexer(self.es, 'foo-master', chunk_size=2) as indexer:
+            for i in range(5):
+                indexer.index('Person', 'uuid-%s' % (i,), {'age': i})
+        self.assertEqual(len(self.es.bulk_requests), 3)
+        self.assertEqual(
+            self.es.docs('foo-master', 'Person'),
+            dict(('uuid-%s' % (i,), {'age': i}) for i in range(5)))
+        stats = indexer.stats()
+        self.assertEqual(stats['indexed'], 5)
+        self.assertEqual(stats['requests'], 3)
+        self.assertTrue(stats['docs_per_second'] > 0)
+
+    def test_max_chunk_bytes(self):
+        document = {'name': 'x' * 100}
+        size = len(json.dumps(document)) + len(json.dumps({'index': {
+            '_index': 'foo-master', '_type': 'Person', '_id': 'uuid-0'}}))
+        with BulkIndexer(self.es, 'foo-master',
+                         max_chunk_bytes=size * 2 + 10) as indexer:
+            for i in range(4):
+                indexer.index('Person', 'uuid-%s' % (i,), document)
+        self.assertEqual(len(self.es.bulk_requests), 2)
+        self.assertEqual(len(self.es.docs('foo-master', 'Person')), 4)
+
+    def test_delete(self):
+        with BulkIndexer(self.es, 'foo-master') as indexer:
+            indexer.index('Person', 'uuid-0', {'age': 0})
+            indexer.index('Person', 'uuid-1', {'age': 1})
+        with BulkIndexer(self.es, 'foo-master') as indexer:
+            indexer.delete('Person', 'uuid-0')
+            indexer.delete('Person', 'does-not-exist')
+        self.assertEqual(
+            self.es.docs('foo-master', 'Person'), {'uuid-1': {'age': 1}})
+        self.assertEqual(indexer.stats()['deleted'], 1)
+
+    def test_errors(self):
+        indexer = BulkIndexer(self.es, 'bar-master')
+        indexer.index('Person', 'uuid-0', {'age': 0})
+        with self.assertRaises(BulkIndexError) as context:
+            indexer.close()
+        self.assertEqual(len(context.exception.errors), 1)
+
+    def test_no_requests_when_empty(self):
+        with BulkIndexer(self.es, 'foo-master'):
+            pass
+        self.assertEqual(self.es.bulk_requests, [])
+
+    def test_get_bulk_indexer(self):
+        indexer = get_bulk_indexer(self.es, 'foo-master', {
+            'es.bulk_chunk_size': '10',
+            'es.bulk_max_chunk_bytes': '1024',
+        })
+        self.assertEqual(indexer.chunk_size, 10)
+        self.assertEqual(indexer.max_chunk_bytes, 1024)
+
+
+class TestBulkLoadSettings(DistributeTestCase):
+
+    def setUp(self):
+        self.es = FakeElasticsearch()
+        self.es.indices.create(index='foo-master')
+
+    def test_bulk_load_settings(self):
+        with bulk_load_settings(self.es, 'foo-master'):
+            self.assertEqual(self.es.indexes['foo-master']['settings'], {
+                'refresh_interval': '-1',
+                'number_of_replicas': 0,
+            })
+        self.assertEqual(self.es.indexes['foo-master']['settings'], {
+            'refresh_interval': '1s',
+            'number_of_replicas': '1',
+        })
+        self.assertEqual(self.es.refreshes, ['foo-master'])
+
+    def test_restored_on_error(self):
+        def load():
+            with bulk_load_settings(self.es, 'foo-master'):
+                raise ValueError()
+        self.assertRaises(ValueError, load)
+        self.assertEqual(
+            self.es.indexes['foo-master']['settings']['refresh_interval'],
+            '1s')
+
+    def test_disabled(self):
+        with bulk_load_settings(self.es, 'foo-master', enabled=False):
+            pass
+        self.assertEqual(self.es.settings_history, [])
+        self.assertEqual(self.es.refreshes, [])
+
+
+class TestWaitForIndex(DistributeTestCase):
+
+    def setUp(self):
+        self.es = FakeElasticsearch()
+        self.now = 0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def wait(self, **kwargs):
+        return wait_for_index(
+            self.es, 'foo-master', sleep=self.sleep, clock=self.clock,
+            **kwargs)
+
+    def test_ready(self):
+        before = readiness_stats.stats()
+        self.assertEqual(self.wait(), 0)
+        self.assertEqual(self.sleeps, [])
+        self.assertEqual(self.es.cluster.health_requests, ['foo-master'])
+        self.assertEqual(
+            readiness_stats.stats()['waits'], before['waits'] + 1)
+
+    def test_backoff(self):
+        self.es.cluster.statuses = [
+            'red', TransportError(503, 'unavailable'), 'red', 'yellow']
+        self.wait(initial_delay=1, max_delay=3)
+        self.assertEqual(len(self.sleeps), 3)
+        for sleep, delay in zip(self.sleeps, [1, 2, 3]):
+            self.assertTrue(delay * 0.5 <= sleep <= delay)
+
+    def test_green(self):
+        self.es.cluster.statuses = ['yellow', 'green']
+        self.wait(status='green')
+        self.assertEqual(len(self.es.cluster.health_requests), 2)
+
+    def test_timeout(self):
+        before = readiness_stats.stats()
+        self.es.cluster.statuses = ['red']
+        self.assertRaises(
+            IndexNotReady, self.wait, timeout=10, max_delay=2)
+        self.assertTrue(self.now >= 10)
+        self.assertTrue(len(self.sleeps) > 4)
+        self.assertEqual(
+            readiness_stats.stats()['timeouts'], before['timeouts'] + 1)
+
+
+class TestReindexRepository(DistributeTestCase):
+
+    def setUp(self):
+        self.workspace = self.mk_model_workspace(TestPerson)
+        for i in range(3):
+            self.workspace.save(
+                TestPerson({'name': 'foo %s' % (i,)}), 'Saving a person.')
+        self.es = FakeElasticsearch()
+        patcher = patch(
+            'unicore.distribute.indexing.get_es', return_value=self.es)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.alias = self.workspace.im.index_name(
+            self.workspace.sm.active_branch())
+        self.doc_type = self.workspace.im.get_mapping_type(
+            TestPerson).get_mapping_type_name()
+
+    def test_reindex(self):
+        # NOTE: an index from before aliases were used
+        self.es.indices.create(index=self.alias)
+        stats = reindex_repository(self.workspace.repo, {})
+        self.assertEqual(stats['alias'], self.alias)
+        self.assertEqual(stats['replaced'], [self.alias])
+        self.assertEqual(stats['indexed'], 3)
+        self.assertEqual(self.es.aliases[self.alias], set([stats['index']]))
+        self.assertEqual(self.es.indexes.keys(), [stats['index']])
+        self.assertEqual(
+            len(self.es.docs(stats['index'], self.doc_type)), 3)
+
+        new_stats = reindex_repository(self.workspace.repo, {})
+        self.assertNotEqual(new_stats['index'], stats['index'])
+        self.assertEqual(new_stats['replaced'], [stats['index']])
+        self.assertEqual(
+            self.es.aliases[self.alias], set([new_stats['index']]))
+        self.assertEqual(self.es.indexes.keys(), [new_stats['index']])
+
+    def test_reindex_replaces_legacy_atomically(self):
+        self.es.indices.create(index=self.alias)
+        with patch.object(
+                self.es.indices, 'delete',
+                side_effect=AssertionError('Deleted separately.')):
+            stats = reindex_repository(self.workspace.repo, {})
+        self.assertEqual(stats['replaced'], [self.alias])
+        self.assertEqual(self.es.aliases[self.alias], set([stats['index']]))
+        self.assertEqual(self.es.indexes.keys(), [stats['index']])
+        self.assertEqual(self.es.alias_requests[-1]['actions'], [
+            {'remove_index': {'index': self.alias}},
+            {'add': {'index': stats['index'], 'alias': self.alias}},
+        ])
+
+    def test_reindex_replaces_legacy_without_remove_index(self):
+        self.es.remove_index_supported = False
+        self.es.indices.create(index=self.alias)
+        stats = reindex_repository(self.workspace.repo, {})
+        self.assertEqual(stats['replaced'], [self.alias])
+        self.assertEqual(self.es.aliases[self.alias], set([stats['index']]))
+        self.assertEqual(self.es.indexes.keys(), [stats['index']])
+
+    def test_reindex_error(self):
+        stats = reindex_repository(self.workspace.repo, {})
+        with patch.object(
+                self.es, 'bulk',
+                side_effect=TransportError(500, 'Boom!')):
+            self.assertRaises(
+                TransportError, reindex_repository, self.workspace.repo, {})
+        # NOTE: the old index is still in place and being served
+        self.assertEqual(self.es.aliases[self.alias], set([stats['index']]))
+        self.assertEqual(self.es.indexes.keys(), [stats['index']])
+
+
+class TestUpdateIndex(DistributeTestCase):
+
+    def setUp(self):
+        self.workspace = self.mk_model_workspace(TestPerson)
+        self.repo = self.workspace.repo
+        self.people = [TestPerson({'name': 'foo %s' % (i,)})
+                       for i in range(3)]
+        for person in self.people:
+            self.workspace.save(person, 'Saving a person.')
+        self.es = FakeElasticsearch()
+        patcher = patch(
+            'unicore.distribute.indexing.get_es', return_value=self.es)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.index = self.workspace.im.index_name('master')
+        self.doc_type = self.workspace.im.get_mapping_type(
+            TestPerson).get_mapping_type_name()
+        reindex_repository(self.repo, {})
+
+    def docs(self):
+        return self.es.docs(
+            self.es.aliases[self.index].copy().pop(), self.doc_type)
+
+    def test_indexed_sha(self):
+        self.assertEqual(
+            get_indexed_sha(self.repo, 'master'),
+            self.repo.head.commit.hexsha)
+        self.assertEqual(get_indexed_sha(self.repo, 'foo'), None)
+        set_indexed_sha(self.repo, 'foo', 'abc')
+        self.assertEqual(get_indexed_sha(self.repo, 'foo'), 'abc')
+
+    def test_update(self):
+        updated = self.people[0].update({'name': 'bar'})
+        self.workspace.save(updated, 'Updating a person.')
+        self.workspace.delete(self.people[1], 'Deleting a person.')
+        added = TestPerson({'name': 'baz'})
+        self.workspace.save(added, 'Adding a person.')
+
+        stats = update_index(self.repo, {}, 'master')
+        self.assertEqual(stats['indexed'], 2)
+        self.assertEqual(stats['deleted'], 1)
+        self.assertEqual(self.docs(), {
+            updated.uuid: dict(updated),
+            self.people[2].uuid: dict(self.people[2]),
+            added.uuid: dict(added),
+        })
+        self.assertEqual(
+            get_indexed_sha(self.repo, 'master'),
+            self.repo.head.commit.hexsha)
+
+    def test_update_schema_removed(self):
+        changes = dict(
+            (self.workspace.sm.git_name(person), None)
+            for person in self.people)
+        changes['_schemas/%s.avsc' % (fqcn(TestPerson),)] = None
+        store_changes(self.repo, changes, 'Removing people.')
+
+        stats = update_index(self.repo, {}, 'master')
+        self.assertEqual(stats['deleted'], 3)
+        self.assertEqual(self.docs(), {})
+
+    def test_update_concurrently(self):
+        added = TestPerson({'name': 'baz'})
+        self.workspace.save(added, 'Adding a person.')
+        results = []
+
+        def update():
+            results.append(update_index(self.repo, {}, 'master'))
+
+        threads = [threading.Thread(target=update) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(
+            sorted(result['skipped'] for result in results),
+            [False, True, True, True])
+        self.assertIn(added.uuid, self.docs())
+
+    def test_advance_indexed_sha(self):
+        old_commit = self.repo.head.commit
+        self.workspace.save(TestPerson({'name': 'baz'}), 'Adding a person.')
+        new_commit = self.repo.head.commit
+        self.assertTrue(
+            advance_indexed_sha(self.repo, 'master', new_commit))
+        self.assertFalse(
+            advance_indexed_sha(self.repo, 'master', old_commit))
+        self.assertEqual(
+            get_indexed_sha(self.repo, 'master'), new_commit.hexsha)
+
+    def test_advance_indexed_sha_for_paths(self):
+        person = TestPerson({'name': 'baz'})
+        path = self.workspace.sm.git_name(person)
+        self.workspace.save(person, 'Adding a person.')
+        self.assertTrue(advance_indexed_sha_for_paths(
+            self.repo, 'master', self.repo.head.commit, [path]))
+        self.assertEqual(
+            get_indexed_sha(self.repo, 'master'),
+            self.repo.head.commit.hexsha)
+
+        # NOTE: the commit holds another change too
+        indexed_sha = self.repo.head.commit.hexsha
+        other = TestPerson({'name': 'qux'})
+        store_changes(self.repo, {
+            path: self.workspace.sm.serializer.serialize(
+                TestPerson({'uuid': person.uuid, 'name': 'baz 2'})),
+            self.workspace.sm.git_name(other):
+                self.workspace.sm.serializer.serialize(other),
+        }, 'Adding people.')
+        self.assertFalse(advance_indexed_sha_for_paths(
+            self.repo, 'master', self.repo.head.commit, [path]))
+
+        # NOTE: the parent has not been indexed
+        self.workspace.save(person, 'Updating a person.')
+        self.assertFalse(advance_indexed_sha_for_paths(
+            self.repo, 'master', self.repo.head.commit, [path]))
+        self.assertEqual(get_indexed_sha(self.repo, 'master'), indexed_sha)
+
+    def test_index_lock_across_processes(self):
+        path = os.path.join(self.repo.git_dir, INDEX_LOCK_FILE)
+        with get_index_lock(self.repo):
+            # NOTE: reentrant within the process
+            with get_index_lock(self.repo):
+                pass
+            # NOTE: a flock on another open file, as another process
+            #       would have, is refused while the lock is held
+            with open(path, 'a') as fp:
+                self.assertRaises(
+                    IOError, fcntl.flock, fp,
+                    fcntl.LOCK_EX | fcntl.LOCK_NB)
+        with open(path, 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_skip_indexed(self):
+        stats = update_index(self.repo, {}, 'master')
+        self.assertTrue(stats['skipped'])
+        self.assertEqual(self.es.bulk_requests[1:], [])
+
+    def test_resume_after_failure(self):
+        added = TestPerson({'name': 'baz'})
+        self.workspace.save(added, 'Adding a person.')
+        indexed_sha = get_indexed_sha(self.repo, 'master')
+        with patch.object(
+                self.es, 'bulk', side_effect=TransportError(500, 'Boom!')):
+            self.assertRaises(
+                TransportError, update_index, self.repo, {}, 'master')
+        self.assertEqual(get_indexed_sha(self.repo, 'master'), indexed_sha)
+
+        update_index(self.repo, {}, 'master')
+        self.assertIn(added.uuid, self.docs())
+
+    def test_fallback_to_changes(self):
+        self.repo.config_writer().remove_section('unicore-index "master"')
+        head = self.repo.head.commit
+        added = TestPerson({'name': 'baz'})
+        self.workspace.save(added, 'Adding a person.')
+        changes = head.diff(self.repo.head.commit)
+        stats = update_index(self.repo, {}, 'master', changes=changes)
+        self.assertEqual(stats['indexed'], 1)
+        self.assertIn(added.uuid, self.docs())
@@ -0,0 +1,70 @@
+import threading
+
+from pyramid import testing
+
+from unicore.distribute.jobs import Job, JobManager, get_job_manager
+from unicore.distribute.tests.base import DistributeTestCase
+
+
+class TestJobManager(DistributeTestCase):
+
+    def setUp(self):
+        self.manager = JobManager(workers=1, max_jobs=2)
+        self.addCleanup(self.manager.close)
+
+    def test_completed(self):
+        def work(job, count):
+            job.set_phase('counting', total=count)
+            for i in range(count):
+                job.progress(i + 1)
+            return {'count': count}
+
+        job = self.manager.submit('count', work, 3)
+        self.manager.join()
+        job_json = job.to_dict()
+        self.assertEqual(job_json['status'], Job.COMPLETED)
+        self.assertEqual(job_json['phase'], 'counting')
+        self.assertEqual(job_json['progress'], {'done': 3, 'total': 3})
+        self.assertEqual(job_json['result'], {'count': 3})
+        self.assertEqual(job_json['error'], None)
+        self.assertTrue(job_json['finished_at'] >= job_json['started_at'])
+        self.assertIs(self.manager.get(job.id), job)
+        self.assertEqual(self.manager.stats()['completed'], 1)
+
+    def test_failed(self):
+        def work(job):
+            raise ValueError('Boom!')
+
+        job = self.manager.submit('boom', work)
+        self.manager.join()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.error, 'ValueError: Boom!')
+        self.assertEqual(self.manager.stats()['failed'], 1)
+
+    def test_pending(self):
+        event = threading.Event()
+        blocking = self.manager.submit('block', lambda job: event.wait())
+        pending = self.manager.submit('noop', lambda job: None)
+        self.assertEqual(pending.status, Job.PENDING)
+        event.set()
+        self.manager.join()
+        self.assertEqual(blocking.status, Job.COMPLETED)
+        self.assertEqual(pending.status, Job.COMPLETED)
+
+    def test_max_jobs(self):
+        jobs = []
+        for i in range(4):
+            jobs.append(self.manager.submit('noop', lambda job: None))
+            self.manager.join()
+        self.assertEqual(self.manager.get(jobs[0].id), None)
+        self.assertIs(self.manager.get(jobs[-1].id), jobs[-1])
+
+    def test_unknown(self):
+        self.assertEqual(self.manager.get('foo'), None)
+
+    def test_get_job_manager(self):
+        config = testing.setUp(settings={'jobs.workers': '3'})
+        self.addCleanup(testing.tearDown)
+        manager = get_job_manager(config.registry)
+        self.assertIs(get_job_manager(config.registry), manager)
+        self.assertEqual(manager.workers, 3)
@@ -0,0 +1,77 @@
+import os
+
+from pyramid import testing
+from pyramid.exceptions import NotFound
+
+from unicore.distribute.pool import RepositoryPool, get_repository_pool
+from unicore.distribute.tests.base import DistributeTestCase
+
+
+class TestRepositoryPool(DistributeTestCase):
+
+    def setUp(self):
+        self.workspace = self.mk_workspace()
+        self.name = os.path.basename(self.workspace.working_dir)
+        self.pool = RepositoryPool(self.WORKING_DIR, max_size=2)
+
+    def test_reuse(self):
+        with self.pool.repository(self.name) as repo1:
+            self.assertEqual(repo1.working_dir, self.workspace.working_dir)
+        with self.pool.repository(self.name) as repo2:
+            self.assertIs(repo1, repo2)
+        stats = self.pool.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['size'], 1)
+
+    def test_concurrent_checkouts(self):
+        with self.pool.repository(self.name) as repo1:
+            with self.pool.repository(self.name) as repo2:
+                self.assertIsNot(repo1, repo2)
+                self.assertEqual(self.pool.stats()['in_use'], 2)
+        self.assertEqual(self.pool.stats()['size'], 2)
+
+    def test_eviction(self):
+        repos = [self.pool.acquire(self.name) for i in range(3)]
+        for repo in repos:
+            self.pool.release(self.name, repo)
+        stats = self.pool.stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        with self.pool.repository(self.name) as repo:
+            self.assertIs(repo, repos[-1])
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = -1
+        with self.pool.repository(self.name) as repo1:
+            pass
+        with self.pool.repository(self.name) as repo2:
+            self.assertIsNot(repo1, repo2)
+        self.assertEqual(self.pool.stats()['evictions'], 1)
+
+    def test_invalidate(self):
+        with self.pool.repository(self.name) as repo1:
+            pass
+        with self.pool.repository(self.name) as repo2:
+            self.pool.invalidate(self.name)
+        self.assertIs(repo1, repo2)
+        self.assertEqual(self.pool.stats()['size'], 0)
+        with self.pool.repository(self.name) as repo3:
+            self.assertIsNot(repo3, repo2)
+        self.assertEqual(self.pool.stats()['invalidations'], 1)
+
+    def test_not_found(self):
+        self.assertRaises(NotFound, self.pool.acquire, 'does-not-exist')
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+
+    def test_get_repository_pool(self):
+        config = testing.setUp(settings={
+            'repo.storage_path': self.WORKING_DIR,
+            'repo.pool_size': '5',
+        })
+        self.addCleanup(testing.tearDown)
+        pool = get_repository_pool(config.registry)
+        self.assertIs(pool, get_repository_pool(config.registry))
+        self.assertEqual(pool.max_size, 5)
+        self.assertEqual(pool.storage_path, self.WORKING_DIR)
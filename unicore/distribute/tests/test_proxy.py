@@ -1,3 +1,6 @@
+import gzip
+
+from StringIO import StringIO
 from unittest import TestCase
 
 from mock import Mock, patch
@@ -6,9 +9,12 @@ from pyramid import testing
 from pyramid.request import Request
 from webtest import TestApp
 
+from requests.exceptions import ConnectionError, ReadTimeout
 from requests.models import Response
+from requests.packages.urllib3.response import HTTPResponse
 
-from unicore.distribute.api.proxy import ProxyView, Proxy
+from unicore.distribute.api.proxy import ProxyView, Proxy, mk_session
+from unicore.distribute.proxycache import ProxyCache
 from unicore.distribute.api import main
 
 
@@ -20,8 +26,9 @@ class TestProxy(TestCase):
                       response_content='',
                       content_type='application/json',
                       encoding='utf-8',
-                      parts=''):
-        request = Request.blank('/', base_url=url, method=method)
+                      parts='',
+                      **kwargs):
+        request = Request.blank('/', base_url=url, method=method, **kwargs)
         request.matchdict = {
             'parts': parts,
         }
@@ -90,6 +97,149 @@ class TestProxy(TestCase):
         proxy_view.mk_request.assert_called_with(
             'GET', 'http://example.org/foo', data='')
 
+    def test_url_query_string(self):
+        request = Request.blank('/foo/_search?size=5&q=bar')
+        request.matchdict = {'parts': 'foo/_search'}
+        proxy_view = ProxyView(request, 'http://example.org')
+        self.assertEqual(
+            proxy_view.url(), 'http://example.org/foo/_search?size=5&q=bar')
+
+    def test_request_headers(self):
+        proxy_view = self.mk_proxy_view(headers={
+            'Content-Type': 'application/json',
+            'Connection': 'close',
+            'X-Custom': 'foo',
+        })
+        headers = proxy_view.request_headers()
+        self.assertEqual(headers['Content-Type'], 'application/json')
+        self.assertEqual(headers['X-Custom'], 'foo')
+        self.assertEqual(headers['Accept-Encoding'], 'identity')
+        self.assertFalse('Connection' in headers)
+        self.assertFalse('Host' in headers)
+
+        proxy_view = self.mk_proxy_view(headers={
+            'Accept-Encoding': 'gzip'})
+        self.assertEqual(
+            proxy_view.request_headers()['Accept-Encoding'], 'gzip')
+
+    def test_mk_request(self):
+        request = Request.blank('/?q=foo', method='POST', body='{}')
+        request.matchdict = {'parts': 'index/_search'}
+        session = Mock()
+        session.request.return_value = Response()
+        proxy = Proxy(
+            'http://example.org/', session=session, timeout=(1, 2))
+        proxy(request)
+        (args, kwargs) = session.request.call_args
+        self.assertEqual(
+            args, ('POST', 'http://example.org/index/_search?q=foo'))
+        self.assertEqual(kwargs['data'], '{}')
+        self.assertEqual(kwargs['timeout'], (1, 2))
+        self.assertTrue(kwargs['stream'])
+        self.assertEqual(kwargs['headers']['Accept-Encoding'], 'identity')
+
+    def test_mk_session(self):
+        session = mk_session(pool_size=3)
+        adapter = session.get_adapter('http://example.org')
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertTrue(session.get_adapter('https://example.org') is adapter)
+
+    def test_streaming_response(self):
+        sio = StringIO()
+        with gzip.GzipFile(fileobj=sio, mode='wb') as fp:
+            fp.write('{"hits": {}}')
+        compressed = sio.getvalue()
+
+        proxy_view = self.mk_proxy_view()
+        response = Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Content-Length'] = str(len(compressed))
+        response.headers['Transfer-Encoding'] = 'chunked'
+        response.raw = HTTPResponse(
+            body=StringIO(compressed), preload_content=False,
+            headers={'Content-Encoding': 'gzip'})
+        proxy_view.mk_request.return_value = response
+
+        resp = proxy_view.do_GET()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertFalse('Transfer-Encoding' in resp.headers)
+        # NOTE: the body is passed through without decompressing it
+        self.assertEqual(''.join(resp.app_iter), compressed)
+        self.assertTrue(response.raw.closed)
+
+    def test_upstream_errors(self):
+        proxy_view = self.mk_proxy_view()
+        proxy_view.mk_request.side_effect = ConnectionError()
+        self.assertEqual(proxy_view.do_GET().status_code, 502)
+        proxy_view.mk_request.side_effect = ReadTimeout()
+        self.assertEqual(proxy_view.do_GET().status_code, 504)
+
+    def mk_upstream_response(self, content='{"hits": {}}', status_code=200):
+        response = Response()
+        response.status_code = status_code
+        response.headers['Content-Type'] = 'application/json'
+        response._content = content
+        return response
+
+    def test_cache(self):
+        cache = ProxyCache()
+        session = Mock()
+        session.request.side_effect = (
+            lambda *args, **kwargs: self.mk_upstream_response())
+        proxy = Proxy('http://example.org/', session=session, cache=cache)
+
+        def search(body='{"query": {}}', **kwargs):
+            request = Request.blank(
+                '/foo-master/_search', method='POST', body=body, **kwargs)
+            request.matchdict = {'parts': 'foo-master/_search'}
+            return proxy(request)
+
+        response = search()
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(response.body, '{"hits": {}}')
+        response = search(body='{ "query" : {} }')
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(response.body, '{"hits": {}}')
+        self.assertEqual(session.request.call_count, 1)
+
+        response = search(headers={'Cache-Control': 'no-cache'})
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(session.request.call_count, 2)
+
+    def test_cache_skips_writes_and_errors(self):
+        cache = ProxyCache()
+        session = Mock()
+        proxy = Proxy('http://example.org/', session=session, cache=cache)
+
+        request = Request.blank('/foo/page/1', method='PUT', body='{}')
+        request.matchdict = {'parts': 'foo/page/1'}
+        session.request.return_value = self.mk_upstream_response()
+        self.assertFalse('X-Cache' in proxy(request).headers)
+
+        request = Request.blank('/foo/_search')
+        request.matchdict = {'parts': 'foo/_search'}
+        session.request.return_value = self.mk_upstream_response(
+            status_code=503)
+        response = proxy(request)
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse('X-Cache' in response.headers)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_cache_large_response(self):
+        cache = ProxyCache(max_entry_size=4)
+        session = Mock()
+        session.request.return_value = self.mk_upstream_response()
+        proxy = Proxy('http://example.org/', session=session, cache=cache)
+        request = Request.blank('/foo/_search')
+        request.matchdict = {'parts': 'foo/_search'}
+        response = proxy(request)
+        self.assertEqual(''.join(response.app_iter), '{"hits": {}}')
+        self.assertEqual(cache.stats()['entries'], 0)
+
     @patch.object(ProxyView, 'mk_request')
     def test_proxy_setup(self, mocked_request):
         response = Response()
@@ -0,0 +1,180 @@
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from mock import Mock
+
+from unicore.distribute.proxycache import (
+    ProxyCache, cache_key, get_proxy_cache, invalidate_proxy_cache,
+    invalidation_keys, is_cacheable, normalize_body, request_indexes)
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestProxyCacheHelpers(TestCase):
+
+    def test_request_indexes(self):
+        self.assertEqual(request_indexes('foo-master/_search'),
+                         ['foo-master'])
+        self.assertEqual(request_indexes('/b-master,a-master/page/_search'),
+                         ['a-master', 'b-master'])
+        self.assertEqual(request_indexes('_search'), None)
+        self.assertEqual(request_indexes('_all/_search'), None)
+        self.assertEqual(request_indexes('foo-*/_search'), None)
+
+    def test_is_cacheable(self):
+        self.assertTrue(is_cacheable('GET', 'foo/_search', ''))
+        self.assertTrue(is_cacheable('POST', 'foo/page/_count/', ''))
+        self.assertFalse(is_cacheable('PUT', 'foo/_search', ''))
+        self.assertFalse(is_cacheable('POST', 'foo/page/1', ''))
+        self.assertFalse(is_cacheable('GET', 'foo/_search', 'scroll=1m'))
+
+    def test_cache_key(self):
+        self.assertEqual(normalize_body('{"b": 1, "a": [1, 2]}'),
+                         '{"a":[1,2],"b":1}')
+        self.assertEqual(normalize_body('not json'), 'not json')
+        self.assertEqual(
+            cache_key('/foo/_search', 'b=1&a=2', '{"b": 1, "a": 2}'),
+            cache_key('foo/_search', 'a=2&b=1', '{"a":2,"b":1}'))
+        self.assertNotEqual(
+            cache_key('foo/_search', '', '{}'),
+            cache_key('foo/_search', '', '{}', 'gzip'))
+        self.assertNotEqual(
+            cache_key('foo/_search', '', '{"size": 1}'),
+            cache_key('foo/_search', '', '{"size": 2}'))
+
+    def test_invalidation_keys(self):
+        self.assertEqual(invalidation_keys(None), ['_any'])
+        self.assertEqual(invalidation_keys(['foo-master-123']), [
+            'foo', 'foo-master', 'foo-master-123'])
+
+
+class TestProxyCache(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def mk_cache(self, **kwargs):
+        kwargs.setdefault('clock', self.clock)
+        return ProxyCache(**kwargs)
+
+    def mk_cache_dir(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        return cache_dir
+
+    def put(self, cache, key, indexes, body='{}'):
+        return cache.put(key, indexes, self.clock(), 200,
+                         [('Content-Type', 'application/json')], body)
+
+    def test_get_put(self):
+        cache = self.mk_cache()
+        self.assertEqual(cache.get('a'), None)
+        self.assertTrue(self.put(cache, 'a', ['foo-master'], body='hits'))
+        entry = cache.get('a')
+        self.assertEqual(entry.status, 200)
+        self.assertEqual(entry.body, 'hits')
+        self.assertEqual(entry.headerlist,
+                         [('Content-Type', 'application/json')])
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['size'], 4)
+
+    def test_ttl(self):
+        cache = self.mk_cache(ttl=10)
+        self.put(cache, 'a', ['foo-master'])
+        self.clock.now += 9
+        self.assertNotEqual(cache.get('a'), None)
+        self.clock.now += 1
+        self.assertEqual(cache.get('a'), None)
+
+    def test_invalidate(self):
+        cache = self.mk_cache(invalidation_delay=0)
+        self.put(cache, 'foo', ['foo-master'])
+        self.put(cache, 'foobar', ['foobar-master'])
+        self.put(cache, 'all', None)
+        self.clock.now += 1
+        cache.invalidate('foo')
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.get('all'), None)
+        self.assertNotEqual(cache.get('foobar'), None)
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+        # NOTE: the index updated since, so don't cache the response
+        self.assertFalse(cache.put(
+            'foo', ['foo-master'], self.clock.now - 1, 200, [], '{}'))
+        self.clock.now += 1
+        self.assertTrue(self.put(cache, 'foo', ['foo-master']))
+
+    def test_invalidation_delay(self):
+        cache = self.mk_cache(invalidation_delay=1)
+        cache.invalidate('foo')
+        self.clock.now += 0.5
+        self.assertFalse(self.put(cache, 'foo', ['foo-master']))
+        self.clock.now += 1
+        self.assertTrue(self.put(cache, 'foo', ['foo-master']))
+
+    def test_eviction(self):
+        cache = self.mk_cache(max_entries=2, max_size=8, max_entry_size=6)
+        self.put(cache, 'a', ['foo'], body='aaa')
+        self.put(cache, 'b', ['foo'], body='bbb')
+        cache.get('a')
+        self.put(cache, 'c', ['foo'], body='ccc')
+        self.assertEqual(cache.get('b'), None)
+        self.assertNotEqual(cache.get('a'), None)
+        self.put(cache, 'd', ['foo'], body='dddddd')
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertEqual(cache.stats()['size'], 6)
+        self.assertFalse(self.put(cache, 'e', ['foo'], body='eeeeeee'))
+
+    def test_shared_cache_dir(self):
+        cache_dir = self.mk_cache_dir()
+        cache1 = self.mk_cache(cache_dir=cache_dir, invalidation_delay=0)
+        cache2 = self.mk_cache(cache_dir=cache_dir, invalidation_delay=0)
+        self.put(cache1, 'a', ['foo-master'], body='\x1f\x8b\nbinary')
+        self.put(cache1, 'b', ['bar-master'])
+        entry = cache2.get('a')
+        self.assertEqual(entry.body, '\x1f\x8b\nbinary')
+        self.assertEqual(entry.indexes, ['foo-master'])
+        self.assertEqual(entry.headerlist,
+                         [('Content-Type', 'application/json')])
+
+        self.clock.now += 1
+        cache1.invalidate('foo')
+        self.assertEqual(cache2.get('a'), None)
+        self.assertNotEqual(cache2.get('b'), None)
+
+    def test_disk_eviction(self):
+        cache_dir = self.mk_cache_dir()
+        cache = self.mk_cache(cache_dir=cache_dir, max_size=200)
+        for i in range(10):
+            self.put(cache, str(i), ['foo'], body='x' * 50)
+        self.assertTrue(cache.disk_size <= 200)
+        self.assertTrue(cache.stats()['evictions'] > 0)
+
+    def test_get_proxy_cache(self):
+        self.assertEqual(get_proxy_cache({}), None)
+        config = {'proxy.cache_enabled': 'true', 'proxy.cache_ttl': '5'}
+        cache = get_proxy_cache(config)
+        self.assertEqual(cache.ttl, 5)
+        self.assertTrue(get_proxy_cache(dict(config)) is cache)
+
+    def test_invalidate_proxy_cache(self):
+        config = {'proxy.cache_enabled': 'true',
+                  'proxy.cache_invalidation_delay': '0'}
+        cache = get_proxy_cache(config)
+        cache.put('a', ['foo-master'], cache.clock() - 1, 200, [], '{}')
+        self.assertNotEqual(cache.get('a'), None)
+        invalidate_proxy_cache(
+            Mock(config=config, repo=Mock(working_dir='/repos/Foo')))
+        self.assertEqual(cache.get('a'), None)
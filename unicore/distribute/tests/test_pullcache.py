@@ -0,0 +1,137 @@
+import json
+import os
+import shutil
+import tempfile
+
+from elasticgit.tests.base import TestPerson
+from pyramid import testing
+from pyramid.exceptions import NotFound
+
+from unicore.distribute.api.repo_status import (
+    RepositoryDiffResource, RepositoryPullResource, prewarm_jobs,
+    prewarm_repo_pull_cache)
+from unicore.distribute.events import (
+    ContentTypeObjectsUpdated, RepositoryUpdated)
+from unicore.distribute.pool import get_repository_pool
+from unicore.distribute.pullcache import (
+    PullCache, get_pull_cache, cached_repository_diff,
+    cached_pull_repository_files)
+from unicore.distribute.tests.base import DistributeTestCase
+from unicore.distribute.utils import (
+    get_repository_diff, pull_repository_files)
+
+
+class TestPullCache(DistributeTestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.cache = PullCache(self.cache_dir, max_size=1000)
+        self.workspace = self.mk_workspace()
+        self.add_schema(self.workspace, TestPerson)
+        self.name = os.path.basename(self.workspace.working_dir)
+        self.initial_commit = self.workspace.repo.head.commit.hexsha
+        self.workspace.save(
+            TestPerson({'age': 1, 'name': 'Foo'}), 'Saving a person.')
+
+    def test_get_put(self):
+        self.assertEqual(self.cache.get('repo', 'pull', 'a', 'b'), None)
+        self.cache.put('repo', 'pull', 'a', 'b', {'foo': 'bar'})
+        self.assertEqual(
+            self.cache.get('repo', 'pull', 'a', 'b'), {'foo': 'bar'})
+        self.assertEqual(self.cache.get('repo', 'diff', 'a', 'b'), None)
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(PullCache(self.cache_dir).size, stats['size'])
+
+    def test_put_replaces(self):
+        for i in range(3):
+            self.cache.put('repo', 'pull', 'a', 'b', {'foo': 'bar'})
+        self.assertEqual(
+            self.cache.stats()['size'], len(json.dumps({'foo': 'bar'})))
+        self.assertEqual(self.cache.stats()['evictions'], 0)
+
+    def test_eviction(self):
+        payload = {'data': 'x' * 300}
+        for i in range(4):
+            self.cache.put('repo', 'pull', str(i), 'b', payload)
+            os.utime(self.cache.path('repo', 'pull', str(i), 'b'),
+                     (i, i))
+        self.assertTrue(self.cache.size <= 1000)
+        self.assertTrue(self.cache.stats()['evictions'] > 0)
+        self.assertEqual(self.cache.get('repo', 'pull', '0', 'b'), None)
+        self.assertEqual(self.cache.get('repo', 'pull', '3', 'b'), payload)
+
+    def test_cached_repository_diff(self):
+        repo = self.workspace.repo
+        short_sha = self.initial_commit[:7]
+        diff = cached_repository_diff(self.cache, self.name, repo, short_sha)
+        self.assertEqual(diff, get_repository_diff(repo, short_sha))
+        self.assertEqual(diff['previous-index'], short_sha)
+        self.assertEqual(
+            cached_repository_diff(
+                self.cache, self.name, repo, self.initial_commit),
+            get_repository_diff(repo, self.initial_commit))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_cached_pull_repository_files(self):
+        repo = self.workspace.repo
+        for i in range(2):
+            self.assertEqual(
+                cached_pull_repository_files(
+                    self.cache, self.name, repo, self.initial_commit),
+                pull_repository_files(repo, self.initial_commit))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertRaises(
+            NotFound, cached_pull_repository_files,
+            self.cache, self.name, repo, 'foo')
+
+    def test_prewarm(self):
+        settings = {
+            'repo.storage_path': self.WORKING_DIR,
+            'cache.pull_dir': self.cache_dir,
+            'cache.pull_prewarm': '5',
+        }
+        config = testing.setUp(settings=settings)
+        self.addCleanup(testing.tearDown)
+        prewarm_repo_pull_cache(RepositoryUpdated(
+            config=settings, repo=self.workspace.repo, changes=[],
+            branch='master'))
+        prewarm_jobs.join()
+        # NOTE: the handle is checked out of the app's pool and returned
+        pool_stats = get_repository_pool(config.registry).stats()
+        self.assertEqual(pool_stats['misses'], 1)
+        self.assertEqual(pool_stats['in_use'], 0)
+        self.assertEqual(pool_stats['size'], 1)
+        cache = get_pull_cache(settings)
+        head = self.workspace.repo.head.commit.hexsha
+        self.assertNotEqual(
+            cache.get(self.name, 'pull', self.initial_commit, head), None)
+        self.assertNotEqual(
+            cache.get(self.name, 'diff', self.initial_commit, head), None)
+
+        request = testing.DummyRequest({})
+        request.matchdict = {
+            'name': self.name,
+            'commit_id': self.initial_commit,
+        }
+        hits = cache.stats()['hits']
+        self.assertEqual(
+            RepositoryPullResource(request).get(),
+            pull_repository_files(self.workspace.repo, self.initial_commit))
+        self.assertEqual(
+            RepositoryDiffResource(request).get(),
+            get_repository_diff(self.workspace.repo, self.initial_commit))
+        self.assertEqual(cache.stats()['hits'], hits + 2)
+
+    def test_prewarm_skips_writes(self):
+        settings = {
+            'repo.storage_path': self.WORKING_DIR,
+            'cache.pull_dir': self.cache_dir,
+        }
+        prewarm_repo_pull_cache(ContentTypeObjectsUpdated(
+            models=[], config=settings, repo=self.workspace.repo,
+            changes=[], branch='master'))
+        prewarm_jobs.join()
+        self.assertEqual(get_pull_cache(settings).stats()['size'], 0)
@@ -0,0 +1,65 @@
+from unittest import TestCase
+
+from unicore.distribute.schedule import PollSchedule
+
+
+class TestPollSchedule(TestCase):
+
+    def setUp(self):
+        self.schedule = PollSchedule(
+            min_interval=10, max_interval=100, backoff=2, jitter=0)
+
+    def test_add(self):
+        self.schedule.add('foo', 0)
+        self.schedule.add('bar', 0)
+        self.assertEqual(self.schedule.names(), set(['foo', 'bar']))
+        self.assertTrue(0 <= self.schedule.next_due() <= 10)
+        self.assertEqual(
+            sorted(self.schedule.pop_due(10, limit=5)), ['bar', 'foo'])
+        self.assertEqual(self.schedule.next_due(), None)
+
+    def test_pop_due_limit(self):
+        for name in ('foo', 'bar', 'baz'):
+            self.schedule.add(name, 0)
+        self.assertEqual(len(self.schedule.pop_due(10, limit=2)), 2)
+        self.assertEqual(len(self.schedule.pop_due(10, limit=2)), 1)
+        self.assertEqual(self.schedule.pop_due(10, limit=2), [])
+
+    def test_pop_due_order(self):
+        self.schedule.add('foo', 0)
+        self.schedule.add('bar', 0)
+        [first, second] = self.schedule.pop_due(10, limit=2)
+        self.schedule.reschedule(first, False, 20)
+        self.schedule.reschedule(second, False, 10)
+        self.assertEqual(self.schedule.pop_due(40, limit=2), [second, first])
+
+    def test_reschedule(self):
+        self.schedule.add('foo', 0)
+        self.schedule.pop_due(10, limit=1)
+        self.assertEqual(self.schedule.reschedule('foo', False, 10), 20)
+        self.assertEqual(self.schedule.next_due(), 30)
+        self.assertEqual(self.schedule.pop_due(29, limit=1), [])
+        self.assertEqual(self.schedule.pop_due(30, limit=1), ['foo'])
+        self.assertEqual(self.schedule.reschedule('foo', False, 30), 40)
+        self.assertEqual(self.schedule.reschedule('foo', False, 30), 80)
+        self.assertEqual(self.schedule.reschedule('foo', False, 30), 100)
+        self.assertEqual(self.schedule.reschedule('foo', True, 30), 50)
+        self.assertEqual(self.schedule.reschedule('foo', True, 30), 25)
+        self.assertEqual(self.schedule.reschedule('foo', True, 30), 12.5)
+        self.assertEqual(self.schedule.reschedule('foo', True, 30), 10)
+        # NOTE: only the last reschedule counts
+        self.assertEqual(self.schedule.pop_due(1000, limit=5), ['foo'])
+
+    def test_jitter(self):
+        schedule = PollSchedule(min_interval=10, jitter=0.5, backoff=1)
+        schedule.add('foo', 0)
+        schedule.pop_due(10, limit=1)
+        schedule.reschedule('foo', False, 0)
+        self.assertTrue(5 <= schedule.next_due() <= 15)
+
+    def test_remove(self):
+        self.schedule.add('foo', 0)
+        self.schedule.remove('foo')
+        self.assertEqual(self.schedule.names(), set())
+        self.assertEqual(self.schedule.pop_due(10, limit=1), [])
+        self.assertEqual(self.schedule.reschedule('foo', True, 10), None)
@@ -0,0 +1,105 @@
+import os
+
+from elasticgit.tests.base import TestPerson, TestPage
+from elasticgit.utils import fqcn
+
+from unicore.distribute.schemas import SchemaRegistry, get_head_sha
+from unicore.distribute.tests.base import DistributeTestCase
+
+
+class TestSchemaRegistry(DistributeTestCase):
+
+    def setUp(self):
+        self.workspace = self.mk_workspace()
+        self.add_schema(self.workspace, TestPerson)
+        self.registry = SchemaRegistry(max_size=1)
+
+    def test_get(self):
+        schema_set = self.registry.get(self.workspace.repo)
+        self.assertEqual(schema_set.sha, get_head_sha(self.workspace.repo))
+        self.assertEqual(schema_set.content_types(), [fqcn(TestPerson)])
+        self.assertEqual(
+            schema_set.schemas()[fqcn(TestPerson)]['name'], 'TestPerson')
+        self.assertIs(self.registry.get(self.workspace.repo), schema_set)
+        self.assertEqual(self.registry.stats()['hits'], 1)
+        self.assertEqual(self.registry.stats()['misses'], 1)
+
+    def test_cached_model_class(self):
+        schema_set = self.registry.get(self.workspace.repo)
+        model_class = schema_set.get_model_class(fqcn(TestPerson))
+        self.assertEqual(model_class.__name__, 'TestPerson')
+        self.assertIs(
+            schema_set.get_model_class(fqcn(TestPerson)), model_class)
+        self.assertIs(
+            schema_set.get_schema(fqcn(TestPerson)),
+            schema_set.get_schema(fqcn(TestPerson)))
+        self.assertRaises(KeyError, schema_set.get_model_class, 'foo')
+
+    def test_head_moved(self):
+        schema_set = self.registry.get(self.workspace.repo)
+        self.add_schema(self.workspace, TestPage)
+        new_schema_set = self.registry.get(self.workspace.repo)
+        self.assertIsNot(schema_set, new_schema_set)
+        self.assertEqual(
+            new_schema_set.content_types(),
+            sorted([fqcn(TestPerson), fqcn(TestPage)]))
+
+    def test_cached_validator(self):
+        schema_set = self.registry.get(self.workspace.repo)
+        validator = schema_set.get_validator(fqcn(TestPerson))
+        self.assertTrue(validator.is_valid(dict(TestPerson({'name': 'Foo'}))))
+        self.assertRaises(KeyError, schema_set.get_validator, 'foo')
+        # NOTE: shared with later commits as long as the schema is the same
+        self.add_schema(self.workspace, TestPage)
+        new_schema_set = self.registry.get(self.workspace.repo)
+        self.assertIsNot(new_schema_set, schema_set)
+        self.assertIs(
+            new_schema_set.get_validator(fqcn(TestPerson)), validator)
+
+    def test_historical_commit(self):
+        sha = get_head_sha(self.workspace.repo)
+        self.add_schema(self.workspace, TestPage)
+        schema_set = self.registry.get(self.workspace.repo, sha)
+        self.assertEqual(schema_set.sha, sha)
+        self.assertEqual(schema_set.content_types(), [fqcn(TestPerson)])
+        self.assertEqual(self.registry.stats()['size'], 0)
+        head_schema_set = self.registry.get(
+            self.workspace.repo, get_head_sha(self.workspace.repo))
+        self.assertIs(self.registry.get(self.workspace.repo), head_schema_set)
+
+    def test_uncommitted_schemas_ignored(self):
+        self.registry.get(self.workspace.repo)
+        with open(os.path.join(self.workspace.working_dir,
+                               '_schemas', 'foo.avsc'), 'w') as fp:
+            fp.write('{}')
+        self.assertEqual(
+            self.registry.get(self.workspace.repo).content_types(),
+            [fqcn(TestPerson)])
+
+    def test_max_size(self):
+        other_workspace = self.mk_workspace(
+            name='%s_other' % (self.id(),),
+            index_prefix='%s_other' % (self.workspace.index_prefix,))
+        self.registry.get(self.workspace.repo)
+        self.registry.get(other_workspace.repo)
+        self.assertEqual(self.registry.stats()['size'], 1)
+
+
+class TestGetHeadSha(DistributeTestCase):
+
+    def test_get_head_sha(self):
+        workspace = self.mk_workspace()
+        self.assertEqual(get_head_sha(workspace.repo), None)
+        self.add_schema(workspace, TestPerson)
+        self.assertEqual(
+            get_head_sha(workspace.repo), workspace.repo.head.commit.hexsha)
+
+    def test_packed_refs(self):
+        workspace = self.mk_workspace()
+        self.add_schema(workspace, TestPerson)
+        repo = workspace.repo
+        sha = repo.head.commit.hexsha
+        repo.git.pack_refs('--all')
+        self.assertFalse(os.path.exists(
+            os.path.join(repo.git_dir, 'refs', 'heads', 'master')))
+        self.assertEqual(get_head_sha(repo), sha)
@@ -1,4 +1,6 @@
 import os.path
+import threading
+import time
 
 from ConfigParser import ConfigParser
 from StringIO import StringIO
@@ -8,7 +10,10 @@ from pyramid.request import Request
 
 from elasticgit.tests.base import ToolBaseTest
 
-from unicore.distribute.scripts import PollRepositories
+from unicore.distribute.pool import RepositoryPool
+from unicore.distribute.schedule import PollSchedule
+from unicore.distribute.scripts import (
+    PollRepositories, PollDaemon, ReindexRepositories)
 
 from elasticgit.tests.base import TestPerson
 
@@ -86,14 +91,15 @@ class TestScripts(ToolBaseTest):
         mock = Mock()
         poll_repos = PollRepositories()
         poll_repos.notify = mock
-        poll_repos.pull_repo(env, self.workspace.repo)
+        self.assertEqual(
+            poll_repos.pull_repo(env, self.workspace.repo), None)
 
         mock.assert_not_called()
 
         self.remote_workspace.save(
             TestPerson({'age': 2, 'name': 'Foo'}), 'Saving person2')
 
-        poll_repos.pull_repo(env, self.workspace.repo)
+        self.assertTrue(poll_repos.pull_repo(env, self.workspace.repo))
         mock.assert_called()
         (call,) = mock.call_args_list
         (args, kwargs) = call
@@ -107,3 +113,233 @@ class TestScripts(ToolBaseTest):
             'repo': name,
             'url': url,
         })
+
+    def test_pull_repo_checks_remote(self):
+        poll_repos = PollRepositories()
+        poll_repos.notify = Mock()
+        repo = self.workspace.repo
+        self.assertTrue(poll_repos.is_up_to_date(
+            repo, 'origin', repo.active_branch))
+
+        # NOTE: local commits that aren't on the remote yet don't need
+        #       a pull either.
+        self.workspace.save(
+            TestPerson({'age': 3, 'name': 'Local'}), 'Saving person3')
+        self.assertTrue(poll_repos.is_up_to_date(
+            repo, 'origin', repo.active_branch))
+        with patch('elasticgit.storage.StorageManager.pull') as pull:
+            self.assertEqual(poll_repos.pull_repo(None, repo), None)
+        pull.assert_not_called()
+
+        self.remote_workspace.save(
+            TestPerson({'age': 2, 'name': 'Foo'}), 'Saving person2')
+        self.assertFalse(poll_repos.is_up_to_date(
+            repo, 'origin', repo.active_branch))
+        self.assertEqual(
+            poll_repos.remote_sha(repo, 'origin', 'master'),
+            self.remote_workspace.repo.active_branch.commit.hexsha)
+        self.assertEqual(
+            poll_repos.remote_sha(repo, 'origin', 'does-not-exist'), None)
+
+    def test_pull_repo_without_remote_check(self):
+        poll_repos = PollRepositories()
+        poll_repos.notify = Mock()
+        poll_repos.check_remote = False
+        with patch('elasticgit.storage.StorageManager.pull') as pull:
+            self.assertFalse(
+                poll_repos.pull_repo(None, self.workspace.repo))
+        pull.assert_called()
+
+    def test_poll(self):
+        repos = [self.workspace.repo, self.remote_workspace.repo]
+        pr = PollRepositories()
+        with patch.object(PollRepositories, 'pull_repo') as mocked_pull_repo:
+            mocked_pull_repo.side_effect = (
+                lambda env, repo: repo is self.workspace.repo)
+            summary = pr.poll(None, repos, workers=2)
+        self.assertEqual(summary['pulled'], [
+            os.path.basename(self.workspace.working_dir)])
+        self.assertEqual(summary['unchanged'], [
+            os.path.basename(self.remote_workspace.working_dir)])
+        self.assertEqual(summary['skipped'], [])
+        self.assertEqual(summary['failed'], {})
+        self.assertEqual(summary['timed_out'], [])
+
+    def test_poll_skipped(self):
+        repos = [self.workspace.repo, self.remote_workspace.repo]
+        pr = PollRepositories()
+        pr.stdout = StringIO()
+        with patch.object(PollRepositories, 'pull_repo') as mocked_pull_repo:
+            mocked_pull_repo.side_effect = (
+                lambda env, repo: True if repo is self.workspace.repo
+                else None)
+            summary = pr.poll(None, repos, workers=2)
+        self.assertEqual(summary['pulled'], [
+            os.path.basename(self.workspace.working_dir)])
+        self.assertEqual(summary['skipped'], [
+            os.path.basename(self.remote_workspace.working_dir)])
+        pr.report(summary)
+        self.assertTrue(pr.stdout.getvalue().strip().endswith(
+            '1 pulled, 0 unchanged, 1 skipped, 0 failed, 0 timed out.'))
+
+    def test_poll_concurrently(self):
+        repos = [self.workspace.repo, self.remote_workspace.repo]
+        started = []
+        both_started = threading.Event()
+
+        def pull_repo(env, repo):
+            started.append(repo)
+            if len(started) == 2:
+                both_started.set()
+            return both_started.wait(5)
+
+        pr = PollRepositories()
+        with patch.object(
+                PollRepositories, 'pull_repo', side_effect=pull_repo):
+            summary = pr.poll(None, repos, workers=2)
+        self.assertEqual(len(summary['pulled']), 2)
+
+    def test_poll_failures_and_timeouts(self):
+        repos = [self.workspace.repo, self.remote_workspace.repo]
+        hung = threading.Event()
+        self.addCleanup(hung.set)
+
+        def pull_repo(env, repo):
+            if repo is self.workspace.repo:
+                raise ValueError('Boom!')
+            hung.wait(1)
+            return True
+
+        pr = PollRepositories()
+        pr.stdout = StringIO()
+        with patch.object(
+                PollRepositories, 'pull_repo', side_effect=pull_repo):
+            summary = pr.poll(None, repos, workers=2, timeout=0.2)
+        name = os.path.basename(self.workspace.working_dir)
+        remote_name = os.path.basename(self.remote_workspace.working_dir)
+        self.assertEqual(summary['failed'], {name: 'ValueError: Boom!'})
+        self.assertEqual(summary['timed_out'], [remote_name])
+        self.assertEqual(summary['pulled'], [])
+        # NOTE: the pull that timed out is waited for
+        self.assertTrue(summary['seconds'] >= 1)
+
+        pr.report(summary)
+        lines = pr.stdout.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Polled 2 repositories in'))
+        self.assertTrue(lines[0].endswith(
+            '0 pulled, 0 unchanged, 0 skipped, 1 failed, 1 timed out.'))
+        self.assertEqual(lines[1:], [
+            '%s failed: ValueError: Boom!' % (name,),
+            '%s timed out' % (remote_name,),
+        ])
+
+    def test_poll_timed_out_keeps_worker(self):
+        repos = [self.workspace.repo, self.remote_workspace.repo]
+        started = []
+
+        def pull_repo(env, repo):
+            started.append((repo, time.time()))
+            if repo is self.workspace.repo:
+                time.sleep(0.5)
+            return True
+
+        pr = PollRepositories()
+        with patch.object(
+                PollRepositories, 'pull_repo', side_effect=pull_repo):
+            summary = pr.poll(None, repos, workers=1, timeout=0.1)
+        name = os.path.basename(self.workspace.working_dir)
+        remote_name = os.path.basename(self.remote_workspace.working_dir)
+        self.assertEqual(summary['timed_out'], [name])
+        self.assertEqual(summary['pulled'], [remote_name])
+        # NOTE: the second pull only starts once the first has finished
+        [(_, first_started), (_, second_started)] = started
+        self.assertTrue(second_started - first_started >= 0.5)
+
+    def test_poll_git_deadline(self):
+        deadlines = []
+
+        def pull_repo(env, repo):
+            deadlines.append(repo.git.deadline)
+            return False
+
+        pr = PollRepositories()
+        git = self.workspace.repo.git
+        with patch.object(
+                PollRepositories, 'pull_repo', side_effect=pull_repo):
+            started = time.time()
+            pr.poll(None, [self.workspace.repo], workers=1, timeout=10)
+        [deadline] = deadlines
+        self.assertTrue(started + 10 <= deadline <= time.time() + 10)
+        self.assertIs(self.workspace.repo.git, git)
+
+    def test_poll_daemon_waits_for_timed_out(self):
+        pd = PollDaemon()
+        pd.stdout = StringIO()
+        pd.pool = RepositoryPool(self.WORKING_DIR)
+        pd.schedule = PollSchedule(min_interval=0.01, max_interval=1)
+        finished = []
+
+        def pull_repo(env, repo):
+            time.sleep(0.3)
+            finished.append(repo.working_dir)
+            return False
+
+        with patch.object(PollDaemon, 'pull_repo', side_effect=pull_repo):
+            pd.serve(None, self.WORKING_DIR, workers=2, max_polls=1,
+                     timeout=0.1)
+        self.assertEqual(len(finished), 2)
+        self.assertEqual(pd.stdout.getvalue().count('timed out'), 2)
+
+    def test_poll_daemon(self):
+        pd = PollDaemon()
+        pd.stdout = StringIO()
+        pd.pool = RepositoryPool(self.WORKING_DIR)
+        pd.schedule = PollSchedule(min_interval=0.01, max_interval=1)
+        name = os.path.basename(self.workspace.working_dir)
+        remote_name = os.path.basename(self.remote_workspace.working_dir)
+        with patch.object(PollDaemon, 'pull_repo') as mocked_pull_repo:
+            mocked_pull_repo.side_effect = (
+                lambda env, repo: repo.working_dir.endswith(name))
+            pd.serve(None, self.WORKING_DIR, workers=1, max_polls=10)
+
+        polled = [os.path.basename(call[0][1].working_dir)
+                  for call in mocked_pull_repo.call_args_list]
+        self.assertEqual(len(polled), 10)
+        self.assertEqual(set(polled), set([name, remote_name]))
+        # NOTE: the unchanged repository is polled less and less often
+        self.assertEqual(pd.schedule.intervals[name], 0.01)
+        self.assertTrue(pd.schedule.intervals[remote_name] > 0.01)
+        self.assertTrue(polled.count(name) > polled.count(remote_name))
+        self.assertTrue(pd.pool.stats()['hits'] > 0)
+        self.assertIn('%s pulled' % (name,), pd.stdout.getvalue())
+
+    def test_poll_daemon_failure(self):
+        pd = PollDaemon()
+        pd.stdout = StringIO()
+        pd.pool = RepositoryPool(self.WORKING_DIR)
+        pd.schedule = PollSchedule(min_interval=0.01, max_interval=1)
+        with patch.object(PollDaemon, 'pull_repo') as mocked_pull_repo:
+            mocked_pull_repo.side_effect = ValueError('Boom!')
+            pd.serve(None, self.WORKING_DIR, workers=2, max_polls=2)
+        self.assertEqual(
+            pd.stdout.getvalue().count('failed: ValueError: Boom!'), 2)
+
+    @patch('unicore.distribute.scripts.reindex_repository')
+    def test_reindex(self, mocked_reindex):
+        mocked_reindex.return_value = {
+            'alias': 'foo-master',
+            'index': 'foo-master-1',
+            'indexed': 3,
+            'seconds': 1.5,
+            'docs_per_second': 2.0,
+        }
+        rr = ReindexRepositories()
+        rr.stdout = StringIO()
+        settings = {'es.host': 'http://localhost:9200'}
+        stats = rr.reindex(settings, self.workspace.repo)
+        self.assertEqual(stats, mocked_reindex.return_value)
+        mocked_reindex.assert_called_with(self.workspace.repo, settings)
+        self.assertEqual(
+            rr.stdout.getvalue(),
+            'foo-master: indexed 3 documents into foo-master-1 in 1.5s '
+            '(2.0 docs/sec)\n')
@@ -0,0 +1,100 @@
+import threading
+import time
+
+from unittest import TestCase
+
+from unicore.distribute.singleflight import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+
+    def wait_for(self, predicate, timeout=5):
+        deadline = time.time() + timeout
+        while not predicate():
+            if time.time() > deadline:
+                self.fail('Timed out.')
+            time.sleep(0.01)
+
+    def run_concurrently(self, flight, func, count):
+        results = []
+        errors = []
+
+        def target():
+            try:
+                results.append(flight.do('pull', ('repo', 'abc'), func))
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def test_do(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do('pull', ('repo', 'abc'), lambda: 1), 1)
+        self.assertEqual(flight.do('pull', ('repo', 'abc'), lambda: 2), 2)
+        self.assertEqual(flight.stats(), {
+            'in_flight': 0,
+            'executions': 2,
+            'coalesced': 0,
+            'kinds': {'pull': {'executions': 2, 'coalesced': 0}},
+        })
+
+    def test_coalesced(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(1)
+            release.wait(5)
+            return {'commit': 'abc'}
+
+        threads, results, errors = self.run_concurrently(flight, func, 5)
+        self.wait_for(lambda: flight.stats()['coalesced'] == 4)
+        self.assertEqual(flight.stats()['in_flight'], 1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'commit': 'abc'}] * 5)
+        self.assertEqual(errors, [])
+        stats = flight.stats()
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['executions'], 1)
+        self.assertEqual(stats['coalesced'], 4)
+
+    def test_coalesced_error(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def func():
+            release.wait(5)
+            raise ValueError('Boom!')
+
+        threads, results, errors = self.run_concurrently(flight, func, 3)
+        self.wait_for(lambda: flight.stats()['coalesced'] == 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(all(isinstance(e, ValueError) for e in errors))
+        # NOTE: errors are not remembered
+        self.assertEqual(flight.do('pull', ('repo', 'abc'), lambda: 1), 1)
+
+    def test_different_keys(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        thread = threading.Thread(
+            target=flight.do, args=('pull', ('repo', 'abc'), release.wait, 5))
+        thread.start()
+        self.wait_for(lambda: flight.stats()['in_flight'] == 1)
+        self.assertEqual(flight.do('pull', ('repo', 'def'), lambda: 1), 1)
+        self.assertEqual(flight.do('clone', ('repo', 'abc'), lambda: 2), 2)
+        release.set()
+        thread.join()
+        self.assertEqual(flight.stats()['coalesced'], 0)
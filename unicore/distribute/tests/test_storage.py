@@ -0,0 +1,225 @@
+import json
+import os
+import shutil
+import time
+
+from elasticgit.commands.avro import serialize
+from elasticgit.storage import StorageManager, StorageException
+from elasticgit.tests.base import TestPerson
+
+from git import Repo
+from git.exc import GitCommandError
+
+from unicore.distribute.storage import (
+    BareStorageManager, DeadlineGit, check_storable, clone_repo,
+    commit_changes, commit_diff, get_storage_manager, git_deadline,
+    is_repository_dir, store_changes, update_ref, head_commit)
+from unicore.distribute.tests.base import DistributeTestCase
+from unicore.distribute.utils import (
+    delete_content_type_object, format_content_type,
+    format_content_type_object, get_repository_names, list_schemas,
+    save_content_type_object, pull_repository_files)
+
+
+class TestBareStorage(DistributeTestCase):
+
+    def setUp(self):
+        self.workspace = self.mk_model_workspace(TestPerson)
+        self.person = TestPerson({'name': 'Foo', 'age': 1})
+        self.workspace.save(self.person, 'Saving a person.')
+        self.repo = self.mk_bare_clone(self.workspace)
+
+    def mk_bare_clone(self, workspace, suffix='bare'):
+        path = os.path.join(self.WORKING_DIR, '%s_%s' % (self.id(), suffix))
+        self.addCleanup(shutil.rmtree, path, True)
+        return clone_repo(workspace.working_dir, path, bare=True)
+
+    def assertValid(self, repo):
+        # NOTE: fails if trees aren't sorted the way git expects
+        repo.git.fsck('--strict')
+
+    def test_clone(self):
+        self.assertTrue(self.repo.bare)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.repo.git_dir, 'TestPerson')))
+        self.assertTrue(is_repository_dir(self.repo.git_dir))
+        self.assertIn(os.path.basename(self.repo.git_dir),
+                      get_repository_names(self.WORKING_DIR))
+        self.assertIsInstance(get_storage_manager(self.repo),
+                              BareStorageManager)
+        self.assertIsInstance(get_storage_manager(self.workspace.repo),
+                              StorageManager)
+
+    def test_reads(self):
+        self.assertEqual(list_schemas(self.repo),
+                         list_schemas(self.workspace.repo))
+        self.assertEqual(format_content_type(self.repo, 'elasticgit.tests.'
+                                             'base.TestPerson'),
+                         [dict(self.person)])
+        self.assertEqual(
+            list(get_storage_manager(self.repo).iterate(TestPerson)),
+            [self.person])
+
+    def test_commit_changes(self):
+        parent = head_commit(self.repo)
+        commit = commit_changes(self.repo, {
+            'a/b/c.txt': 'c',
+            'a/b.txt': 'b',
+            'a.txt': 'a',
+        }, 'Adding files.')
+        self.assertEqual(head_commit(self.repo), commit)
+        self.assertEqual(list(commit.parents), [parent])
+        self.assertEqual(commit.tree['a/b/c.txt'].data_stream.read(), 'c')
+        self.assertValid(self.repo)
+
+        commit = commit_changes(
+            self.repo, {'a/b/c.txt': None}, 'Removing a file.')
+        self.assertRaises(KeyError, lambda: commit.tree['a/b'])
+        self.assertEqual(commit.tree['a/b.txt'].data_stream.read(), 'b')
+        self.assertRaises(
+            StorageException, commit_changes, self.repo, {}, u'unicode')
+
+    def test_store_changes(self):
+        for repo in (self.repo, self.workspace.repo):
+            parent = repo.head.commit
+            commit = store_changes(repo, {
+                'a/b.txt': 'b',
+                'a.txt': u'\u00e4',
+            }, 'Adding files.')
+            commit = store_changes(repo, {
+                'a/b.txt': None,
+                'c.txt': 'c',
+            }, 'Changing files.')
+            self.assertEqual(repo.head.commit, commit)
+            self.assertEqual(list(commit.parents[0].parents), [parent])
+            self.assertEqual(
+                commit.tree['a.txt'].data_stream.read(), '\xc3\xa4')
+            self.assertRaises(KeyError, lambda: commit.tree['a/b.txt'])
+            self.assertRaises(
+                StorageException, store_changes, repo, {'d.txt': None},
+                'Removing a missing file.')
+        self.assertFalse(self.workspace.repo.is_dirty(untracked_files=True))
+
+    def test_update_ref(self):
+        head = head_commit(self.repo)
+        commit = commit_changes(self.repo, {'a.txt': 'a'}, 'Adding a file.')
+        ref_path = self.repo.head.reference.path
+        self.assertFalse(update_ref(self.repo, ref_path, head, head))
+        self.assertEqual(head_commit(self.repo), commit)
+        self.assertTrue(update_ref(self.repo, ref_path, head, commit))
+        self.assertEqual(head_commit(self.repo), head)
+
+    def test_save_and_delete(self):
+        person = TestPerson({'name': 'Bar', 'age': 2})
+        schema = json.loads(serialize(TestPerson))
+        commit, model = save_content_type_object(
+            self.repo, schema, person.uuid, dict(person))
+        self.assertEqual(model, person)
+        self.assertEqual(
+            format_content_type_object(
+                self.repo, 'elasticgit.tests.base.TestPerson', person.uuid),
+            dict(person))
+        self.assertValid(self.repo)
+
+        delete_content_type_object(
+            self.repo, 'elasticgit.tests.base.TestPerson', person.uuid)
+        self.assertEqual(format_content_type(self.repo, 'elasticgit.tests.'
+                                             'base.TestPerson'),
+                         [dict(self.person)])
+        self.assertRaises(
+            StorageException, get_storage_manager(self.repo).delete_data,
+            'does/not/exist.json', 'Deleting.')
+
+    def test_pull_fast_forward(self):
+        old_commit = head_commit(self.repo)
+        person = TestPerson({'name': 'Bar', 'age': 2})
+        self.workspace.save(person, 'Saving a person.')
+        changes = get_storage_manager(self.repo).pull()
+        self.assertEqual(head_commit(self.repo).hexsha,
+                         self.workspace.repo.head.commit.hexsha)
+        self.assertEqual([diff.b_blob.path for diff in changes],
+                         ['elasticgit.tests.base/TestPerson/%s.json' % (
+                             person.uuid,)])
+        files = pull_repository_files(self.repo, old_commit.hexsha)
+        self.assertEqual(files['elasticgit.tests.base.TestPerson'],
+                         [dict(person)])
+
+    def test_check_storable(self):
+        check_storable(self.person)
+        self.assertRaises(
+            StorageException, check_storable,
+            TestPerson({'name': 'Bar', 'age': 2, 'uuid': None}))
+        person = TestPerson({'name': 'Bar', 'age': 2})
+        person.set_read_only()
+        self.assertRaises(StorageException, check_storable, person)
+
+    def test_commit_diff(self):
+        path = os.path.join(self.WORKING_DIR, '%s_empty' % (self.id(),))
+        self.addCleanup(shutil.rmtree, path, True)
+        repo = Repo.init(path, bare=True)
+        root = commit_changes(repo, {'a.txt': 'a'}, 'Adding a file.')
+        [change] = commit_diff(root)
+        self.assertTrue(change.new_file)
+        self.assertEqual(change.b_blob.path, 'a.txt')
+        commit = commit_changes(
+            repo, {'a.txt': None, 'b.txt': 'b'}, 'Replacing a file.')
+        self.assertEqual(
+            sorted((change.a_blob or change.b_blob).path
+                   for change in commit_diff(commit)),
+            ['a.txt', 'b.txt'])
+
+    def test_pull_merge(self):
+        local = commit_changes(self.repo, {'a.txt': 'a'}, 'Adding a file.')
+        person = TestPerson({'name': 'Bar', 'age': 2})
+        self.workspace.save(person, 'Saving a person.')
+        get_storage_manager(self.repo).pull()
+        merge = head_commit(self.repo)
+        self.assertEqual(
+            [parent.hexsha for parent in merge.parents],
+            [local.hexsha, self.workspace.repo.head.commit.hexsha])
+        self.assertEqual(merge.tree['a.txt'].data_stream.read(), 'a')
+        self.assertEqual(
+            format_content_type_object(
+                self.repo, 'elasticgit.tests.base.TestPerson', person.uuid),
+            dict(person))
+        self.assertValid(self.repo)
+
+    def test_pull_conflict(self):
+        self.workspace.sm.store_data('a.txt', 'theirs', 'Adding a file.')
+        commit_changes(self.repo, {'a.txt': 'ours'}, 'Adding a file.')
+        head = head_commit(self.repo)
+        self.assertRaises(
+            StorageException, get_storage_manager(self.repo).pull)
+        self.assertEqual(head_commit(self.repo), head)
+
+
+class TestGitDeadline(DistributeTestCase):
+
+    def setUp(self):
+        self.repo = self.mk_workspace().repo
+        writer = self.repo.config_writer()
+        try:
+            # NOTE: a remote that hangs for 5 seconds
+            writer.set_value('protocol "ext"', 'allow', 'always')
+        finally:
+            writer.release()
+        self.repo.create_remote('hung', 'ext::sleep 5')
+
+    def test_remote_commands_killed(self):
+        with git_deadline(self.repo, time.time() + 0.2):
+            self.assertIsInstance(self.repo.git, DeadlineGit)
+            started = time.time()
+            self.assertRaises(
+                GitCommandError, self.repo.git.ls_remote, 'hung')
+            self.assertRaises(
+                GitCommandError, self.repo.remote('hung').fetch)
+            self.assertTrue(time.time() - started < 2)
+            # NOTE: local commands run regardless of the deadline
+            self.assertEqual(
+                self.repo.git.config('remote.hung.url'), 'ext::sleep 5')
+        self.assertNotIsInstance(self.repo.git, DeadlineGit)
+
+    def test_no_deadline(self):
+        git = self.repo.git
+        with git_deadline(self.repo, None):
+            self.assertIs(self.repo.git, git)
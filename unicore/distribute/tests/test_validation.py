@@ -0,0 +1,141 @@
+import json
+
+from unittest import TestCase
+
+import avro.schema
+from avro.io import validate
+
+from unicore.distribute.validation import (
+    CompiledValidator, ValidatorCache)
+
+
+SCHEMA = {
+    'type': 'record',
+    'name': 'Article',
+    'namespace': 'unicore.content',
+    'fields': [
+        {'name': 'uuid', 'type': 'string'},
+        {'name': 'title', 'type': ['null', 'string']},
+        {'name': 'position', 'type': 'int'},
+        {'name': 'views', 'type': 'long'},
+        {'name': 'score', 'type': 'double'},
+        {'name': 'featured', 'type': 'boolean'},
+        {'name': 'status', 'type': {
+            'type': 'enum', 'name': 'Status',
+            'symbols': ['draft', 'published']}},
+        {'name': 'checksum', 'type': {
+            'type': 'fixed', 'name': 'MD5', 'size': 16}},
+        {'name': 'tags', 'type': {'type': 'array', 'items': 'string'}},
+        {'name': 'meta', 'type': {'type': 'map', 'values': 'long'}},
+        {'name': 'author', 'type': ['null', {
+            'type': 'record', 'name': 'Author',
+            'fields': [
+                {'name': 'name', 'type': 'string'},
+                {'name': 'status', 'type': 'Status'},
+            ]}]},
+        {'name': 'editors', 'type': {
+            'type': 'array', 'items': 'unicore.content.Author'}},
+    ],
+}
+
+VALID = {
+    'uuid': 'the-uuid',
+    'title': None,
+    'position': 1,
+    'views': 2 ** 40,
+    'score': 1.5,
+    'featured': False,
+    'status': 'draft',
+    'checksum': '0123456789abcdef',
+    'tags': ['a', u'b'],
+    'meta': {'a': 1},
+    'author': {'name': 'Foo', 'status': 'published'},
+    'editors': [],
+}
+
+
+class TestCompiledValidator(TestCase):
+
+    def setUp(self):
+        self.validator = CompiledValidator(SCHEMA)
+        self.avro_schema = avro.schema.parse(json.dumps(SCHEMA))
+
+    def assertSameAsAvro(self, datum):
+        self.assertEqual(
+            self.validator.is_valid(datum),
+            validate(self.avro_schema, datum), datum)
+
+    def test_same_as_avro(self):
+        self.assertTrue(self.validator.is_valid(VALID))
+        changes = [
+            ('uuid', None), ('uuid', 1),
+            ('title', u'A title'), ('title', 1),
+            ('position', 2 ** 31), ('position', True), ('position', 1.0),
+            ('views', 2 ** 63), ('views', '1'),
+            ('score', 1), ('score', None),
+            ('featured', 0),
+            ('status', 'deleted'), ('status', ['draft']),
+            ('checksum', 'short'), ('checksum', u'0123456789abcdef'),
+            ('tags', ('a',)), ('tags', [1]),
+            ('meta', {'a': 'b'}), ('meta', {1: 1}), ('meta', []),
+            ('author', None), ('author', {'name': 'Foo'}),
+            ('editors', [VALID['author'], {'name': 1}]),
+            ('editors', [VALID['author']]),
+        ]
+        for name, value in changes:
+            self.assertSameAsAvro(dict(VALID, **{name: value}))
+        self.assertSameAsAvro(None)
+        self.assertSameAsAvro([])
+
+    def test_errors(self):
+        self.assertEqual(self.validator.errors(VALID), [])
+        datum = dict(VALID, position='1', tags=['a', 2], meta={'a': None},
+                     author={'name': 'Foo', 'status': 'deleted'},
+                     editors=[VALID['author'], {}])
+        del datum['uuid']
+        self.assertEqual(self.validator.errors(datum), [
+            ('uuid', 'Required.'),
+            ('position', "'1' is not a valid int"),
+            ('tags[1]', '2 is not a valid string'),
+            ('meta.a', 'None is not a valid long'),
+            ('author.status', "'deleted' is not one of draft, published"),
+            ('editors[1].name', 'Required.'),
+            ('editors[1].status', 'Required.'),
+        ])
+        self.assertEqual(self.validator.errors([]), [
+            ('', '[] is not a valid unicore.content.Article')])
+
+    def test_recursive(self):
+        validator = CompiledValidator({
+            'type': 'record', 'name': 'Node',
+            'fields': [
+                {'name': 'value', 'type': 'int'},
+                {'name': 'next', 'type': ['null', 'Node']},
+            ]})
+        self.assertTrue(validator.is_valid(
+            {'value': 1, 'next': {'value': 2, 'next': None}}))
+        self.assertEqual(
+            validator.errors({'value': 1, 'next': {'value': 'a'}}),
+            [('next.value', "'a' is not a valid int")])
+
+    def test_unknown_type(self):
+        self.assertRaises(ValueError, CompiledValidator, {
+            'type': 'record', 'name': 'Foo',
+            'fields': [{'name': 'bar', 'type': 'Bar'}]})
+
+
+class TestValidatorCache(TestCase):
+
+    def test_get(self):
+        cache = ValidatorCache(max_size=1)
+        source = json.dumps(SCHEMA)
+        validator = cache.get(source)
+        self.assertIs(cache.get(str(source)), validator)
+        self.assertEqual(cache.stats(), {
+            'size': 1,
+            'max_size': 1,
+            'hits': 1,
+            'misses': 1,
+        })
+        cache.get(json.dumps({'type': 'string'}))
+        self.assertIsNot(cache.get(source), validator)
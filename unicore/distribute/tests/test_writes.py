@@ -0,0 +1,124 @@
+import threading
+
+from mock import Mock
+
+from elasticgit.storage import StorageException
+from elasticgit.tests.base import TestPerson
+
+from unicore.distribute.tests.base import DistributeTestCase
+from unicore.distribute.utils import get_repository
+from unicore.distribute.writes import WriteQueue, get_write_queues
+
+
+class TestWriteQueue(DistributeTestCase):
+
+    def setUp(self):
+        self.workspace = self.mk_model_workspace(TestPerson)
+        self.repo = self.workspace.repo
+
+    def write_concurrently(self, queue, writes):
+        results = [None] * len(writes)
+
+        def write(i, changes):
+            # NOTE: every thread uses a handle of its own, like requests
+            repo = get_repository(self.repo.working_dir)
+            try:
+                results[i] = queue.write(repo, changes, 'Write %s.' % (i,))
+            except Exception, e:
+                results[i] = e
+
+        threads = [threading.Thread(target=write, args=(i, changes))
+                   for i, changes in enumerate(writes)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_write(self):
+        queue = WriteQueue()
+        parent = self.repo.head.commit
+        commit = queue.write(self.repo, {'a.txt': 'a'}, 'Adding a file.')
+        self.assertEqual(self.repo.head.commit, commit)
+        self.assertEqual(list(commit.parents), [parent])
+        self.assertEqual(commit.message, 'Adding a file.')
+        self.assertEqual(queue.stats(), {
+            'pending': 0,
+            'writes': 1,
+            'commits': 1,
+            'grouped': 0,
+            'largest_group': 1,
+        })
+
+    def test_group_commit(self):
+        queue = WriteQueue(window=0.2)
+        head = self.repo.head.commit
+        results = self.write_concurrently(
+            queue, [{'%s.txt' % (i,): str(i)} for i in range(10)])
+
+        commit = self.repo.head.commit
+        self.assertEqual(
+            set(result.hexsha for result in results), set([commit.hexsha]))
+        self.assertEqual(list(commit.parents), [head])
+        self.assertTrue(commit.message.startswith(
+            'Group commit of 10 writes.'))
+        for i in range(10):
+            self.assertEqual(
+                commit.tree['%s.txt' % (i,)].data_stream.read(), str(i))
+        self.assertEqual(queue.stats()['commits'], 1)
+        self.assertEqual(queue.stats()['grouped'], 10)
+        self.assertFalse(self.repo.is_dirty(untracked_files=True))
+
+    def test_max_group_size(self):
+        queue = WriteQueue(window=0.2, max_group_size=3)
+        results = self.write_concurrently(
+            queue, [{'%s.txt' % (i,): str(i)} for i in range(7)])
+        # NOTE: the first leader's group fills up while it waits, the
+        #       others are committed by the callers it hands over to.
+        self.assertEqual(len(set(result.hexsha for result in results)), 3)
+        self.assertEqual(queue.stats()['commits'], 3)
+        self.assertEqual(queue.stats()['largest_group'], 3)
+        self.assertEqual(queue.stats()['pending'], 0)
+
+    def test_failed_write_in_group(self):
+        queue = WriteQueue(window=0.2)
+        results = self.write_concurrently(queue, [
+            {'a.txt': 'a'},
+            {'missing.txt': None},
+            {'b.txt': 'b'},
+        ])
+        self.assertIsInstance(results[1], StorageException)
+        tree = self.repo.head.commit.tree
+        self.assertEqual(tree['a.txt'].data_stream.read(), 'a')
+        self.assertEqual(tree['b.txt'].data_stream.read(), 'b')
+        self.assertEqual(queue.stats()['commits'], 2)
+        self.assertFalse(self.repo.is_dirty(untracked_files=True))
+
+    def test_exclusive(self):
+        queue = WriteQueue()
+        written = threading.Event()
+
+        def write():
+            queue.write(self.repo, {'a.txt': 'a'}, 'Adding a file.')
+            written.set()
+
+        with queue.exclusive():
+            thread = threading.Thread(target=write)
+            thread.start()
+            self.assertFalse(written.wait(0.1))
+        thread.join()
+        self.assertTrue(written.is_set())
+
+    def test_get_write_queues(self):
+        registry = Mock(spec=['settings'], settings={
+            'repo.write_window': '0.5',
+            'repo.write_max_group_size': '10',
+        })
+        queues = get_write_queues(registry)
+        self.assertIs(get_write_queues(registry), queues)
+        queue = queues.get('repo')
+        self.assertIs(queues.get('repo'), queue)
+        self.assertEqual(queue.window, 0.5)
+        self.assertEqual(queue.max_group_size, 10)
+        queue.write(self.repo, {'a.txt': 'a'}, 'Adding a file.')
+        self.assertEqual(queues.stats()['commits'], 1)
@@ -1,7 +1,7 @@
-import glob
 import json
 import os
 import re
+import zlib
 
 from datetime import datetime
 
@@ -12,12 +12,14 @@ from git import Repo
 from git.exc import (
     InvalidGitRepositoryError, NoSuchPathError, GitCommandError, BadName)
 
-import avro.schema
-
 from elasticutils import get_es as get_es_object
 
 from elasticgit.commands.avro import deserialize
-from elasticgit.storage import StorageManager
+from elasticgit.storage import StorageManager, StorageException
+
+from unicore.distribute.schemas import schema_registry
+from unicore.distribute.storage import (
+    check_storable, get_storage_manager, is_repository_dir, store_changes)
 
 
 class UCConfigParser(ConfigParser):
@@ -80,8 +82,7 @@ def get_repositories(path):
     """
     return [get_repository(os.path.join(path, subdir))
             for subdir in os.listdir(path)
-            if os.path.isdir(
-            os.path.join(path, subdir, '.git'))]
+            if is_repository_dir(os.path.join(path, subdir))]
 
 
 def get_repository_names(path):
@@ -95,7 +96,7 @@ def get_repository_names(path):
     """
     return [subdir
             for subdir in os.listdir(path)
-            if os.path.isdir(os.path.join(path, subdir, '.git'))]
+            if is_repository_dir(os.path.join(path, subdir))]
 
 
 def get_repository(path):
@@ -123,72 +124,105 @@ def get_index_prefix(path):
     return os.path.basename(path).lower()
 
 
-def list_schemas(repo):
+def get_commit(repo, commit_id=None):
+    """
+    Return the commit to read a repository's content from.
+
+    Content is read from the commit's tree rather than from the working
+    directory, so reads see a consistent snapshot and don't depend on
+    what is checked out.
+
+    :param Repo repo:
+        The git repository.
+    :param str commit_id:
+        The (possibly abbreviated) commit id, defaults to HEAD.
+    :returns: git.Commit
+    """
+    try:
+        if commit_id is None:
+            return repo.head.commit
+        return repo.commit(commit_id)
+    except (GitCommandError, BadName, ValueError):
+        raise NotFound("The git index does not exist")
+
+
+def read_blob(commit, path):
+    """
+    Return the contents of a file in a commit's tree.
+
+    :param git.Commit commit:
+        The commit.
+    :param str path:
+        The path of the file in the repository.
+    :returns: str
+    :raises KeyError: if the file does not exist in the commit.
+    """
+    return commit.tree[path].data_stream.read()
+
+
+def list_schemas(repo, commit_id=None):
     """
     Return a list of parsed avro schemas as dictionaries.
 
     :param Repo repo:
         The git repository.
+    :param str commit_id:
+        The commit to read from, defaults to HEAD.
     :returns: dict
     """
-    schema_files = glob.glob(
-        os.path.join(repo.working_dir, '_schemas', '*.avsc'))
-    schemas = {}
-    for schema_file in schema_files:
-        with open(schema_file, 'r') as fp:
-            schema = json.load(fp)
-            schemas['%(namespace)s.%(name)s' % schema] = schema
-    return schemas
+    return get_schema_set(repo, commit_id).schemas()
 
 
-def list_content_types(repo):
+def list_content_types(repo, commit_id=None):
     """
     Return a list of content types in a repository.
 
     :param Repo repo:
         The git repository.
+    :param str commit_id:
+        The commit to read from, defaults to HEAD.
     :returns: list
     """
-    schema_files = glob.glob(
-        os.path.join(repo.working_dir, '_schemas', '*.avsc'))
-    return [os.path.splitext(os.path.basename(schema_file))[0]
-            for schema_file in schema_files]
+    return get_schema_set(repo, commit_id).content_types()
+
+
+def get_schema_set(repo, commit_id=None):
+    if commit_id is None:
+        return schema_registry.get(repo)
+    return schema_registry.get(repo, get_commit(repo, commit_id).hexsha)
 
 
-def get_schema(repo, content_type):
+def get_schema(repo, content_type, commit_id=None):
     """
     Return a schema for a content type in a repository.
 
     :param Repo repo:
         The git repository.
+    :param str commit_id:
+        The commit to read from, defaults to HEAD.
     :returns: dict
     """
     try:
-        with open(
-                os.path.join(repo.working_dir,
-                             '_schemas',
-                             '%s.avsc' % (content_type,)), 'r') as fp:
-            data = fp.read()
-            return avro.schema.parse(data)
-    except IOError:  # pragma: no cover
+        return get_schema_set(repo, commit_id).get_schema(content_type)
+    except KeyError:
         raise NotFound('Schema does not exist.')
 
 
-def get_mapping(repo, content_type):
+def get_mapping(repo, content_type, commit_id=None):
     """
     Return an ES mapping for a content type in a repository.
 
     :param Repo repo:
         This git repository.
+    :param str commit_id:
+        The commit to read from, defaults to HEAD.
     :returns: dict
     """
     try:
-        with open(
-            os.path.join(repo.working_dir,
-                         '_mappings',
-                         '%s.json' % (content_type,)), 'r') as fp:
-            return json.load(fp)
-    except IOError:
+        return json.loads(read_blob(
+            get_commit(repo, commit_id),
+            '_mappings/%s.json' % (content_type,)))
+    except KeyError:
         raise NotFound('Mapping does not exist.')
 
 
@@ -290,24 +324,249 @@ def format_diffindex(diff_index):
             yield format_diff_M(diff)
 
 
-def format_content_type(repo, content_type):
+def get_model_tree(storage_manager, model_class, commit):
     """
-    Return a list of all content objects for a given content type
-    in a repository.
+    Return the tree with a model class' objects in a commit, or
+    ``None`` if the commit has no objects of the class.
+
+    :param StorageManager storage_manager:
+        The repository's storage manager.
+    :param class model_class:
+        The model class.
+    :param git.Commit commit:
+        The commit.
+    :returns: git.Tree
+    """
+    try:
+        return commit.tree[storage_manager.git_path(model_class)]
+    except KeyError:
+        return None
+
+
+def list_tree_uuids(storage_manager, tree):
+    """
+    Return the sorted uuids of the objects stored in a tree.
+
+    :param StorageManager storage_manager:
+        The repository's storage manager.
+    :param git.Tree tree:
+        The tree, see :py:func:`get_model_tree`.
+    :returns: list
+    """
+    if tree is None:
+        return []
+    suffix = '.%s' % (storage_manager.serializer.suffix,)
+    return sorted(
+        blob.name[:-len(suffix)] for blob in tree.blobs
+        if blob.name.endswith(suffix))
+
+
+def load_tree_object(storage_manager, model_class, tree, uuid):
+    """
+    Return a model instance from a tree without touching the working
+    directory.
+
+    :param StorageManager storage_manager:
+        The repository's storage manager.
+    :param class model_class:
+        The model class.
+    :param git.Tree tree:
+        The tree, see :py:func:`get_model_tree`.
+    :param str uuid:
+        The uuid of the object.
+    :returns: elasticgit.models.Model
+    :raises KeyError: if the object does not exist.
+    """
+    if tree is None:
+        raise KeyError(uuid)
+    blob = tree['%s.%s' % (uuid, storage_manager.serializer.suffix)]
+    model = storage_manager.serializer.deserialize(
+        model_class, blob.data_stream.read())
+    if model.uuid != uuid:
+        raise StorageException(
+            'Data uuid (%s) does not match requested uuid (%s).' % (
+                model.uuid, uuid))
+    return model
+
+
+def iterate_model_objects(storage_manager, model_class, commit, uuids=None):
+    """
+    Return a generator of model instances of a class stored in a
+    commit, ordered by uuid.
+
+    :param StorageManager storage_manager:
+        The repository's storage manager.
+    :param class model_class:
+        The model class.
+    :param git.Commit commit:
+        The commit.
+    :param list uuids:
+        The uuids of the objects to load, defaults to all of them.
+    :returns: generator
+    """
+    tree = get_model_tree(storage_manager, model_class, commit)
+    if uuids is None:
+        uuids = list_tree_uuids(storage_manager, tree)
+    for uuid in uuids:
+        yield load_tree_object(storage_manager, model_class, tree, uuid)
+
+
+def list_content_type_uuids(repo, content_type, commit_id=None):
+    """
+    Return the sorted uuids of all content objects for a given content
+    type in a repository.
 
     :param Repo repo:
         The git repository.
     :param str content_type:
         The content type to list
+    :param str commit_id:
+        The commit to read from, defaults to HEAD.
     :returns: list
     """
+    commit = get_commit(repo, commit_id)
     storage_manager = StorageManager(repo)
-    model_class = load_model_class(repo, content_type)
-    return [dict(model_obj)
-            for model_obj in storage_manager.iterate(model_class)]
+    model_class = load_model_class(repo, content_type, commit.hexsha)
+    return list_tree_uuids(
+        storage_manager,
+        get_model_tree(storage_manager, model_class, commit))
+
+
+def paginate_uuids(uuids, offset=0, after=None, limit=None):
+    """
+    Return a page of a sorted list of uuids.
+
+    :param list uuids:
+        The sorted uuids.
+    :param int offset:
+        The number of uuids to skip.
+    :param str after:
+        Only return uuids sorting after this cursor.
+    :param int limit:
+        The maximum number of uuids to return.
+    :returns: list
+    """
+    if after is not None:
+        uuids = [uuid for uuid in uuids if uuid > after]
+    uuids = uuids[offset:]
+    if limit is not None:
+        uuids = uuids[:limit]
+    return uuids
+
+
+def iterate_content_type(repo, content_type, uuids=None, commit_id=None):
+    """
+    Return a generator of content objects for a given content type
+    in a repository, ordered by uuid.
+
+    :param Repo repo:
+        The git repository.
+    :param str content_type:
+        The content type to list
+    :param list uuids:
+        The uuids of the objects to load, defaults to all of them.
+    :param str commit_id:
+        The commit to read from, defaults to HEAD.
+    :returns: generator
+    """
+    commit = get_commit(repo, commit_id)
+    storage_manager = StorageManager(repo)
+    model_class = load_model_class(repo, content_type, commit.hexsha)
+    for model in iterate_model_objects(
+            storage_manager, model_class, commit, uuids):
+        yield dict(model)
+
+
+def format_content_type(repo, content_type, offset=0, after=None,
+                        limit=None, commit_id=None):
+    """
+    Return a list of all content objects for a given content type
+    in a repository, ordered by uuid.
+
+    :param Repo repo:
+        The git repository.
+    :param str content_type:
+        The content type to list
+    :param int offset:
+        The number of objects to skip.
+    :param str after:
+        Only return objects with a uuid sorting after this cursor.
+    :param int limit:
+        The maximum number of objects to return.
+    :param str commit_id:
+        The commit to read from, defaults to HEAD.
+    :returns: list
+    """
+    commit_id = get_commit(repo, commit_id).hexsha
+    uuids = paginate_uuids(
+        list_content_type_uuids(repo, content_type, commit_id),
+        offset=offset, after=after, limit=limit)
+    return list(iterate_content_type(
+        repo, content_type, uuids, commit_id=commit_id))
+
+
+def stream_json_list(iterable):
+    """
+    Return a generator that encodes an iterable as a JSON array one
+    item at a time, suitable for use as a WSGI ``app_iter``.
+
+    :param iterable:
+        The JSON serializable items.
+    :returns: generator
+    """
+    return stream_encoded_json_list(json.dumps(item) for item in iterable)
+
+
+def stream_encoded_json_list(iterable):
+    """
+    Return a generator that joins already JSON encoded items into a
+    JSON array one item at a time.
+
+    :param iterable:
+        The JSON encoded items.
+    :returns: generator
+    """
+    yield '['
+    separator = ''
+    for item in iterable:
+        yield separator + item
+        separator = ','
+    yield ']'
+
+
+def stream_ndjson(iterable):
+    """
+    Return a generator that encodes an iterable as newline delimited
+    JSON, one item per line.
 
+    :param iterable:
+        The JSON serializable items.
+    :returns: generator
+    """
+    for item in iterable:
+        yield json.dumps(item) + '\n'
+
+
+def stream_gzip(chunks, level=6):
+    """
+    Return a generator that gzip compresses a stream of chunks.
+
+    :param chunks:
+        An iterable of byte strings.
+    :param int level:
+        The compression level.
+    :returns: generator
+    """
+    # NOTE: a wbits value of 16 + MAX_WBITS writes a gzip header & trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
-def format_content_type_object(repo, content_type, uuid):
+
+def format_content_type_object(repo, content_type, uuid, commit_id=None):
     """
     Return a content object from a repository for a given content_type
     and uuid
@@ -316,13 +575,18 @@ def format_content_type_object(repo, content_type, uuid):
         The git repository.
     :param str content_type:
         The content type to list
+    :param str commit_id:
+        The commit to read from, defaults to HEAD.
     :returns: dict
     """
+    commit = get_commit(repo, commit_id)
+    storage_manager = StorageManager(repo)
+    model_class = load_model_class(repo, content_type, commit.hexsha)
     try:
-        storage_manager = StorageManager(repo)
-        model_class = load_model_class(repo, content_type)
-        return dict(storage_manager.get(model_class, uuid))
-    except GitCommandError:
+        return dict(load_tree_object(
+            storage_manager, model_class,
+            get_model_tree(storage_manager, model_class, commit), uuid))
+    except KeyError:
         raise NotFound('Object does not exist.')
 
 
@@ -347,29 +611,89 @@ def format_repo_status(repo):
     }
 
 
-def save_content_type_object(repo, schema, uuid, data):
+def save_content_type_object(repo, schema, uuid, data, write_queue=None):
     """
-    Save an object as a certain content type
+    Save an object as a certain content type, through ``write_queue``
+    if given.
     """
-    storage_manager = StorageManager(repo)
-    model_class = deserialize(schema,
-                              module_name=schema['namespace'])
+    storage_manager = get_storage_manager(repo)
+    try:
+        # NOTE: reuse the model class generated for the HEAD commit
+        model_class = load_model_class(
+            repo, '%(namespace)s.%(name)s' % schema)
+    except NotFound:
+        model_class = deserialize(schema,
+                                  module_name=schema['namespace'])
     model = model_class(data)
-    commit = storage_manager.store(model, 'Updated via PUT request.')
+    message = 'Updated via PUT request.'
+    if write_queue is None:
+        commit = storage_manager.store(model, message)
+    else:
+        check_storable(model)
+        commit = write_queue.write(repo, {
+            storage_manager.git_name(model):
+                storage_manager.serializer.serialize(model),
+        }, message)
     return commit, model
 
 
-def delete_content_type_object(repo, content_type, uuid):
+def delete_content_type_object(repo, content_type, uuid, write_queue=None):
     """
-    Delete an object of a certain content type
+    Delete an object of a certain content type, through ``write_queue``
+    if given.
     """
-    storage_manager = StorageManager(repo)
+    storage_manager = get_storage_manager(repo)
     model_class = load_model_class(repo, content_type)
     model = storage_manager.get(model_class, uuid)
-    commit = storage_manager.delete(model, 'Deleted via DELETE request.')
+    message = 'Deleted via DELETE request.'
+    if write_queue is None:
+        commit = storage_manager.delete(model, message)
+    else:
+        commit = write_queue.write(
+            repo, {storage_manager.git_name(model): None}, message)
     return commit, model
 
 
+def apply_content_type_operations(repo, operations, message,
+                                  write_queue=None):
+    """
+    Create, update and delete objects of any content type as a single
+    commit.
+
+    :param Repo repo:
+        The git repository.
+    :param list operations:
+        Dictionaries with an ``action``, ``content_type``, ``uuid`` and,
+        unless deleting, ``data``.
+    :param str message:
+        The commit message.
+    :param WriteQueue write_queue:
+        The queue to commit through, the commit is made straight away
+        if not given.
+    :returns: tuple
+        The commit and a list of ``(action, model)`` tuples.
+    """
+    storage_manager = get_storage_manager(repo)
+    changes = {}
+    models = []
+    for operation in operations:
+        model_class = load_model_class(repo, operation['content_type'])
+        if operation['action'] == 'delete':
+            model = storage_manager.get(model_class, operation['uuid'])
+            changes[storage_manager.git_name(model)] = None
+        else:
+            model = model_class(operation['data'])
+            check_storable(model)
+            changes[storage_manager.git_name(model)] = (
+                storage_manager.serializer.serialize(model))
+        models.append((operation['action'], model))
+    if write_queue is None:
+        commit = store_changes(repo, changes, message)
+    else:
+        commit = write_queue.write(repo, changes, message)
+    return commit, models
+
+
 def get_config(request):  # pragma: no cover
     """
     Get the configuration for a request.
@@ -394,6 +718,20 @@ def get_es_settings(config):
     }
 
 
+def is_indexing_enabled(config):
+    """
+    Return whether changes to repositories are indexed in Elasticsearch,
+    based on the config or ENV.
+
+    :param dict config:
+        The app configuration
+    :returns: bool
+    """
+    indexing_enabled = os.environ.get('INDEXING_ENABLED') or config.get(
+        'es.indexing_enabled', 'false')
+    return indexing_enabled.lower() == 'true'
+
+
 def get_es(config):
     """
     Return the :py:class:`elasticsearch.Elasticsearch` object based
@@ -406,7 +744,7 @@ def get_es(config):
     return get_es_object(**get_es_settings(config))
 
 
-def load_model_class(repo, content_type):
+def load_model_class(repo, content_type, commit_id=None):
     """
     Return a model class for a content type in a repository.
 
@@ -414,10 +752,14 @@ def load_model_class(repo, content_type):
         The git repository.
     :param str content_type:
         The content type to list
+    :param str commit_id:
+        The commit to read the schema from, defaults to HEAD.
     :returns: class
     """
-    schema = get_schema(repo, content_type).to_json()
-    return deserialize(schema, module_name=schema['namespace'])
+    try:
+        return get_schema_set(repo, commit_id).get_model_class(content_type)
+    except KeyError:
+        raise NotFound('Schema does not exist.')
 
 
 def add_model_item_to_pull_dict(storage_manager, path, pull_dict):
@@ -429,6 +771,37 @@ def add_model_item_to_pull_dict(storage_manager, path, pull_dict):
     return False
 
 
+def add_blob_to_pull_dict(repo, storage_manager, blob, pull_dict,
+                          commit_id=None):
+    """
+    Add the content object stored in a blob to a pull payload, reading
+    it from the object database rather than the working directory.
+
+    :param Repo repo:
+        The git repository.
+    :param StorageManager storage_manager:
+        The repository's storage manager.
+    :param git.Blob blob:
+        The blob.
+    :param dict pull_dict:
+        The content objects by content type.
+    :param str commit_id:
+        The commit to read the schema from, defaults to HEAD.
+    :returns: bool
+        Whether the blob is a content object.
+    """
+    suffix = '.%s' % (storage_manager.serializer.suffix,)
+    directory, _, file_name = blob.path.rpartition('/')
+    content_type = directory.replace('/', '.')
+    if not file_name.endswith(suffix) or content_type not in pull_dict:
+        return False
+    model_class = load_model_class(repo, content_type, commit_id)
+    model = storage_manager.serializer.deserialize(
+        model_class, blob.data_stream.read())
+    pull_dict[content_type].append(dict(model))
+    return True
+
+
 def get_repository_diff(repo, commit_id):
     try:
         old_commit = repo.commit(commit_id)
@@ -445,22 +818,23 @@ def get_repository_diff(repo, commit_id):
 
 
 def pull_repository_files(repo, commit_id):
+    head = get_commit(repo)
     changed_files = {}
-    for name in list_content_types(repo):
+    for name in list_content_types(repo, head.hexsha):
         changed_files[name] = []
 
     try:
         old_commit = repo.commit(commit_id)
-        diff = old_commit.diff(repo.head)
+        diff = old_commit.diff(head)
 
         sm = StorageManager(repo)
         for diff_added in diff.iter_change_type('A'):
-            add_model_item_to_pull_dict(
-                sm, diff_added.b_blob.path, changed_files)
+            add_blob_to_pull_dict(
+                repo, sm, diff_added.b_blob, changed_files, head.hexsha)
 
         for diff_modified in diff.iter_change_type('M'):
-            add_model_item_to_pull_dict(
-                sm, diff_modified.b_blob.path, changed_files)
+            add_blob_to_pull_dict(
+                repo, sm, diff_modified.b_blob, changed_files, head.hexsha)
 
         json_diff = []
         for diff_added in diff.iter_change_type('R'):
@@ -470,17 +844,45 @@ def pull_repository_files(repo, commit_id):
             json_diff.append(format_diff_D(diff_removed))
 
         changed_files["other"] = json_diff
-        changed_files["commit"] = repo.head.commit.hexsha
+        changed_files["commit"] = head.hexsha
         return changed_files
 
     except (GitCommandError, BadName):
         raise NotFound("The git index does not exist")
 
 
-def clone_repository(repo):
+def iterate_repository_objects(repo, commit_id=None):
+    """
+    Return a generator of all content objects in a repository, one
+    content type at a time.
+
+    .. code::
+        {
+            'content_type': 'unicore.content.models.Page',
+            'data': {'uuid': '...', ...}
+        }
+
+    :param Repo repo:
+        The git repository.
+    :param str commit_id:
+        The commit to read from, defaults to HEAD.
+    :returns: generator
+    """
+    commit_id = get_commit(repo, commit_id).hexsha
+    for content_type in list_content_types(repo, commit_id):
+        for data in iterate_content_type(
+                repo, content_type, commit_id=commit_id):
+            yield {
+                'content_type': content_type,
+                'data': data,
+            }
+
+
+def clone_repository(repo, commit_id=None):
+    commit_id = get_commit(repo, commit_id).hexsha
     files = {}
-    for name in list_content_types(repo):
-        files[name] = format_content_type(repo, name)
+    for name in list_content_types(repo, commit_id):
+        files[name] = format_content_type(repo, name, commit_id=commit_id)
 
-    files['commit'] = repo.head.commit.hexsha
+    files['commit'] = commit_id
     return files
@@ -0,0 +1,324 @@
+import hashlib
+import json
+import threading
+
+from collections import OrderedDict
+
+from avro.io import (
+    INT_MIN_VALUE, INT_MAX_VALUE, LONG_MIN_VALUE, LONG_MAX_VALUE)
+
+
+PRIMITIVE_CHECKS = {
+    'null': lambda datum: datum is None,
+    'boolean': lambda datum: isinstance(datum, bool),
+    'string': lambda datum: isinstance(datum, basestring),
+    'bytes': lambda datum: isinstance(datum, str),
+    'int': lambda datum: (
+        isinstance(datum, (int, long)) and
+        INT_MIN_VALUE <= datum <= INT_MAX_VALUE),
+    'long': lambda datum: (
+        isinstance(datum, (int, long)) and
+        LONG_MIN_VALUE <= datum <= LONG_MAX_VALUE),
+    'float': lambda datum: isinstance(datum, (int, long, float)),
+    'double': lambda datum: isinstance(datum, (int, long, float)),
+}
+
+
+def join_path(*names):
+    return '.'.join(name for name in names if name)
+
+
+class Node(object):
+    """
+    A compiled schema: ``check`` returns whether a datum is valid and
+    ``explain`` adds ``(path, message)`` tuples for what isn't.
+    """
+
+    def __init__(self, type_name, check=None, explain=None):
+        self.type_name = type_name
+        self.check = check
+        self.explain = explain or self.explain_type
+
+    def explain_type(self, datum, path, errors):
+        if not self.check(datum):
+            errors.append((path, '%r is not a valid %s' % (
+                datum, self.type_name)))
+
+
+class SchemaCompiler(object):
+    """
+    Turns the JSON of an Avro schema into Python closures that
+    validate data the same way :py:func:`avro.io.validate` does,
+    without walking the parsed schema for every datum.
+    """
+
+    def __init__(self):
+        # full name -> Node, for references to named types
+        self.names = {}
+
+    def full_name(self, name, namespace):
+        if '.' in name or not namespace:
+            return name
+        return '%s.%s' % (namespace, name)
+
+    def compile(self, schema, namespace=None):
+        if isinstance(schema, list):
+            return self.compile_union(schema, namespace)
+        if isinstance(schema, basestring):
+            if schema in PRIMITIVE_CHECKS:
+                return Node(schema, PRIMITIVE_CHECKS[schema])
+            return self.reference(schema, namespace)
+
+        schema_type = schema['type']
+        if schema_type in PRIMITIVE_CHECKS:
+            return Node(schema_type, PRIMITIVE_CHECKS[schema_type])
+        compile_type = getattr(self, 'compile_%s' % (schema_type,), None)
+        if compile_type is None:
+            if isinstance(schema_type, (list, dict)):
+                return self.compile(schema_type, namespace)
+            return self.reference(schema_type, namespace)
+        return compile_type(schema, namespace)
+
+    def reference(self, name, namespace):
+        try:
+            node = self.names[self.full_name(name, namespace)]
+        except KeyError:
+            try:
+                node = self.names[name]
+            except KeyError:
+                raise ValueError('Unknown type %r' % (name,))
+        # NOTE: the named type may still be being compiled if it refers
+        #       to itself, so look its closures up when called.
+        return Node(
+            node.type_name,
+            lambda datum: node.check(datum),
+            lambda datum, path, errors: node.explain(datum, path, errors))
+
+    def named(self, schema, namespace):
+        namespace = schema.get('namespace', namespace)
+        name = self.full_name(schema['name'], namespace)
+        node = Node(name)
+        self.names[name] = node
+        # NOTE: names in a named type resolve to its own namespace
+        return node, name.rpartition('.')[0] or None
+
+    def compile_union(self, schemas, namespace):
+        branches = [self.compile(schema, namespace) for schema in schemas]
+        checks = [branch.check for branch in branches]
+        type_name = ' or '.join(branch.type_name for branch in branches)
+
+        def check(datum):
+            for branch_check in checks:
+                if branch_check(datum):
+                    return True
+            return False
+
+        node = Node(type_name, check)
+        not_null = [branch for branch in branches
+                    if branch.type_name != 'null']
+        if len(not_null) == 1:
+            # NOTE: optional values, explain why the value is invalid
+            def explain(datum, path, errors):
+                if datum is not None and not check(datum):
+                    not_null[0].explain(datum, path, errors)
+            node.explain = explain
+        return node
+
+    def compile_record(self, schema, namespace):
+        node, namespace = self.named(schema, namespace)
+        fields = [
+            (field['name'], self.compile(field['type'], namespace))
+            for field in schema['fields']]
+        field_checks = [(name, field.check) for name, field in fields]
+
+        def check(datum):
+            if not isinstance(datum, dict):
+                return False
+            get = datum.get
+            for name, field_check in field_checks:
+                if not field_check(get(name)):
+                    return False
+            return True
+
+        def explain(datum, path, errors):
+            if not isinstance(datum, dict):
+                errors.append((path, '%r is not a valid %s' % (
+                    datum, node.type_name)))
+                return
+            for name, field in fields:
+                if name not in datum and not field.check(None):
+                    errors.append((join_path(path, name), 'Required.'))
+                    continue
+                field.explain(datum.get(name), join_path(path, name), errors)
+
+        node.check = check
+        node.explain = explain
+        return node
+
+    compile_error = compile_record
+
+    def compile_enum(self, schema, namespace):
+        node, _ = self.named(schema, namespace)
+        symbols = frozenset(schema['symbols'])
+
+        def check(datum):
+            try:
+                return datum in symbols
+            except TypeError:
+                return False
+
+        def explain(datum, path, errors):
+            if not check(datum):
+                errors.append((path, '%r is not one of %s' % (
+                    datum, ', '.join(schema['symbols']))))
+
+        node.check = check
+        node.explain = explain
+        return node
+
+    def compile_fixed(self, schema, namespace):
+        node, _ = self.named(schema, namespace)
+        size = schema['size']
+        node.check = lambda datum: isinstance(datum, str) and (
+            len(datum) == size)
+        return node
+
+    def compile_array(self, schema, namespace):
+        items = self.compile(schema['items'], namespace)
+        item_check = items.check
+
+        def check(datum):
+            if not isinstance(datum, list):
+                return False
+            for item in datum:
+                if not item_check(item):
+                    return False
+            return True
+
+        def explain(datum, path, errors):
+            if not isinstance(datum, list):
+                errors.append((path, '%r is not a valid array' % (datum,)))
+                return
+            for i, item in enumerate(datum):
+                items.explain(item, '%s[%s]' % (path, i), errors)
+
+        return Node('array', check, explain)
+
+    def compile_map(self, schema, namespace):
+        values = self.compile(schema['values'], namespace)
+        value_check = values.check
+
+        def check(datum):
+            if not isinstance(datum, dict):
+                return False
+            for key, value in datum.iteritems():
+                if not isinstance(key, basestring) or not value_check(value):
+                    return False
+            return True
+
+        def explain(datum, path, errors):
+            if not isinstance(datum, dict):
+                errors.append((path, '%r is not a valid map' % (datum,)))
+                return
+            for key, value in sorted(datum.items()):
+                if not isinstance(key, basestring):
+                    errors.append((path, '%r is not a valid key' % (key,)))
+                    continue
+                values.explain(value, join_path(path, key), errors)
+
+        return Node('map', check, explain)
+
+
+class CompiledValidator(object):
+    """
+    Validates data against an Avro schema.
+
+    :param dict schema:
+        The schema's JSON.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.node = SchemaCompiler().compile(schema)
+
+    def is_valid(self, datum):
+        """
+        Return whether ``datum`` is valid, like :py:func:`avro.io.validate`.
+
+        :returns: bool
+        """
+        return self.node.check(datum)
+
+    def errors(self, datum):
+        """
+        Return what is invalid about ``datum`` as a list of
+        ``(path, message)`` tuples, the path is the dotted path of the
+        field, an empty string for the datum itself.
+
+        :returns: list
+        """
+        if self.node.check(datum):
+            return []
+        errors = []
+        self.node.explain(datum, '', errors)
+        return errors
+
+
+class ValidatorCache(object):
+    """
+    A cache of :py:class:`CompiledValidator` objects keyed by a hash of
+    the schema's source, so that validators are shared by repositories
+    and commits with the same schema.
+
+    :param int max_size:
+        The maximum number of validators to keep.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # sha1 -> CompiledValidator
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, source):
+        """
+        Return the validator for a schema.
+
+        :param str source:
+            The contents of the ``.avsc`` file.
+        :returns: CompiledValidator
+        """
+        key = hashlib.sha1(source).hexdigest()
+        with self.lock:
+            validator = self.entries.pop(key, None)
+            if validator is not None:
+                self.entries[key] = validator
+                self.hits += 1
+                return validator
+            self.misses += 1
+
+        validator = CompiledValidator(json.loads(source))
+        with self.lock:
+            self.entries[key] = validator
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return validator
+
+    def stats(self):
+        """
+        Return the cache's counters.
+
+        :returns: dict
+        """
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+validator_cache = ValidatorCache()
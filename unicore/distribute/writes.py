@@ -0,0 +1,255 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+from elasticgit.storage import StorageException
+
+from unicore.distribute.storage import store_changes
+
+
+class Write(object):
+    """
+    Changes waiting to be committed and the commit they end up in.
+    """
+
+    def __init__(self, changes, message):
+        self.changes = changes
+        self.message = message
+        self.done = threading.Event()
+        # NOTE: set when this write's caller has to commit the next group
+        self.leader = False
+        self.commit = None
+        self.error = None
+
+
+class WriteQueue(object):
+    """
+    Serializes the writes to a repository and commits the writes that
+    arrive while a commit is being made, or within ``window`` seconds
+    of the first one, as a single group commit.
+
+    The first caller to find no commit in progress becomes the leader:
+    it waits ``window`` seconds, takes up to ``max_group_size`` waiting
+    writes, commits them and hands leadership to the next waiting
+    caller, if any. Every caller gets the commit its changes ended up
+    in. If a group commit fails, for example because one of the writes
+    deletes a file that doesn't exist, the writes are committed one by
+    one so that only the faulty write fails.
+
+    :param float window:
+        The number of seconds a leader waits for more writes.
+    :param int max_group_size:
+        The maximum number of writes in a single commit.
+    """
+
+    def __init__(self, window=0, max_group_size=100):
+        self.window = window
+        self.max_group_size = max_group_size
+        self.lock = threading.Lock()
+        # NOTE: held while the repository is being changed
+        self.commit_lock = threading.Lock()
+        self.pending = []
+        self.leading = False
+        self.writes = 0
+        self.commits = 0
+        self.grouped = 0
+        self.largest_group = 0
+
+    def write(self, repo, changes, message):
+        """
+        Commit changes to files, possibly along with other writes.
+
+        :param git.Repo repo:
+            The repository.
+        :param dict changes:
+            Maps file paths to their new data or to ``None`` to delete
+            them.
+        :param str message:
+            The commit message.
+        :returns: git.Commit
+        """
+        write = Write(changes, message)
+        with self.lock:
+            self.pending.append(write)
+            self.writes += 1
+            if not self.leading:
+                self.leading = write.leader = True
+
+        if not write.leader:
+            write.done.wait()
+            if write.leader:
+                # NOTE: handed leadership, our write is still pending
+                write.done.clear()
+        if write.leader:
+            self.lead(repo, write)
+
+        if write.error is not None:
+            raise write.error
+        return write.commit
+
+    def lead(self, repo, write):
+        if self.window:
+            time.sleep(self.window)
+        with self.lock:
+            group = self.pending[:self.max_group_size]
+            del self.pending[:self.max_group_size]
+        try:
+            with self.commit_lock:
+                self.commit_group(repo, group)
+        finally:
+            with self.lock:
+                if self.pending:
+                    self.pending[0].leader = True
+                    self.pending[0].done.set()
+                else:
+                    self.leading = False
+            for other in group:
+                other.done.set()
+
+    def commit_group(self, repo, group):
+        if len(group) == 1:
+            self.commit_writes(repo, group, group[0].message)
+            return
+
+        changes = {}
+        for write in group:
+            changes.update(write.changes)
+        message = 'Group commit of %s writes.\n\n%s' % (
+            len(group), '\n'.join(write.message for write in group))
+        try:
+            self.commit_writes(repo, group, message, changes)
+        except StorageException:
+            for write in group:
+                self.commit_writes(repo, [write], write.message)
+
+    def commit_writes(self, repo, group, message, changes=None):
+        try:
+            commit = store_changes(
+                repo, group[0].changes if changes is None else changes,
+                message)
+        except StorageException, e:
+            if len(group) > 1:
+                raise
+            group[0].error = e
+            return
+        except Exception, e:
+            for write in group:
+                write.error = e
+            return
+        with self.lock:
+            self.commits += 1
+            if len(group) > 1:
+                self.grouped += len(group)
+            self.largest_group = max(self.largest_group, len(group))
+        for write in group:
+            write.commit = commit
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Hold off writes while the repository is changed some other way,
+        pulled for example.
+        """
+        with self.commit_lock:
+            yield
+
+    def stats(self):
+        """
+        Return the number of waiting writes, of writes and commits made
+        and of writes that shared a commit.
+
+        :returns: dict
+        """
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'writes': self.writes,
+                'commits': self.commits,
+                'grouped': self.grouped,
+                'largest_group': self.largest_group,
+            }
+
+
+class WriteQueues(object):
+    """
+    The :py:class:`WriteQueue` of every repository, by name.
+
+    :param float window:
+        See :py:class:`WriteQueue`.
+    :param int max_group_size:
+        See :py:class:`WriteQueue`.
+    """
+
+    def __init__(self, window=0, max_group_size=100):
+        self.window = window
+        self.max_group_size = max_group_size
+        self.lock = threading.Lock()
+        self.queues = {}
+
+    def get(self, name):
+        """
+        Return a repository's queue.
+
+        :param str name:
+            The name of the repository.
+        :returns: WriteQueue
+        """
+        with self.lock:
+            queue = self.queues.get(name)
+            if queue is None:
+                queue = WriteQueue(
+                    window=self.window, max_group_size=self.max_group_size)
+                self.queues[name] = queue
+            return queue
+
+    def stats(self):
+        """
+        Return the totals of the queues' counters.
+
+        :returns: dict
+        """
+        with self.lock:
+            queues = self.queues.values()
+        totals = {
+            'pending': 0,
+            'writes': 0,
+            'commits': 0,
+            'grouped': 0,
+            'largest_group': 0,
+        }
+        for queue in queues:
+            for key, value in queue.stats().items():
+                if key == 'largest_group':
+                    totals[key] = max(totals[key], value)
+                else:
+                    totals[key] += value
+        return totals
+
+
+_queues_lock = threading.Lock()
+
+
+def get_write_queues(registry):
+    """
+    Return the :py:class:`WriteQueues` for an application registry,
+    creating them from the settings if they do not exist yet.
+
+    :param pyramid.registry.Registry registry:
+        The application registry.
+    :returns: WriteQueues
+    """
+    queues = getattr(registry, 'write_queues', None)
+    if queues is not None:
+        return queues
+
+    with _queues_lock:
+        queues = getattr(registry, 'write_queues', None)
+        if queues is None:
+            settings = registry.settings or {}
+            queues = WriteQueues(
+                window=float(settings.get('repo.write_window', 0)),
+                max_group_size=int(
+                    settings.get('repo.write_max_group_size', 100)))
+            registry.write_queues = queues
+        return queues